@@ -1,21 +1,85 @@
+import argparse
+import functools
+
 from .common import (
+    DEFAULT_SIZES,
+    add_common_arguments,
+    add_manifest_arguments,
+    add_sizes_argument,
     add_thumbnail,
-    has_thumbnail,
+    add_thumbnail_sizes,
+    find_sidecar,
     iterate_images,
+    missing_thumbnail_sizes,
+    probe_thumbnail,
+    thumbnail_operation,
     ALL_SUPPORTED_EXTENSIONS,
 )
+from .encoders import DEFAULT_ENCODING, add_encoding_arguments, encoding_from_args
+from .metrics import RunMetrics
 
 
-def add_thumbnails_if_needed(file_path):
-    if not has_thumbnail(file_path):
-        add_thumbnail(file_path)
+def add_thumbnails_if_needed(
+    file_path, keep_aspect=False, sizes=DEFAULT_SIZES, encoding=DEFAULT_ENCODING
+):
+    probe = probe_thumbnail(file_path)
+    if not probe.has_thumbnail:
+        added = add_thumbnail(
+            file_path,
+            keep_aspect=keep_aspect,
+            probe=probe,
+            sizes=sizes,
+            encoding=encoding,
+        )
     else:
-        print(f"Already has thumbnail for {file_path}")
+        # Sizes added to the command line since are added on their own
+        missing = missing_thumbnail_sizes(file_path, sizes)
+        if missing:
+            added = add_thumbnail_sizes(
+                file_path, missing, keep_aspect=keep_aspect, encoding=encoding
+            )
+        else:
+            print(f"Already has thumbnail for {file_path}")
+            added = True
+    # Recorded in the run manifest: removing a sidecar leaves the image itself
+    # unchanged, so only the missing output shows it needs adding again
+    return added and (find_sidecar(file_path) or True)
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Add thumbnails to images")
+    parser.add_argument(
+        "--keep-aspect",
+        action="store_true",
+        help="Fit thumbnails within their size instead of stretching them to it",
+    )
+    add_sizes_argument(parser)
+    add_encoding_arguments(parser)
+    add_common_arguments(parser)
+    add_manifest_arguments(parser)
+    args = parser.parse_args(argv)
+    encoding = encoding_from_args(parser, args)
 
-def main():
     extensions = list(ALL_SUPPORTED_EXTENSIONS)
-    iterate_images(add_thumbnails_if_needed, extensions)
+    operation = thumbnail_operation("add-thumbnail", args.sizes, encoding)
+    func = functools.partial(
+        add_thumbnails_if_needed,
+        keep_aspect=args.keep_aspect,
+        sizes=args.sizes,
+        encoding=encoding,
+    )
+    iterate_images(
+        func,
+        extensions,
+        jobs=args.jobs,
+        max_memory=args.max_memory,
+        operation=operation,
+        force=args.force,
+        status=args.status,
+        resume=args.resume,
+        watch=args.watch,
+        metrics=RunMetrics.from_args(args, "add-thumbnail", encodes=True),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,306 @@
+"""
+Benchmark the processors and tools on synthetic corpora.
+
+  iw-benchmark run --corpus all --output before.json
+  iw-benchmark compare before.json after.json --threshold 10
+
+Each corpus is generated into a scratch directory from noise over gradients,
+which compresses roughly like photographs and scans. Each operation runs over
+every file of a corpus sequentially in a fresh process, so its wall time, CPU
+time and peak RSS are measured in isolation. Operations run in the order
+listed, on the files as the previous operation left them (add-thumbnail,
+then extract-thumbnail, then remove-thumbnail, ...).
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from .common import (
+    add_thumbnail,
+    extract_thumbnail,
+    probe_thumbnail,
+    remove_thumbnail,
+)
+from .compress_tiffs import compress_tiff
+from .convert_format import convert_to_format
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+tifffile = lazy_import("tifffile")
+
+# Corpus name -> [(format, count, (width, height)), ...]
+CORPORA = {
+    "small-jpegs": [("jpg", 200, (640, 480))],
+    "huge-tiffs": [("tif", 2, (6000, 4000))],
+    "mixed": [
+        ("png", 40, (1024, 768)),
+        ("webp", 40, (1024, 768)),
+        ("jpg", 20, (2048, 1536)),
+    ],
+}
+
+# Operation -> extensions it applies to
+OPERATIONS = {
+    "probe": (".jpg", ".png", ".tif"),
+    "add-thumbnail": (".jpg", ".png", ".tif"),
+    "extract-thumbnail": (".jpg", ".png", ".tif"),
+    "remove-thumbnail": (".jpg", ".png", ".tif"),
+    "compress": (".tif",),
+    "convert": (".jpg", ".png", ".tif", ".webp"),
+}
+
+# Metrics compared by `compare`, and whether a larger value is better
+COMPARED = {"wall_s": False, "cpu_s": False, "peak_rss_mb": False}
+
+
+def synthetic_image(size, seed):
+    """An RGB image of smooth gradients plus noise, as a numpy array."""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    base = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    noise = rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+def make_corpus(root, name, scale=1.0):
+    """
+    Write corpus name into root/name and return its files, relative to root
+    (the tools write their output relative to the working directory).
+    """
+    os.makedirs(os.path.join(root, name), exist_ok=True)
+    files = []
+    for fmt, count, size in CORPORA[name]:
+        arr = synthetic_image(size, seed=len(files))
+        for i in range(max(1, round(count * scale))):
+            path = os.path.join(name, f"{fmt}-{i:05d}.{fmt}")
+            files.append(path)
+            path = os.path.join(root, path)
+            if fmt == "tif":
+                tifffile.imwrite(path, arr, photometric="rgb")
+            else:
+                Image.fromarray(arr).save(path)
+    return files
+
+
+def _apply_operation(operation, path):
+    if operation == "probe":
+        return probe_thumbnail(path)
+    if operation == "add-thumbnail":
+        return add_thumbnail(path)
+    if operation == "extract-thumbnail":
+        os.makedirs("thumbnails", exist_ok=True)
+        return extract_thumbnail(path, "thumbnails")
+    if operation == "remove-thumbnail":
+        return remove_thumbnail(path)
+    if operation == "compress":
+        return compress_tiff(path)
+    if operation == "convert":
+        return convert_to_format(path, "png" if not path.endswith(".png") else "jpg")
+    raise ValueError(f"Unknown operation: {operation}")
+
+
+def _reset_peak_rss():
+    # Linux keeps the peak RSS of the process this one was spawned from
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux (but bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _measure(operation, files, workdir):
+    """Run operation over files in this (fresh) process and measure it."""
+    _reset_peak_rss()
+    os.chdir(workdir)
+    os.environ["IW_CACHE"] = os.path.join(workdir, "benchmark-cache.sqlite")
+    nbytes = sum(os.path.getsize(path) for path in files)
+    failed = 0
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for path in files:
+                try:
+                    if _apply_operation(operation, path) is False:
+                        failed += 1
+                except Exception:
+                    failed += 1
+        finally:
+            sys.stdout = stdout
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_start
+    return {
+        "files": len(files),
+        "failed": failed,
+        "bytes": nbytes,
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "files_per_s": round(len(files) / wall, 2) if wall else None,
+        "mb_per_s": round(nbytes / wall / 1e6, 2) if wall else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _git_commit():
+    try:
+        res = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except OSError:
+        return None
+    return res.stdout.strip() or None
+
+
+def run_benchmarks(corpora, operations, scale=1.0, workdir=None):
+    """Generate each corpus, run each applicable operation on it, return results."""
+    results = {}
+    scratch = workdir or tempfile.mkdtemp(prefix="iw-benchmark-")
+    try:
+        for name in corpora:
+            files = make_corpus(scratch, name, scale)
+            for operation in operations:
+                selected = [f for f in files if f.endswith(OPERATIONS[operation])]
+                if not selected:
+                    continue
+                # spawn, so peak RSS is not inherited from this process
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                    result = pool.submit(_measure, operation, selected, scratch)
+                    result = result.result()
+                results[f"{name}/{operation}"] = result
+                print(
+                    f"{name}/{operation}: {result['files']} files in "
+                    f"{result['wall_s']:.2f}s ({result['files_per_s']} files/s, "
+                    f"{result['mb_per_s']} MB/s, peak {result['peak_rss_mb']} MB, "
+                    f"{result['failed']} failed)"
+                )
+    finally:
+        if workdir is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return {
+        "created_at": time.time(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": scale,
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """
+    Print the change of each metric between two result sets and return the
+    list of regressions larger than threshold percent.
+    """
+    regressions = []
+    for key in sorted(set(baseline["results"]) & set(current["results"])):
+        before, after = baseline["results"][key], current["results"][key]
+        changes = []
+        for metric, higher_is_better in COMPARED.items():
+            if not before.get(metric) or after.get(metric) is None:
+                continue
+            change = (after[metric] - before[metric]) / before[metric] * 100
+            changes.append(f"{metric} {change:+.1f}%")
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append((key, metric, change))
+        print(f"{key}: {', '.join(changes)}")
+    for key, metric, change in regressions:
+        print(f"REGRESSION {key}: {metric} {change:+.1f}% (threshold {threshold}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the image operations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run benchmarks")
+    run_parser.add_argument(
+        "--corpus",
+        action="append",
+        choices=list(CORPORA) + ["all"],
+        help="Corpus to generate (repeatable; default: all)",
+    )
+    run_parser.add_argument(
+        "--operation",
+        action="append",
+        choices=list(OPERATIONS),
+        help="Operation to time (repeatable; default: all, in the listed order)",
+    )
+    run_parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply the number of files in each corpus",
+    )
+    run_parser.add_argument(
+        "--workdir", help="Generate corpora here and keep them (default: temporary)"
+    )
+    run_parser.add_argument("--output", help="Write the JSON results to this file")
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two result files; exit 1 on a regression"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="Percentage slowdown (or growth in memory) counted as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        corpora = args.corpus or ["all"]
+        if "all" in corpora:
+            corpora = list(CORPORA)
+        operations = args.operation or list(OPERATIONS)
+        results = run_benchmarks(corpora, operations, args.scale, args.workdir)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
+        else:
+            print(json.dumps(results, indent=2))
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        if compare(baseline, current, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
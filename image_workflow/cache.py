@@ -0,0 +1,201 @@
+"""
+Persistent cache of file hashes and provenance metadata.
+
+Entries live in an SQLite database in the root of the tree being processed and
+are keyed by file identity (device, inode). An entry is only used while the
+file's size, mtime and ctime are unchanged. ctime is included because the
+tools restore mtime after rewriting a file, which would otherwise hide the
+change.
+"""
+
+import json
+import os
+import sqlite3
+
+CACHE_FILENAME = ".iw-cache.sqlite"
+
+# Cached fields, each stored in the column of the same name
+FIELDS = ("sha1", "metadata")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    sha1 TEXT,
+    metadata TEXT,
+    PRIMARY KEY (device, inode)
+)
+"""
+
+
+class MetadataCache:
+    def __init__(self, db_path=CACHE_FILENAME):
+        self.db_path = str(db_path)
+        # Autocommit; WAL lets worker processes read while one of them writes
+        self.conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(SCHEMA)
+
+    def _row(self, stat):
+        return self.conn.execute(
+            "SELECT size, mtime_ns, ctime_ns, sha1, metadata FROM files "
+            "WHERE device = ? AND inode = ?",
+            (stat.st_dev, stat.st_ino),
+        ).fetchone()
+
+    def get(self, path, field, compute, stat=None):
+        """
+        Return field ("sha1" or "metadata") for path, calling compute(path) and
+        storing the result when there is no valid cached value.
+        """
+        if field not in FIELDS:
+            raise ValueError(f"Unknown cache field: {field}")
+        if stat is None:
+            stat = os.stat(path)
+
+        try:
+            row = self._row(stat)
+        except sqlite3.Error:
+            return compute(path)
+        fresh = row is not None and row[:3] == (
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ctime_ns,
+        )
+        if fresh:
+            value = row[3] if field == "sha1" else row[4]
+            if value is not None:
+                return value if field == "sha1" else json.loads(value)
+
+        value = compute(path)
+        stored = value if field == "sha1" else json.dumps(value)
+        try:
+            self._store(path, stat, field, stored, fresh)
+        except sqlite3.Error as e:
+            # A busy or read-only database must not fail the operation itself
+            print(f"Could not update metadata cache for {path}: {e}")
+        return value
+
+    def peek(self, path, field, stat=None):
+        """Return field for path if it is cached and valid, without computing it."""
+        if stat is None:
+            stat = os.stat(path)
+        try:
+            row = self._row(stat)
+        except sqlite3.Error:
+            return None
+        if row is None or row[:3] != (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns):
+            return None
+        value = row[3] if field == "sha1" else row[4]
+        if value is None or field == "sha1":
+            return value
+        return json.loads(value)
+
+    def _store(self, path, stat, field, stored, fresh):
+        if fresh:
+            self.conn.execute(
+                f"UPDATE files SET {field} = ?, path = ? WHERE device = ? AND inode = ?",
+                (stored, str(path), stat.st_dev, stat.st_ino),
+            )
+        else:
+            # New or changed file: any other cached field is stale
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO files "
+                f"(device, inode, path, size, mtime_ns, ctime_ns, {field}) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    stat.st_dev,
+                    stat.st_ino,
+                    str(path),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    stat.st_ctime_ns,
+                    stored,
+                ),
+            )
+
+    def entries(self):
+        """Yield (path, size, sha1, metadata) for every cached file."""
+        rows = self.conn.execute(
+            "SELECT path, size, sha1, metadata FROM files ORDER BY path"
+        )
+        for path, size, sha1, metadata in rows:
+            yield path, size, sha1, json.loads(metadata) if metadata else None
+
+    def stats(self):
+        """Return a dict of entry counts for the cache report."""
+        total, hashed, with_meta = self.conn.execute(
+            "SELECT COUNT(*), COUNT(sha1), "
+            "SUM(CASE WHEN metadata IS NOT NULL AND metadata != 'null' "
+            "THEN 1 ELSE 0 END) FROM files"
+        ).fetchone()
+        return {"entries": total, "hashed": hashed, "with_metadata": with_meta or 0}
+
+    def prune(self):
+        """Drop entries whose file is gone or has changed. Returns the count."""
+        stale = []
+        rows = self.conn.execute(
+            "SELECT device, inode, path, size, mtime_ns, ctime_ns FROM files"
+        ).fetchall()
+        for device, inode, path, size, mtime_ns, ctime_ns in rows:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append((device, inode))
+                continue
+            identity = (stat.st_dev, stat.st_ino, stat.st_size)
+            times = (stat.st_mtime_ns, stat.st_ctime_ns)
+            if identity != (device, inode, size) or times != (mtime_ns, ctime_ns):
+                stale.append((device, inode))
+        self.conn.executemany("DELETE FROM files WHERE device = ? AND inode = ?", stale)
+        self.conn.execute("VACUUM")
+        return len(stale)
+
+    def clear(self):
+        self.conn.execute("DELETE FROM files")
+
+    def close(self):
+        self.conn.close()
+
+
+class NullCache:
+    """Stand-in used when caching is disabled or the database is unusable."""
+
+    def get(self, path, field, compute, stat=None):
+        return compute(path)
+
+    def peek(self, path, field, stat=None):
+        return None
+
+
+_caches = {}
+
+
+def cache_path():
+    """Location of the cache database: $IW_CACHE, else the tree root (cwd)."""
+    return os.environ.get("IW_CACHE") or CACHE_FILENAME
+
+
+def get_cache():
+    """
+    Return this process's cache for the current tree.
+    Connections are per process because SQLite handles must not cross fork().
+    Set IW_CACHE=off to disable caching.
+    """
+    path = cache_path()
+    if path == "off":
+        return NullCache()
+    key = (os.getpid(), os.path.abspath(path))
+    cache = _caches.get(key)
+    if cache is None:
+        try:
+            cache = MetadataCache(path)
+        except sqlite3.Error as e:
+            print(f"Metadata cache disabled ({path}: {e})")
+            cache = NullCache()
+        _caches[key] = cache
+    return cache
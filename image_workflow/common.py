@@ -1,73 +1,294 @@
 import os
 import shutil
 import hashlib
+import filecmp
+import functools
 import json
+import re
 import subprocess
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
 from io import BytesIO
 from pathlib import Path
 
-import piexif
-import tifffile
-from PIL import Image
+from . import headers
+from .encoders import (
+    DEFAULT_ENCODING,
+    FORMATS,
+    encode_thumbnail,
+    extension,
+    settings_label,
+    tiff_thumbnail,
+)
+from .headers import NO_THUMBNAIL, ThumbnailProbe
+from .lazy import lazy_import, preload
+from .cache import get_cache
+from .jobs import JobJournal
+from .manifest import get_manifest
+from .metrics import Measured, measured, timed
+from .thumbstore import STORE_DIRNAME, get_thumbnail_store
+from .tiffio import (
+    JOURNAL_SUFFIX,
+    append_subifds,
+    jpeg_stream,
+    needs_bigtiff,
+    page_resolution,
+    read_thumbnail,
+    recover_append,
+    shrink_page,
+    write_page,
+    write_thumbnail,
+)
+
+# Codec libraries and the process pool, loaded when first needed (see lazy.py)
+futures = lazy_import("concurrent.futures")
+piexif = lazy_import("piexif")
+tifffile = lazy_import("tifffile")
+Image = lazy_import("PIL.Image")
+
+# Suffix of the JPEG sidecar written next to formats without embedded thumbnails
+SIDECAR_SUFFIX = ".thumb.jpg"
+
+# Sidecars: the primary thumbnail's, and those of other sizes (.thumb-64.jpg),
+# in any thumbnail format
+SIDECAR_PATTERN = re.compile(r"\.thumb(-\d+)?\.(jpg|webp|avif)$", re.IGNORECASE)
+
+# Directories the tools write their own output into; never scanned for inputs
+GENERATED_DIRS = ("converted", "thumbnails", STORE_DIRNAME)
+
+# Suffixes of files the tools write next to their input and then rename over
+# it or remove: left behind only if a run is killed midway
+TEMPORARY_SUFFIXES = (".tmp", JOURNAL_SUFFIX)
+
+# Suffix of the rewrite compress_tiff makes of <stem>.tif next to it
+COMPRESSED_SUFFIX = "-compressed.tiff"
+
+# Seconds a new file's size and mtime must be stable before --watch takes it
+DEFAULT_SETTLE = 0.5
+
+# Largest EXIF segment a JPEG APP1 marker can hold (its length field counts itself)
+EXIF_MAX_BYTES = 65533
+
+# Default thumbnail dimensions (width, height)
+THUMBNAIL_SIZE = (256, 256)
+
+# Thumbnail sizes (edge lengths) made by default: the first is the primary
+# thumbnail, embedded where the format allows it; others go to sidecars
+DEFAULT_SIZES = (THUMBNAIL_SIZE[0],)
+
+
+def thumbnail_target(source_size, size=THUMBNAIL_SIZE, keep_aspect=False):
+    """Final thumbnail dimensions for an image of source_size."""
+    if not keep_aspect:
+        return size
+    scale = min(size[0] / source_size[0], size[1] / source_size[1])
+    return (
+        max(1, round(source_size[0] * scale)),
+        max(1, round(source_size[1] * scale)),
+    )
+
+
+def make_thumbnail(img, size=THUMBNAIL_SIZE, keep_aspect=False):
+    """
+    Downscale an opened (not yet loaded) image to a thumbnail.
+    JPEGs are decoded at reduced resolution in the DCT domain (draft mode), and
+    resize() pre-shrinks with Image.reduce() before the final resampling, so
+    the full-resolution raster is never filtered. With keep_aspect the
+    thumbnail fits within size instead of being stretched to it.
+    """
+    target = thumbnail_target(img.size, size, keep_aspect)
+    with timed("thumbnail"):
+        if img.format == "JPEG":
+            img.draft(None, target)
+        thumb = img.resize(target, reducing_gap=3.0)
+    # Thumbnails are stored as JPEG or RGB TIFF
+    if thumb.mode not in ("RGB", "L"):
+        thumb = thumb.convert("RGB")
+    return thumb
+
+
+def downsample_thumbnails(thumbnail, sizes, keep_aspect=False):
+    """
+    Thumbnails of each of sizes (edge lengths, at most thumbnail's own), in
+    the order given, each resized from the next larger one rather than from
+    the image.
+    """
+    made = {}
+    for size in sorted(set(sizes), reverse=True):
+        target = thumbnail_target(thumbnail.size, (size, size), keep_aspect)
+        if thumbnail.size != target:
+            with timed("thumbnail"):
+                thumbnail = thumbnail.resize(target)
+        made[size] = thumbnail
+    return [made[size] for size in sizes]
+
+
+def sidecar_path(file_path, size=None, ext=".jpg"):
+    """Sidecar of file_path holding its primary thumbnail, or the one of size."""
+    if size is None:
+        return f"{file_path}.thumb{ext}"
+    return f"{file_path}.thumb-{size}{ext}"
+
+
+def find_sidecar(file_path, size=None):
+    """The existing sidecar of file_path for size, in whichever format, or None."""
+    for _, ext in FORMATS.values():
+        path = sidecar_path(file_path, size, ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def is_sidecar(name):
+    return SIDECAR_PATTERN.search(name) is not None
+
+
+def _write_sidecar(path, data):
+    with timed("sidecar-write") as stage, open(path, "wb") as f:
+        f.write(data)
+        stage.bytes_written = len(data)
+
+
+def _sidecars(file_path):
+    """Every sidecar of file_path, of the primary and other sizes, in any format."""
+    directory, name = os.path.split(str(file_path))
+    try:
+        names = os.listdir(directory or ".")
+    except OSError:
+        return []
+    return [
+        os.path.join(directory, other)
+        for other in sorted(names)
+        if other.startswith(name) and SIDECAR_PATTERN.match(other, len(name))
+    ]
+
+
+def _sidecar_sizes(file_path):
+    """The sizes of the sidecars of file_path other than the primary one."""
+    sizes = set()
+    for sidecar in _sidecars(file_path):
+        size = SIDECAR_PATTERN.search(sidecar).group(1)
+        if size:
+            sizes.add(int(size[1:]))
+    return sizes
+
+
+def _write_sidecars(file_path, thumbnails, sizes, encoding):
+    """Write thumbnails, one for each of sizes, to sized sidecars."""
+    for thumbnail, size in zip(thumbnails, sizes):
+        data = encode_thumbnail(thumbnail, encoding)
+        _write_sidecar(sidecar_path(file_path, size, extension(encoding)), data)
+
+
+def _add_sidecars(file_path, sizes, keep_aspect, encoding):
+    thumbnails = build_thumbnails(file_path, sizes, keep_aspect)
+    _write_sidecars(file_path, thumbnails, sizes, encoding)
+    return True
+
+
+def _remove_sidecars(file_path):
+    """
+    Remove every sidecar of file_path, whatever its size or format. Returns
+    True if one of them held the primary thumbnail.
+    """
+    primary = False
+    sidecars = _sidecars(file_path)
+    for sidecar in sidecars:
+        os.remove(sidecar)
+        primary = primary or not SIDECAR_PATTERN.search(sidecar).group(1)
+    manifest = get_manifest() if sidecars else None
+    if manifest is not None:
+        # The image itself is unchanged, so its extractions would look current
+        manifest.forget(file_path, "extract-thumbnail")
+    return primary
+
+
+def _transcode(data, encoding):
+    """
+    Encoded thumbnail data re-encoded as encoding, unless already in its format
+    and encoding asks for no particular quality, subsampling or progressive.
+    """
+    with Image.open(BytesIO(data)) as img:
+        if img.format == FORMATS[encoding.format][0] and not settings_label(encoding):
+            return data
+        img.load()
+        return encode_thumbnail(img, encoding)
+
+
+def _extract_sidecar(file_path, thumb_path, size=None, encoding=DEFAULT_ENCODING):
+    sidecar = find_sidecar(file_path, size)
+    if sidecar is None:
+        print(f"No {_size_label(size)}thumbnail found in {file_path}")
+        return False
+    with open(sidecar, "rb") as f:
+        write_if_changed(thumb_path, _transcode(f.read(), encoding))
+    print(f"Extracted {_size_label(size)}thumbnail for {file_path}")
+    return True
+
+
+def _size_label(size):
+    return "" if size is None else f"{size}px "
+
 
 # Processor classes for different image formats
 
 
 class ExifImageProcessor:
+    @staticmethod
+    def probe(file_path):
+        return headers.probe_jpeg_thumbnail(file_path)
+
     @staticmethod
     def has_thumbnail(file_path):
-        try:
-            exif = piexif.load(str(file_path))
-            return exif["thumbnail"] is not None
-        except:
-            return False
+        return ExifImageProcessor.probe(file_path).has_thumbnail
+
+    @staticmethod
+    def build_thumbnail(file_path, keep_aspect=False, size=THUMBNAIL_SIZE):
+        with Image.open(file_path) as img:
+            return make_thumbnail(img, size, keep_aspect=keep_aspect)
 
     @staticmethod
-    def add_thumbnail(file_path):
+    def add_thumbnail(
+        file_path,
+        keep_aspect=False,
+        probe=None,
+        thumbnails=None,
+        sizes=DEFAULT_SIZES,
+        encoding=DEFAULT_ENCODING,
+    ):
         file_str = str(file_path)
         if not os.path.isfile(file_path):
             return False
+        if probe is None:
+            probe = ExifImageProcessor.probe(file_path)
 
         path_obj = Path(file_path)
 
+        # The "Original Creation Date" in the JSON refers to the SOURCE, while
+        # the file modification date should preserve the file's history.
+        # So we restore stats of the file as it was before this operation.
+        stat = path_obj.stat()
+
         # Metadata Logic: Prefer existing, else create new
-        existing_meta = get_existing_metadata(path_obj)
-        if existing_meta:
-            json_str = json.dumps(existing_meta)
-            # Use existing stats for restoration? Or current stats?
-            # If we are modifying the file, we want to restore PRE-modification stats.
-            # But technically the "Original Creation Date" in JSON refers to the SOURCE.
-            # The file modification date should preserve the file's history.
-            # So we restore stats of the file as it was before this operation.
-            stat = path_obj.stat()
-        else:
-            # Gather new metadata
-            stat = path_obj.stat()
-            created_at = getattr(stat, "st_birthtime", stat.st_mtime)
-            sha1 = get_sha1(path_obj)
-            source_file = str(path_obj.resolve())
-
-            metadata = {
-                "created_at": created_at,
-                "sha1": sha1,
-                "source_file": source_file,
-            }
-            json_str = json.dumps(metadata)
+        json_str = json.dumps(get_provenance(path_obj))
 
-        with Image.open(file_str) as img:
-            thumb = img.resize((256, 256))
-            buffer = BytesIO()
-            thumb.save(buffer, "JPEG")
-            thumb_bytes = buffer.getvalue()
+        if thumbnails is None:
+            thumbnails = build_thumbnails(file_path, sizes, keep_aspect)
 
         try:
+            if probe.exif is None:
+                raise ValueError("No EXIF segment")
             exif_dict = piexif.load(file_str)
+            created = False
         except:
             # Create new EXIF with thumbnail
-            exif_dict = {"thumbnail": thumb_bytes}
-            print(f"Added thumbnail to {file_path}: created new EXIF segment")
+            exif_dict = {}
+            created = True
 
-        exif_dict["thumbnail"] = thumb_bytes
+        # piexif only writes the thumbnail if there is an IFD1 ("1st") for it
+        exif_dict.setdefault("1st", {})
 
         # Embed metadata in ImageDescription (Tag 270)
         if "0th" not in exif_dict:
@@ -75,44 +296,116 @@ class ExifImageProcessor:
 
         exif_dict["0th"][piexif.ImageIFD.ImageDescription] = json_str.encode("utf-8")
 
-        exif_bytes = piexif.dump(exif_dict)
-        piexif.insert(exif_bytes, file_str)
+        embedded, exif_bytes = ExifImageProcessor._fit_thumbnail(
+            exif_dict, thumbnails, encoding
+        )
+        if exif_bytes is None:
+            print(
+                f"Failed to add thumbnail to {file_path}: no thumbnail size fits "
+                "in the 64 KB EXIF segment"
+            )
+            return False
+        if created:
+            print(f"Added thumbnail to {file_path}: created new EXIF segment")
+
+        primary_sidecar = find_sidecar(file_path)
+        if embedded != 0:
+            # The primary thumbnail is kept in a sidecar, as for a PNG
+            width = max(thumbnails[embedded].size)
+            print(
+                f"Added thumbnail to {file_path}: primary thumbnail too large for "
+                f"EXIF, embedded the {width}px one instead"
+            )
+            thumb_bytes = encode_thumbnail(thumbnails[0], encoding)
+            _write_sidecar(
+                sidecar_path(file_path, None, extension(encoding)), thumb_bytes
+            )
+        elif primary_sidecar is not None:
+            os.remove(primary_sidecar)
+
+        with timed("exif-write") as stage:
+            piexif.insert(exif_bytes, file_str)
+            stage.bytes_written = len(exif_bytes)
 
         # Restore timestamps
         os.utime(file_str, (stat.st_atime, stat.st_mtime))
 
+        # Other sizes do not fit in the 64 KB EXIF segment
+        _write_sidecars(file_path, thumbnails[1:], sizes[1:], encoding)
+
         print(f"Added thumbnail to {file_path}")
         return True
 
     @staticmethod
-    def extract_thumbnail(file_path, thumb_dir):
-        file_str = str(file_path)
+    def _fit_thumbnail(exif_dict, thumbnails, encoding):
+        """
+        Put the largest of thumbnails, the primary one if it fits, that fits
+        in the EXIF segment into exif_dict. Returns its index in thumbnails
+        and the segment, or (None, None) if none fits.
+        """
+        candidates = sorted(
+            range(len(thumbnails)),
+            key=lambda index: (index != 0, -max(thumbnails[index].size)),
+        )
+        for index in candidates:
+            exif_dict["thumbnail"] = encode_thumbnail(
+                thumbnails[index], encoding, baseline=True
+            )
+            try:
+                exif_bytes = piexif.dump(exif_dict)
+            except ValueError:
+                continue  # piexif refuses thumbnails over 64000 bytes
+            if len(exif_bytes) <= EXIF_MAX_BYTES:
+                return index, exif_bytes
+        return None, None
+
+    @staticmethod
+    def extract_thumbnail(file_path, thumb_path, size=None, encoding=DEFAULT_ENCODING):
+        # A primary thumbnail too large for EXIF is kept in a sidecar
+        if size is not None or find_sidecar(file_path) is not None:
+            return _extract_sidecar(file_path, thumb_path, size, encoding)
         try:
-            exif = piexif.load(file_str)
-            if exif["thumbnail"] is not None:
-                thumb_path = os.path.join(
-                    thumb_dir, f"{os.path.basename(file_str)}.jpg"
-                )
-                with open(thumb_path, "wb") as f:
-                    f.write(exif["thumbnail"])
-                print(f"Extracted thumbnail for {file_path}")
-                return True
-            else:
+            # The IFD1 JPEG is copied out as is, located from the headers
+            probe = ExifImageProcessor.probe(file_path)
+            if not probe.has_thumbnail:
                 print(f"No thumbnail found in {file_path}")
                 return False
+            offset, length = probe.thumbnail
+            with open(file_path, "rb") as f:
+                f.seek(offset)
+                thumb_bytes = f.read(length)
+            if len(thumb_bytes) != length or not thumb_bytes.startswith(b"\xff\xd8"):
+                raise ValueError("thumbnail data is truncated or not a JPEG")
+            write_if_changed(thumb_path, _transcode(thumb_bytes, encoding))
+            print(f"Extracted thumbnail for {file_path}")
+            return True
         except Exception as e:
             print(f"Failed to extract thumbnail for {file_path}: {e}")
             return False
 
     @staticmethod
-    def remove_thumbnail(file_path):
+    def thumbnail_sizes(file_path):
+        return _sidecar_sizes(file_path)
+
+    @staticmethod
+    def add_sizes(file_path, sizes, keep_aspect=False, encoding=DEFAULT_ENCODING):
+        return _add_sidecars(file_path, sizes, keep_aspect, encoding)
+
+    @staticmethod
+    def remove_thumbnail(file_path, probe=None):
         file_str = str(file_path)
+        _remove_sidecars(file_path)
+        if probe is not None and not probe.has_thumbnail:
+            print(f"No thumbnail to remove in {file_path}")
+            return False
         try:
             exif_dict = piexif.load(file_str)
             if exif_dict["thumbnail"] is not None:
                 exif_dict["thumbnail"] = None
                 exif_bytes = piexif.dump(exif_dict)
-                piexif.insert(exif_bytes, file_str)
+                with timed("exif-write") as stage:
+                    piexif.insert(exif_bytes, file_str)
+                    stage.bytes_written = len(exif_bytes)
                 print(f"Removed thumbnail from {file_path}")
                 return True
             else:
@@ -124,145 +417,208 @@ class ExifImageProcessor:
 
 
 class PngImageProcessor:
+    @staticmethod
+    def probe(file_path):
+        return ThumbnailProbe(find_sidecar(file_path) is not None)
+
     @staticmethod
     def has_thumbnail(file_path):
-        sidecar = str(file_path) + ".thumb.jpg"
-        return os.path.isfile(sidecar)
+        return PngImageProcessor.probe(file_path).has_thumbnail
 
     @staticmethod
-    def add_thumbnail(file_path):
-        file_str = str(file_path)
+    def build_thumbnail(file_path, keep_aspect=False, size=THUMBNAIL_SIZE):
+        with Image.open(file_path) as img:
+            return make_thumbnail(img, size, keep_aspect=keep_aspect)
+
+    @staticmethod
+    def add_thumbnail(
+        file_path,
+        keep_aspect=False,
+        probe=None,
+        thumbnails=None,
+        sizes=DEFAULT_SIZES,
+        encoding=DEFAULT_ENCODING,
+    ):
         if not os.path.isfile(file_path):
             return False
-        if PngImageProcessor.has_thumbnail(file_path):
+        if probe is None:
+            probe = PngImageProcessor.probe(file_path)
+        if probe.has_thumbnail:
             return False
-        with Image.open(file_str) as img:
-            thumb = img.resize((256, 256))
-            buffer = BytesIO()
-            thumb.save(buffer, "JPEG")
-            thumb_bytes = buffer.getvalue()
-
-        sidecar = file_str + ".thumb.jpg"
-        with open(sidecar, "wb") as f:
-            f.write(thumb_bytes)
+        if thumbnails is None:
+            thumbnails = build_thumbnails(file_path, sizes, keep_aspect)
+        thumb_bytes = encode_thumbnail(thumbnails[0], encoding)
+
+        _write_sidecar(sidecar_path(file_path, None, extension(encoding)), thumb_bytes)
+        _write_sidecars(file_path, thumbnails[1:], sizes[1:], encoding)
         print(f"Added thumbnail to {file_path}")
         return True
 
     @staticmethod
-    def extract_thumbnail(file_path, thumb_dir):
-        file_str = str(file_path)
-        sidecar = file_str + ".thumb.jpg"
-        if not os.path.isfile(sidecar):
-            print(f"No thumbnail found in {file_path}")
-            return False
-        thumb_path = os.path.join(thumb_dir, f"{os.path.basename(file_str)}.jpg")
-        shutil.copy2(sidecar, thumb_path)
-        print(f"Extracted thumbnail for {file_path}")
-        return True
+    def extract_thumbnail(file_path, thumb_path, size=None, encoding=DEFAULT_ENCODING):
+        return _extract_sidecar(file_path, thumb_path, size, encoding)
 
     @staticmethod
-    def remove_thumbnail(file_path):
-        file_str = str(file_path)
-        sidecar = file_str + ".thumb.jpg"
-        if not os.path.isfile(sidecar):
+    def thumbnail_sizes(file_path):
+        return _sidecar_sizes(file_path)
+
+    @staticmethod
+    def add_sizes(file_path, sizes, keep_aspect=False, encoding=DEFAULT_ENCODING):
+        return _add_sidecars(file_path, sizes, keep_aspect, encoding)
+
+    @staticmethod
+    def remove_thumbnail(file_path, probe=None):
+        if not _remove_sidecars(file_path):
             print(f"No thumbnail to remove in {file_path}")
             return False
-        os.remove(sidecar)
         print(f"Removed thumbnail from {file_path}")
         return True
 
 
 class TiffImageProcessor:
+    @staticmethod
+    def probe(file_path):
+        # Check for SubIFD thumbnail (correct method).
+        # We strictly check for the SubIFD structure (not a second page) to
+        # avoid false positives with actual multipage TIFFs.
+        return headers.probe_tiff_thumbnail(file_path)
+
     @staticmethod
     def has_thumbnail(file_path):
+        return TiffImageProcessor.probe(file_path).has_thumbnail
+
+    @staticmethod
+    def _reduced_thumbnail(file_path, keep_aspect=False, size=THUMBNAIL_SIZE):
+        """
+        Build the thumbnail from the smallest reduced-resolution level of the
+        image that is still at least thumbnail sized, if the TIFF has any.
+        Returns None when there is no usable level.
+        """
         try:
             with tifffile.TiffFile(file_path) as tif:
-                # Check for SubIFD thumbnail (correct method)
-                if tif.pages[0].subifds:
-                    return True
-                # Fallback: check for multi-page (legacy method compatibility)
-                # only if second page is a thumbnail (e.g. reduced resolution)
-                # For now, we'll strictly check for the SubIFD structure as the "correct" way
-                # but since we are fixing it, we might want to be able to detect the old ones too?
-                # Let's stick to the new standard to avoid false positives with actual multipage TIFFs.
-                return False
-        except:
-            return False
+                best = None
+                for level in tif.series[0].levels[1:]:
+                    page = level.keyframe
+                    target = thumbnail_target(
+                        (page.imagewidth, page.imagelength), size, keep_aspect
+                    )
+                    if page.imagewidth < target[0] or page.imagelength < target[1]:
+                        break
+                    best = level
+                if best is None:
+                    return None
+                img = Image.fromarray(best.asarray())
+        except Exception:
+            return None
+        return make_thumbnail(img, size, keep_aspect=keep_aspect)
+
+    @staticmethod
+    def _streamed_thumbnail(file_path, keep_aspect=False, size=THUMBNAIL_SIZE):
+        """
+        Build the thumbnail of an image too large to decode at once from its
+        strips or tiles, shrinking each band as it is read (see shrink_page).
+        Returns None for images small enough to be decoded whole.
+        """
+        try:
+            with tifffile.TiffFile(file_path) as tif:
+                reduced = shrink_page(tif.pages[0], size)
+                if reduced is None:
+                    return None
+                img = Image.fromarray(reduced)
+        except Exception:
+            return None
+        return make_thumbnail(img, size, keep_aspect=keep_aspect)
+
+    @staticmethod
+    def build_thumbnail(file_path, keep_aspect=False, size=THUMBNAIL_SIZE):
+        thumb = TiffImageProcessor._reduced_thumbnail(file_path, keep_aspect, size)
+        if thumb is None:
+            thumb = TiffImageProcessor._streamed_thumbnail(file_path, keep_aspect, size)
+        if thumb is None:
+            with Image.open(file_path) as img:
+                thumb = make_thumbnail(img, size, keep_aspect=keep_aspect)
+        return thumb
 
     @staticmethod
-    def add_thumbnail(file_path):
+    def add_thumbnail(
+        file_path,
+        keep_aspect=False,
+        probe=None,
+        thumbnails=None,
+        sizes=DEFAULT_SIZES,
+        encoding=DEFAULT_ENCODING,
+    ):
         file_str = str(file_path)
         if not os.path.isfile(file_path):
             return False
-        if TiffImageProcessor.has_thumbnail(file_path):
+        # Roll back an in-place update interrupted by a crash
+        if recover_append(file_path) or probe is None:
+            probe = TiffImageProcessor.probe(file_path)
+        if probe.has_thumbnail:
             return False
 
         path_obj = Path(file_path)
 
+        stat = path_obj.stat()
+
         # Metadata Logic: Prefer existing, else create new
-        existing_meta = get_existing_metadata(path_obj)
-        if existing_meta:
-            json_str = json.dumps(existing_meta)
-            stat = path_obj.stat()
-        else:
-            # Gather metadata
-            stat = path_obj.stat()
-            created_at = getattr(stat, "st_birthtime", stat.st_mtime)
-            sha1 = get_sha1(path_obj)
-            source_file = str(path_obj.resolve())
-
-            metadata = {
-                "created_at": created_at,
-                "sha1": sha1,
-                "source_file": source_file,
-            }
-            json_str = json.dumps(metadata)
+        json_str = json.dumps(get_provenance(path_obj))
 
-        # Generate thumbnail
-        with Image.open(file_str) as img:
-            thumb = img.resize((256, 256))
-            buffer = BytesIO()
-            thumb.save(buffer, "TIFF")
-            thumb_bytes = buffer.getvalue()
+        if thumbnails is None:
+            thumbnails = build_thumbnails(file_path, sizes, keep_aspect)
+        # Every size is a SubIFD of page 0, the primary thumbnail first
+        thumbs = [tiff_thumbnail(thumbnail, encoding) for thumbnail in thumbnails]
 
-        # Read original
-        with tifffile.TiffFile(file_path) as tif:
-            arr = tif.asarray()
-            page0 = tif.pages[0]
-            photometric = getattr(page0, "photometric", 2)  # RGB
-            compression = getattr(page0, "compression", 1)  # uncompressed
-            # Preserve other critical tags if needed, but for now these are the basics used before
+        try:
+            # Append the thumbnail IFDs and patch page 0 in place
+            with timed("tiff-append") as stage:
+                append_subifds(file_path, thumbs, json_str)
+                stage.bytes_written = os.path.getsize(file_path) - stat.st_size
+        except ValueError:
+            # Not updatable in place: rewrite the file instead
+            if not TiffImageProcessor._rewrite_with_thumbnail(
+                file_path, thumbs, json_str
+            ):
+                return False
+        except Exception as e:
+            recover_append(file_path)
+            print(f"Failed to add thumbnail to {file_path}: {e}")
+            return False
+
+        # Restore timestamps
+        os.utime(file_str, (stat.st_atime, stat.st_mtime))
+
+        print(f"Added thumbnail to {file_path}")
+        return True
 
+    @staticmethod
+    def _rewrite_with_thumbnail(file_path, thumbs, json_str):
+        file_str = str(file_path)
         tmp_path = file_str + ".tmp"
         try:
-            # Write original with SubIFD pointing to thumbnail
-            with tifffile.TiffWriter(tmp_path) as writer:
-                # subifds=1 means we promise 1 subifd for this page
-                # Add description metadata
-                writer.write(
-                    arr,
-                    photometric=photometric,
-                    compression=compression,
-                    subifds=1,
-                    description=json_str,
-                )
-
-                # Load thumb as array
-                with BytesIO(thumb_bytes) as bio:
-                    thumbs = tifffile.TiffFile(bio)
-                    thumb_arr = thumbs.asarray()
-                    thumb_photometric = thumbs.pages[0].photometric or 2
-
-                # Write the thumbnail as the SubIFD
-                # subfiletype=1 indicates it is a reduced-resolution version (thumbnail)
-                writer.write(thumb_arr, photometric=thumb_photometric, subfiletype=1)
+            with tifffile.TiffFile(file_path) as tif:
+                page0 = tif.pages[0]
+                size = os.path.getsize(file_path)
+                bigtiff = tif.is_bigtiff or needs_bigtiff(size)
+                # Write original with SubIFD pointing to thumbnail.
+                # The main image is streamed with its original compression.
+                with tifffile.TiffWriter(tmp_path, bigtiff=bigtiff) as writer:
+                    # subifds=N means we promise N subifds for this page
+                    write_page(
+                        writer,
+                        tif,
+                        page0,
+                        subifds=len(thumbs),
+                        description=json_str,
+                        resolution=page_resolution(page0),
+                    )
+
+                    # Write the thumbnails as the SubIFDs, marked as
+                    # reduced-resolution versions (subfiletype=1)
+                    for thumb in thumbs:
+                        write_thumbnail(writer, thumb, compression=None)
 
             os.replace(tmp_path, file_str)
-
-            # Restore timestamps
-            os.utime(file_str, (stat.st_atime, stat.st_mtime))
-
-            print(f"Added thumbnail to {file_path}")
             return True
         except Exception as e:
             if os.path.exists(tmp_path):
@@ -271,8 +627,38 @@ class TiffImageProcessor:
             return False
 
     @staticmethod
-    def extract_thumbnail(file_path, thumb_dir):
-        file_str = str(file_path)
+    def thumbnail_sizes(file_path):
+        with tifffile.TiffFile(file_path) as tif:
+            return {
+                max(thumb.imagewidth, thumb.imagelength)
+                for thumb in tif.pages[0].pages or ()
+            }
+
+    @staticmethod
+    def add_sizes(file_path, sizes, keep_aspect=False, encoding=DEFAULT_ENCODING):
+        """Add SubIFD thumbnails of sizes after the ones page 0 already has."""
+        stat = os.stat(file_path)
+        json_str = json.dumps(get_provenance(file_path))
+        thumbnails = build_thumbnails(file_path, sizes, keep_aspect)
+        try:
+            with tifffile.TiffFile(file_path) as tif:
+                thumbs = [read_thumbnail(tif, thumb) for thumb in tif.pages[0].pages]
+        except Exception as e:
+            print(f"Failed to add thumbnail to {file_path}: {e}")
+            return False
+        thumbs += [tiff_thumbnail(thumbnail, encoding) for thumbnail in thumbnails]
+        if not TiffImageProcessor._rewrite_with_thumbnail(file_path, thumbs, json_str):
+            return False
+        os.utime(file_path, (stat.st_atime, stat.st_mtime))
+        return True
+
+    @staticmethod
+    def extract_thumbnail(file_path, thumb_path, size=None, encoding=DEFAULT_ENCODING):
+        """
+        Extract the primary thumbnail (the first SubIFD of page 0), or with
+        size the SubIFD whose longer edge is size pixels.
+        """
+        label = _size_label(size)
         try:
             with tifffile.TiffFile(file_path) as tif:
                 # Check SubIFDs of first page
@@ -281,55 +667,63 @@ class TiffImageProcessor:
                     print(f"No thumbnail found in {file_path}")
                     return False
 
-                # Find the series matching the subifd offset
-                thumb_offsets = set(page.subifds)
-                thumb_series = None
-
-                # Look through series to find the one that matches the subifd offset
-                for series in tif.series:
-                    if series.pages:
-                        if series.pages[0].offset in thumb_offsets:
-                            thumb_series = series
-                            break
-
-                if thumb_series is None:
-                    print(f"Could not locate thumbnail series in {file_path}")
+                thumb_pages = list(page.pages)
+                if size is not None:
+                    thumb_pages = [
+                        thumb
+                        for thumb in thumb_pages
+                        if max(thumb.imagewidth, thumb.imagelength) == size
+                    ]
+                if not thumb_pages:
+                    print(f"No {label}thumbnail found in {file_path}")
                     return False
-
-                thumb_data = thumb_series.asarray()
-
-                thumb_path = os.path.join(
-                    thumb_dir, f"{os.path.basename(file_str)}.jpg"
-                )
-                thumb_img = Image.fromarray(thumb_data)
-                thumb_img.save(thumb_path, "JPEG")
-                print(f"Extracted thumbnail for {file_path}")
+                thumb_page = thumb_pages[0]
+
+                thumb_bytes = jpeg_stream(tif, thumb_page)
+                if thumb_bytes is not None:
+                    thumb_bytes = _transcode(thumb_bytes, encoding)
+                else:
+                    thumbnail = Image.fromarray(thumb_page.asarray())
+                    thumb_bytes = encode_thumbnail(thumbnail, encoding)
+                write_if_changed(thumb_path, thumb_bytes)
+                print(f"Extracted {label}thumbnail for {file_path}")
                 return True
         except Exception as e:
             print(f"Failed to extract thumbnail for {file_path}: {e}")
             return False
 
     @staticmethod
-    def remove_thumbnail(file_path):
+    def remove_thumbnail(file_path, probe=None):
         file_str = str(file_path)
-        # We don't check has_thumbnail here strictly to allow cleaning up potentially malformed ones
-        # providing we can read the main image.
+        # Every size is a SubIFD, so all go at once.
+        # Without a probe we don't check has_thumbnail here strictly to allow
+        # cleaning up potentially malformed ones providing we can read the main image.
+        if probe is not None and not probe.has_thumbnail:
+            print(f"No thumbnail to remove in {file_path}")
+            return False
 
+        tmp_path = file_str + ".tmp"
         try:
             with tifffile.TiffFile(file_path) as tif:
-                if not tif.pages[0].subifds:
+                page0 = tif.pages[0]
+                if not page0.subifds:
                     print(f"No thumbnail to remove in {file_path}")
                     return False
 
-                arr = tif.pages[0].asarray()
-                photometric = getattr(tif.pages[0], "photometric", 2)
-                compression = getattr(tif.pages[0], "compression", 1)
-
-            tmp_path = file_str + ".tmp"
-            # Write back only standard image, no subifds
-            tifffile.imwrite(
-                tmp_path, arr, photometric=photometric, compression=compression
-            )
+                # Keep our provenance JSON, but not tifffile's shape metadata
+                description = page0.description
+                if not _parse_provenance(description):
+                    description = None
+
+                # Write back only standard image, no subifds
+                with tifffile.TiffWriter(tmp_path, bigtiff=tif.is_bigtiff) as writer:
+                    write_page(
+                        writer,
+                        tif,
+                        page0,
+                        description=description,
+                        resolution=page_resolution(page0),
+                    )
             os.replace(tmp_path, file_str)
             print(f"Removed thumbnail from {file_path}")
             return True
@@ -353,115 +747,885 @@ EXIF_SUPPORTED_EXTENSIONS = (".jpg", ".jpeg", ".tif", ".tiff")
 ALL_SUPPORTED_EXTENSIONS = EXIF_SUPPORTED_EXTENSIONS + (".png",)
 
 
+def probe_thumbnail(file_path):
+    """
+    Check for an embedded thumbnail or sidecar by reading only file headers.
+    The returned ThumbnailProbe can be passed to add_thumbnail/remove_thumbnail
+    so they do not parse the file again.
+    """
+    ext = Path(file_path).suffix.lower()
+    processor = PROCESSORS.get(ext)
+    if not processor:
+        return NO_THUMBNAIL
+    return processor.probe(file_path)
+
+
 def has_thumbnail(file_path):
     """Check if image has embedded thumbnail or sidecar."""
+    return probe_thumbnail(file_path).has_thumbnail
+
+
+def build_thumbnail(file_path, keep_aspect=False, size=THUMBNAIL_SIZE):
+    """
+    Decode an image into a thumbnail image of size, without writing anything.
+    Thumbnails of images whose SHA-1 is cached are kept (losslessly) in the
+    thumbnail store, so such an image is only decoded the first time a
+    thumbnail of it is built.
+    """
     ext = Path(file_path).suffix.lower()
     processor = PROCESSORS.get(ext)
     if not processor:
-        return False
-    return processor.has_thumbnail(file_path)
+        raise ValueError(f"Unsupported image format for thumbnail operations: {ext}")
+    sha1 = _stored_sha1(file_path)
+    if sha1 is None:
+        return processor.build_thumbnail(file_path, keep_aspect=keep_aspect, size=size)
+
+    store = get_thumbnail_store()
+    width, height = size
+    params = f"{'fit' if keep_aspect else ''}{width}x{height}.png"
+    stored = store.lookup(sha1, params)
+    if stored is None:
+        thumbnail = processor.build_thumbnail(
+            file_path, keep_aspect=keep_aspect, size=size
+        )
+        store.add(sha1, params, functools.partial(_save_image, thumbnail, "PNG"))
+        return thumbnail
+    with Image.open(stored) as img:
+        img.load()
+        return img
 
 
-def add_thumbnail(file_path):
-    """Add a thumbnail to an image (embedded or sidecar)."""
+def _stored_sha1(file_path):
+    """
+    The SHA-1 keying file_path's thumbnails in the thumbnail store, or None
+    to do without the store. Only a cached SHA-1 is used: hashing the whole
+    image would cost more reading than the store saves.
+    """
+    if get_thumbnail_store() is None:
+        return None
+    return get_cache().peek(file_path, "sha1")
+
+
+def build_thumbnails(file_path, sizes=DEFAULT_SIZES, keep_aspect=False):
+    """
+    Thumbnails of an image for each of sizes (edge lengths), in that order,
+    from a single decode: the largest is built by build_thumbnail and the
+    others downsampled from it.
+    """
+    largest = max(sizes)
+    thumbnail = build_thumbnail(file_path, keep_aspect, size=(largest, largest))
+    return downsample_thumbnails(thumbnail, sizes, keep_aspect)
+
+
+def _save_image(img, fmt, path):
+    img.save(path, fmt)
+
+
+def extracted_thumbnail_path(file_path, thumb_dir="thumbnails", size=None, ext=".jpg"):
+    """
+    Where extraction puts the thumbnail of file_path: thumb_dir/<path>.jpg,
+    or thumb_dir/<path>-<size>.jpg for other sizes than the primary one (with
+    ext for other formats), with the directories below the tree root
+    mirrored so that images of the same name in different directories do
+    not collide.
+    """
+    rel = os.path.normpath(str(file_path))
+    if os.path.isabs(rel) or rel.startswith(".."):
+        rel = os.path.basename(rel)
+    suffix = "" if size is None else f"-{size}"
+    return os.path.join(thumb_dir, f"{rel}{suffix}{ext}")
+
+
+def find_thumbnail(file_path, thumb_dir="thumbnails"):
+    """
+    Return the path of an already extracted or stored thumbnail of file_path,
+    or None. Never hashes or decodes the image.
+    """
+    for _, ext in FORMATS.values():
+        thumb_path = extracted_thumbnail_path(file_path, thumb_dir, ext=ext)
+        if os.path.isfile(thumb_path):
+            return thumb_path
+    store = get_thumbnail_store()
+    if store is None:
+        return None
+    sha1 = get_cache().peek(file_path, "sha1")
+    if not sha1:
+        return None
+    for _, ext in FORMATS.values():
+        stored = store.lookup(sha1, f"embedded{ext}")
+        if stored:
+            return os.path.relpath(stored)
+    return None
+
+
+def write_if_changed(path, data):
+    """
+    Write data to path unless the file already holds exactly these bytes,
+    which is checked by size first. Returns True if the file was written.
+    """
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, "rb") as f:
+                if hashlib.sha1(f.read()).digest() == hashlib.sha1(data).digest():
+                    return False
+    except OSError:
+        pass
+    with timed("thumbnail-write") as stage, open(path, "wb") as f:
+        f.write(data)
+        stage.bytes_written = len(data)
+    return True
+
+
+def _publish(stored, thumb_path):
+    """
+    Put a stored thumbnail at thumb_path: a hard link where possible. An
+    existing file with the same contents is left alone.
+    """
+    os.makedirs(os.path.dirname(thumb_path) or ".", exist_ok=True)
+    try:
+        if os.path.samefile(stored, thumb_path):
+            return
+        if filecmp.cmp(stored, thumb_path, shallow=False):
+            return
+    except OSError:
+        pass
+    tmp_path = thumb_path + ".tmp"
+    try:
+        os.link(stored, tmp_path)
+    except OSError:
+        shutil.copyfile(stored, tmp_path)
+    os.replace(tmp_path, thumb_path)
+
+
+def add_thumbnail(file_path, **options):
+    """
+    Add a thumbnail to an image (embedded or sidecar).
+    options are passed to the processor, e.g. keep_aspect=True, the probe
+    returned by probe_thumbnail, sizes=(256, 64, 1024) for thumbnails of
+    several sizes, the thumbnails already built by build_thumbnails or how to
+    encode them (an encoders.ThumbnailEncoding).
+    """
+    ext = Path(file_path).suffix.lower()
+    processor = PROCESSORS.get(ext)
+    if not processor:
+        raise ValueError(f"Unsupported image format for thumbnail operations: {ext}")
+    return processor.add_thumbnail(file_path, **options)
+
+
+def missing_thumbnail_sizes(file_path, sizes=DEFAULT_SIZES):
+    """
+    Those of sizes, other than the primary (first) one, that an image with a
+    primary thumbnail has no thumbnail of.
+    """
     ext = Path(file_path).suffix.lower()
     processor = PROCESSORS.get(ext)
     if not processor:
         raise ValueError(f"Unsupported image format for thumbnail operations: {ext}")
-    return processor.add_thumbnail(file_path)
+    if len(sizes) < 2:
+        return []
+    present = processor.thumbnail_sizes(file_path)
+    return [size for size in sizes[1:] if size not in present]
 
 
-def extract_thumbnail(file_path, thumb_dir):
-    """Extract thumbnail to thumb_dir (from embedded or sidecar)."""
+def add_thumbnail_sizes(file_path, sizes, keep_aspect=False, encoding=DEFAULT_ENCODING):
+    """
+    Add thumbnails of sizes (see missing_thumbnail_sizes) to an image that
+    already has its primary thumbnail.
+    """
     ext = Path(file_path).suffix.lower()
     processor = PROCESSORS.get(ext)
     if not processor:
         raise ValueError(f"Unsupported image format for thumbnail operations: {ext}")
-    return processor.extract_thumbnail(file_path, thumb_dir)
+    if not processor.add_sizes(file_path, sizes, keep_aspect, encoding):
+        return False
+    labels = ", ".join(_size_label(size).strip() for size in sizes)
+    print(f"Added {labels} thumbnails to {file_path}")
+    return True
 
 
-def remove_thumbnail(file_path):
-    """Remove embedded thumbnail or sidecar."""
+def thumbnail_operation(operation, sizes=DEFAULT_SIZES, encoding=DEFAULT_ENCODING):
+    """
+    Run manifest operation of a thumbnail tool: operation (e.g. add-thumbnail)
+    for the default sizes and encoding, else with them appended, e.g.
+    add-thumbnail-256-64-webp-q60.
+    """
+    parts = [operation]
+    if tuple(sizes) != DEFAULT_SIZES:
+        parts.append("-".join(str(size) for size in sizes))
+    if encoding.format != DEFAULT_ENCODING.format:
+        parts.append(encoding.format)
+    if encoding.tiff != DEFAULT_ENCODING.tiff:
+        parts.append(f"tiff{encoding.tiff}")
+    return "-".join(parts) + settings_label(encoding)
+
+
+def extract_thumbnail(
+    file_path,
+    thumb_dir,
+    thumbnails=None,
+    sizes=DEFAULT_SIZES,
+    encoding=DEFAULT_ENCODING,
+):
+    """
+    Extract the thumbnails of each of sizes to thumb_dir (from embedded or
+    sidecar), see extracted_thumbnail_path; the first size is the primary
+    thumbnail. They are written in encoding's format: thumbnails already in
+    that format are copied as they are unless encoding sets a quality,
+    subsampling or progressive, others re-encoded. Extracted
+    thumbnails are kept in the thumbnail store, so each image's are only read
+    out once (see build_thumbnail). Thumbnails kept in sidecars are read
+    directly instead: a sidecar can be replaced without the image changing,
+    and is no dearer to read than the stored copy. Thumbnail images just
+    built for the file can be passed to store them instead of reading them
+    back.
+    """
     ext = Path(file_path).suffix.lower()
     processor = PROCESSORS.get(ext)
     if not processor:
         raise ValueError(f"Unsupported image format for thumbnail operations: {ext}")
-    return processor.remove_thumbnail(file_path)
 
+    try:
+        sha1 = _stored_sha1(file_path)
+    except OSError as e:
+        print(f"Failed to extract thumbnail for {file_path}: {e}")
+        return False
+    store = get_thumbnail_store() if sha1 is not None else None
+
+    for index, size in enumerate(sizes):
+        # The primary thumbnail is the one embedded in the image
+        size = None if index == 0 else size
+        ext = extension(encoding)
+        thumb_path = extracted_thumbnail_path(file_path, thumb_dir, size, ext)
+        if thumbnails is None:
+            produce = functools.partial(
+                processor.extract_thumbnail, file_path, size=size, encoding=encoding
+            )
+        else:
+            produce = functools.partial(
+                _save_extracted, thumbnails[index], file_path, size, encoding
+            )
+
+        if store is None or find_sidecar(file_path, size) is not None:
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            if not produce(thumb_path):
+                return False
+            continue
+        label = settings_label(encoding)
+        if size is not None:
+            label = f"-{size}{label}"
+        params = f"embedded{label}{ext}"
+        stored = store.lookup(sha1, params)
+        if stored is not None:
+            print(
+                f"Extracted {_size_label(size)}thumbnail for {file_path} (from store)"
+            )
+        else:
+            stored = store.add(sha1, params, produce)
+            if stored is None:
+                return False
+        _publish(stored, thumb_path)
+    return True
 
-def iterate_images(func, extensions, collect_results=False):
-    """Iterate over image files in subdirectories and apply func sequentially."""
-    files = []
-    for ext in extensions:
-        files.extend(Path(".").rglob(f"*{ext}"))
 
-    results = []
+def _save_extracted(thumbnail, file_path, size, encoding, thumb_path):
+    with open(thumb_path, "wb") as f:
+        f.write(encode_thumbnail(thumbnail, encoding))
+    print(f"Extracted {_size_label(size)}thumbnail for {file_path}")
+    return True
+
+
+def remove_thumbnail(file_path, probe=None):
+    """Remove embedded thumbnail or sidecar, and the sidecars of every size."""
+    ext = Path(file_path).suffix.lower()
+    processor = PROCESSORS.get(ext)
+    if not processor:
+        raise ValueError(f"Unsupported image format for thumbnail operations: {ext}")
+    return processor.remove_thumbnail(file_path, probe=probe)
+
+
+def default_jobs():
+    """Number of worker processes used when --jobs is not given."""
+    return os.cpu_count() or 1
+
+
+def parse_sizes(text):
+    """Parse thumbnail sizes such as "256,64,1024" into (256, 64, 1024)."""
+    sizes = tuple(int(size) for size in text.split(","))
+    if any(size <= 0 for size in sizes) or len(set(sizes)) != len(sizes):
+        raise ValueError(f"Invalid thumbnail sizes: {text!r}")
+    return sizes
+
+
+def add_sizes_argument(parser):
+    """Add the --sizes option of the tools that handle thumbnails."""
+    parser.add_argument(
+        "--sizes",
+        type=parse_sizes,
+        default=DEFAULT_SIZES,
+        help="Comma-separated thumbnail sizes in pixels, e.g. 256,64,1024. The "
+        "first is the primary thumbnail (the EXIF thumbnail of a JPEG, the "
+        ".thumb.jpg sidecar of a PNG, or of a JPEG whose primary thumbnail is "
+        "over the 64 KB EXIF limit, which then embeds the largest size that "
+        "fits); the others are stored as .thumb-SIZE.jpg sidecars, and all as "
+        "SubIFDs of a TIFF (default: 256)",
+    )
+    return parser
+
+
+def parse_size(text):
+    """Parse a size such as "512M", "4G" or "1.5GiB" into bytes."""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?)(i?b)?\s*", text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {text!r}")
+    scale = 1024 ** " kmgt".index(match.group(2).lower() or " ")
+    return int(float(match.group(1)) * scale)
+
+
+def add_common_arguments(parser):
+    """Add the options shared by every iw-* entry point to an argparse parser."""
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=default_jobs(),
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        help="Only start a file while the estimated decoded size of the files "
+        "being processed stays within this budget (e.g. 8G); largest first",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="Print per-stage timings (p50/p95/p99) at the end of the run, and "
+        "the PSNR of thumbnail encodes, which is only computed with this option",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write per-file stage timings to this file (implies --metrics)",
+    )
+    parser.add_argument(
+        "--metrics-format",
+        choices=["jsonl", "prometheus"],
+        help="Format of --metrics-file (default: prometheus for *.prom, "
+        "else JSON lines)",
+    )
+    return parser
+
+
+def add_manifest_arguments(parser):
+    """Add the options of tools that record their work in the run manifest."""
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Process every file, even those the manifest says are up to date",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Only report which files a run would process",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run, skipping the files it completed",
+    )
+    parser.add_argument(
+        "--watch",
+        nargs="?",
+        type=float,
+        const=DEFAULT_SETTLE,
+        metavar="SETTLE",
+        help="Keep running and process new files as they arrive, once their size "
+        f"and mtime have been stable for SETTLE seconds (default {DEFAULT_SETTLE})",
+    )
+    return parser
+
+
+def _apply(func, file):
+    """Run func on one file, isolating its failure from the rest of the batch."""
+    try:
+        return True, func(file)
+    except Exception as e:
+        print(f"Failed to process {file}: {e}")
+        return False, None
+
+
+def _result_of(future, file):
+    try:
+        ok, res = future.result()
+    except Exception as e:
+        # The worker itself died (e.g. killed by the OOM killer)
+        print(f"Failed to process {file}: {e}")
+        return file, False, None
+    return file, ok, res
+
+
+class WorkerPool:
+    """
+    Process pool running func(file) for one file at a time, each file's
+    failure isolated from the others. The pool replaces itself when a worker
+    dies (e.g. killed by the OOM killer): the files then in flight fail, the
+    rest go on. Files may be submitted from several threads.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.executor = futures.ProcessPoolExecutor(max_workers=jobs)
+
+    def start(self):
+        """Start every worker now, rather than as the first files arrive."""
+        for future in [self.executor.submit(os.getpid) for _ in range(self.jobs)]:
+            future.result()
+
+    def submit(self, func, file):
+        """Queue func(file); pass the returned future to outcome()."""
+        executor = self.executor
+        try:
+            return executor.submit(_apply, func, file)
+        except futures.BrokenExecutor:
+            # Replaced once, however many threads find it broken
+            with self.lock:
+                if self.executor is executor:
+                    executor.shutdown(wait=False)
+                    self.executor = futures.ProcessPoolExecutor(max_workers=self.jobs)
+            return self.executor.submit(_apply, func, file)
+
+    @staticmethod
+    def outcome(future, file):
+        """Wait for a submitted file and return (file, ok, result)."""
+        return _result_of(future, file)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _ignore(file):
+    pass
+
+
+def _run_sequential(func, files, dispatched):
     for file in files:
-        res = func(file)
+        dispatched(file)
+        ok, res = _apply(func, file)
+        yield file, ok, res
+
+
+def _run_parallel(func, files, jobs, ordered, dispatched):
+    """
+    Dispatch func over files on a process pool, yielding (file, ok, result).
+    Only a bounded window of files is in flight at once, so the file list can
+    be consumed lazily. With ordered=True results come back in input order,
+    otherwise as soon as each file completes. dispatched(file) is called as
+    each file is handed to the pool.
+    """
+    window = jobs * 4
+    in_flight = {}
+    order = deque()
+
+    def drain():
+        if ordered:
+            future = order.popleft()
+            yield _result_of(future, in_flight.pop(future))
+        else:
+            done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                yield _result_of(future, in_flight.pop(future))
+
+    # Imported once here rather than in every forked worker
+    preload()
+    with WorkerPool(jobs) as pool:
+        for file in files:
+            dispatched(file)
+            future = pool.submit(func, file)
+            in_flight[future] = file
+            order.append(future)
+            while len(in_flight) >= window:
+                yield from drain()
+        while in_flight:
+            yield from drain()
+
+
+def estimate_memory(file_path):
+    """
+    Estimate the memory needed to process a file: its decoded raster size
+    from the header, or its file size if the header cannot be read.
+    """
+    size = headers.decoded_size(file_path)
+    if size is None:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0
+    return size
+
+
+def _run_budgeted(func, files, jobs, ordered, max_memory, dispatched):
+    """
+    Like _run_parallel, but start a file only while the estimated memory of
+    the files in progress stays within max_memory. Files are started largest
+    first, so the big ones do not end up alone at the tail of the run, and
+    small files fill whatever budget the large ones leave. A file larger than
+    the whole budget runs on its own. All files are estimated up front, so
+    the file list is consumed before any work starts.
+    """
+    pending = sorted(
+        (estimate_memory(file), index, file) for index, file in enumerate(files)
+    )
+    costs = [cost for cost, _, _ in pending]
+    in_flight = {}
+    used = 0
+    outcomes = []
+
+    # Imported once here rather than in every forked worker
+    preload()
+    with WorkerPool(jobs) as pool:
+        while pending or in_flight:
+            while pending and len(in_flight) < jobs:
+                # The largest file that fits in the remaining budget
+                i = bisect_right(costs, max_memory - used) - 1
+                if i < 0:
+                    if in_flight:
+                        break
+                    i = len(pending) - 1
+                cost, index, file = pending.pop(i)
+                del costs[i]
+                dispatched(file)
+                future = pool.submit(func, file)
+                in_flight[future] = (cost, index, file)
+                used += cost
+
+            done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                cost, index, file = in_flight.pop(future)
+                used -= cost
+                outcome = _result_of(future, file)
+                if ordered:
+                    outcomes.append((index, outcome))
+                else:
+                    yield outcome
+
+    for _, outcome in sorted(outcomes, key=lambda item: item[0]):
+        yield outcome
+
+
+def is_temporary_file(path, names=None):
+    """
+    Whether path is an intermediate file written by one of the tools. A
+    <stem>-compressed.tiff only is while its source <stem>.tif(f) is next to
+    it; names, the lowercased names in its directory, saves listing that.
+    """
+    name = os.path.basename(str(path)).lower()
+    if name.endswith(TEMPORARY_SUFFIXES):
+        return True
+    if not name.endswith(COMPRESSED_SUFFIX):
+        return False
+    if names is None:
+        try:
+            names = {
+                other.lower() for other in os.listdir(os.path.dirname(path) or ".")
+            }
+        except OSError:
+            return False
+    stem = name[: -len(COMPRESSED_SUFFIX)]
+    return f"{stem}.tif" in names or f"{stem}.tiff" in names
+
+
+def recover_interrupted(file_path):
+    """
+    Clean up after an operation on file_path that was killed midway: roll back
+    an interrupted in-place TIFF append and delete temporary rewrites, which
+    are only renamed over the original once complete.
+    """
+    file_path = Path(file_path)
+    if recover_append(file_path):
+        print(f"Rolled back interrupted thumbnail append to {file_path}")
+    for temp in (
+        file_path.with_name(f"{file_path.stem}{COMPRESSED_SUFFIX}"),
+        Path(f"{file_path}.tmp"),
+    ):
+        if temp.exists():
+            temp.unlink()
+            print(f"Removed incomplete {temp}")
+
+
+def walk_images(root, extensions, prune=GENERATED_DIRS):
+    """
+    Lazily yield image files under root in a single pass.
+    Extensions are matched case-insensitively, directories named in prune are
+    skipped without being descended into, and thumbnail sidecars and the
+    tools' temporary files are ignored.
+    """
+    extensions = tuple(ext.lower() for ext in extensions)
+    prune = set(prune)
+    stack = [str(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Skipping {directory}: {e}")
+            continue
+
+        subdirs = []
+        names = {entry.name.lower() for entry in entries}
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in prune:
+                    subdirs.append(entry.path)
+                continue
+            name = entry.name.lower()
+            if not name.endswith(extensions) or is_sidecar(name):
+                continue
+            if is_temporary_file(name, names):
+                continue
+            yield Path(entry.path)
+        # Reversed so the stack pops subdirectories in sorted order
+        stack.extend(reversed(subdirs))
+
+
+def iterate_images(
+    func,
+    extensions,
+    collect_results=False,
+    jobs=1,
+    ordered=True,
+    prune=GENERATED_DIRS,
+    operation=None,
+    force=False,
+    status=False,
+    resume=False,
+    metrics=None,
+    max_memory=None,
+    files=None,
+    watch=None,
+):
+    """
+    Iterate over image files in subdirectories (or the given files) and
+    apply func to each.
+    With jobs > 1 the files are processed on a pool of worker processes, so
+    func must be picklable (a module-level function or functools.partial).
+    A failure in one file is reported and counted without stopping the run.
+
+    With an operation name, files the run manifest records as already
+    processed by it (and unchanged since) are skipped unless force is set,
+    and each file func does not return False for is recorded; a returned
+    path is recorded as the file's output. status only reports what would
+    be processed.
+
+    Runs with an operation name are also journalled (see jobs.py): files left
+    in progress by a killed run are recovered at startup, and resume skips
+    the files that run completed.
+
+    metrics, a metrics.RunMetrics, collects each file's stage timings and is
+    reported and exported at the end of the run. max_memory (bytes) limits
+    the parallel run to files whose estimated decoded size fits in it.
+
+    With watch (a settle time in seconds) the run does not end: after going
+    through the tree it waits for new files and processes each batch of them
+    once they have been stable for that long (see watch.py).
+    """
+    if watch is not None and not status:
+        # Imported here because it imports this module
+        from .watch import watch_images
+
+        def run(files=None):
+            iterate_images(
+                func,
+                extensions,
+                jobs=jobs,
+                ordered=ordered,
+                prune=prune,
+                operation=operation,
+                force=force,
+                # Only the catch-up run continues an interrupted one
+                resume=resume and files is None,
+                metrics=metrics,
+                max_memory=max_memory,
+                files=files,
+            )
+
+        watch_images(run, ".", extensions, prune, settle=watch)
+        return [] if collect_results else None
+
+    if files is None:
+        files = walk_images(".", extensions, prune)
+
+    manifest = get_manifest() if operation else None
+    if status:
+        if manifest is None:
+            print("Run manifest is disabled; every file would be processed")
+        else:
+            manifest.status(files, operation)
+        return [] if collect_results else None
+    journal = None
+    if operation:
+        journal = JobJournal(operation)
+        if not journal.open(resume=resume):
+            print(f"Another {operation} run is in progress in this directory")
+            return [] if collect_results else None
+        if journal.interrupted:
+            print(
+                f"Previous {operation} run was interrupted: "
+                f"{len(journal.done)} files done, "
+                f"{len(journal.in_progress)} in progress"
+            )
+        for file in sorted(journal.in_progress):
+            recover_interrupted(file)
+        if resume:
+            files = (file for file in files if not journal.is_done(file))
+
+    skipped = []
+    if manifest is not None and not force:
+        files = manifest.pending(files, operation, skipped)
+    dispatched = journal.queued if journal is not None else _ignore
+
+    if metrics is not None:
+        func = functools.partial(measured, func, psnr=metrics.detailed)
+
+    started = time.monotonic()
+    if jobs is None:
+        jobs = default_jobs()
+    if jobs > 1 and max_memory:
+        outcomes = _run_budgeted(func, files, jobs, ordered, max_memory, dispatched)
+    elif jobs > 1:
+        outcomes = _run_parallel(func, files, jobs, ordered, dispatched)
+    else:
+        outcomes = _run_sequential(func, files, dispatched)
+
+    processed = 0
+    failed = []
+    results = []
+    for file, ok, res in outcomes:
+        processed += 1
+        if isinstance(res, Measured):
+            metrics.add(file, res.samples)
+            res = res.result
+        if journal is not None:
+            journal.finish(file, ok and res is not False)
+        if not ok:
+            failed.append(file)
+            continue
+        if manifest is not None and res is not False:
+            output = res if isinstance(res, (str, Path)) else None
+            manifest.record(file, operation, output)
         if collect_results and res is not None:
             results.append(res)
 
+    if journal is not None:
+        journal.close(processed, len(failed))
+
+    elapsed = time.monotonic() - started
+    print(f"Processed {processed} files in {elapsed:.1f}s, {len(failed)} failed")
+    if skipped:
+        print(f"Skipped {len(skipped)} up-to-date files (use --force to redo them)")
+    for file in failed:
+        print(f"  failed: {file}")
+    if metrics is not None:
+        metrics.report()
+        metrics.export()
+
     if collect_results:
         return results
 
 
 def get_sha1(path):
     h = hashlib.sha1()
-    with open(path, "rb") as f:
+    with timed("sha1") as stage, open(path, "rb") as f:
         while chunk := f.read(8192):
             h.update(chunk)
+            stage.bytes_read += len(chunk)
     return h.hexdigest()
 
 
+def get_provenance(file_path):
+    """
+    Return the provenance metadata for an image: the JSON already embedded in
+    it by an earlier operation if any, otherwise a new record of the file's
+    creation time, SHA-1 and location. Lookups go through the metadata cache.
+    """
+    path_obj = Path(file_path)
+    stat = path_obj.stat()
+    cache = get_cache()
+
+    existing_meta = cache.get(path_obj, "metadata", get_existing_metadata, stat)
+    if existing_meta:
+        return existing_meta
+
+    return {
+        "created_at": getattr(stat, "st_birthtime", stat.st_mtime),
+        "sha1": cache.get(path_obj, "sha1", get_sha1, stat),
+        "source_file": str(path_obj.resolve()),
+    }
+
+
+def _parse_provenance(text):
+    """Return the provenance dict encoded in text, or None if it is not one."""
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    if isinstance(data, dict) and "sha1" in data and "source_file" in data:
+        return data
+    return None
+
+
 def get_existing_metadata(file_path):
     """
     Attempt to read existing JSON metadata from image comments/description.
     Returns dict or None.
     """
+    # 1. Read the comment fields straight from the file headers
+    with timed("read-metadata"):
+        comments = headers.read_comments(file_path)
+    if comments is not None:
+        for comment in comments:
+            data = _parse_provenance(comment.strip())
+            if data:
+                return data
+        return None
+
+    # 2. Unrecognised container: fall back to GraphicsMagick
+    with timed("gm-identify"):
+        return _identify_metadata(file_path)
+
+
+def _identify_metadata(file_path):
     try:
-        # 1. Try gm identify -format "%c"
         res = subprocess.run(
             ["gm", "identify", "-format", "%c", str(file_path)],
             capture_output=True,
             text=True,
         )
         if res.returncode == 0:
-            output = res.stdout.strip()
-            if output:
-                try:
-                    data = json.loads(output)
-                    if (
-                        isinstance(data, dict)
-                        and "sha1" in data
-                        and "source_file" in data
-                    ):
-                        return data
-                except json.JSONDecodeError:
-                    pass
-
-        # 2. Fallback to verbose output parsing (sometimes %c is empty for PNG)
+            data = _parse_provenance(res.stdout.strip())
+            if data:
+                return data
+
+        # Fallback to verbose output parsing (sometimes %c is empty for PNG)
         res = subprocess.run(
             ["gm", "identify", "-verbose", str(file_path)],
             capture_output=True,
             text=True,
         )
         if res.returncode == 0:
-            import re
-
             # Look for "Comment: {json}"
             # It might be at the start of the line with indent
             match = re.search(r"^\s*Comment:\s*(\{.*\})", res.stdout, re.MULTILINE)
             if match:
-                try:
-                    data = json.loads(match.group(1))
-                    if (
-                        isinstance(data, dict)
-                        and "sha1" in data
-                        and "source_file" in data
-                    ):
-                        return data
-                except json.JSONDecodeError:
-                    pass
+                data = _parse_provenance(match.group(1))
+                if data:
+                    return data
 
     except Exception:
         pass
@@ -1,94 +1,305 @@
-import tifffile
+import argparse
+import functools
 import json
 import os
+import time
+from collections import namedtuple
 from pathlib import Path
-from .common import iterate_images, get_sha1, get_existing_metadata
+from .common import (
+    COMPRESSED_SUFFIX,
+    add_common_arguments,
+    add_manifest_arguments,
+    iterate_images,
+    get_provenance,
+)
+from .lazy import lazy_import
+from .headers import tiff_encoding
+from .metrics import RunMetrics
+from .tiffio import (
+    DEFAULT_BUFFER_SIZE,
+    needs_bigtiff,
+    page_resolution,
+    read_thumbnail,
+    write_page,
+    write_thumbnail,
+)
 
+tifffile = lazy_import("tifffile")
 
-def compress_tiff(file_path):
+# --codec choices -> tifffile COMPRESSION names (all encoded by imagecodecs)
+CODECS = {
+    "lzw": "LZW",
+    "deflate": "ADOBE_DEFLATE",
+    "zstd": "ZSTD",
+    "jpegxl": "JPEGXL",
+}
+
+# --predictor choices -> tifffile PREDICTOR names; "auto" picks by sample type
+PREDICTORS = {
+    "none": None,
+    "horizontal": "HORIZONTAL",
+    "float": "FLOATINGPOINT",
+    "auto": None,
+}
+
+# How compress_tiff encodes the main image. level is the codec's compression
+# level (None: its default), tile the tile edge in pixels (None: strips) and
+# threads the number of threads encoding tiles or strips (None: all cores).
+CompressionSettings = namedtuple(
+    "CompressionSettings",
+    "codec predictor level tile threads",
+    defaults=("lzw", "none", None, None, None),
+)
+
+LZW = CompressionSettings()
+
+
+def operation_name(settings):
+    """
+    Run manifest operation of a compression, e.g. compress-zstd-horizontal-l9
+    or compress-deflate-t256 for 256-pixel tiles.
+    """
+    parts = ["compress", settings.codec]
+    if settings.predictor != "none":
+        parts.append(settings.predictor)
+    if settings.level is not None:
+        parts.append(f"l{settings.level}")
+    if settings.tile:
+        parts.append(f"t{settings.tile}")
+    return "-".join(parts)
+
+
+def _predictor(settings, is_float):
+    """tifffile PREDICTOR name settings use for an image, or None."""
+    predictor = settings.predictor
+    if predictor == "auto" and settings.codec != "jpegxl":
+        predictor = "float" if is_float else "horizontal"
+    return PREDICTORS[predictor]
+
+
+def _write_options(settings, page):
+    """Return the compression and write_page keyword arguments for page."""
+    compression = tifffile.COMPRESSION[CODECS[settings.codec]]
+    options = {}
+    predictor = _predictor(settings, page.dtype.kind == "f")
+    if predictor:
+        options["predictor"] = tifffile.PREDICTOR[predictor]
+    if settings.level is not None:
+        options["compressionargs"] = {"level": settings.level}
+    if settings.tile:
+        options["tile"] = settings.tile
+    if settings.threads is not None:
+        options["maxworkers"] = settings.threads
+    return compression, options
+
+
+def is_compressed(file_path, settings=LZW):
+    """
+    Whether the first page of a TIFF is already encoded with the codec,
+    predictor and (if settings ask for one) tile size of settings, going by
+    its header. The compression level is not recorded in the file.
+    """
+    encoding = tiff_encoding(file_path)
+    if encoding is None:
+        return False
+    predictor = _predictor(settings, encoding.sample_format == 3)
+    return (
+        encoding.compression == tifffile.COMPRESSION[CODECS[settings.codec]]
+        and encoding.predictor == (tifffile.PREDICTOR[predictor] if predictor else 1)
+        and (not settings.tile or encoding.tile == settings.tile)
+    )
+
+
+def compress_tiff(
+    file_path,
+    buffer_size=None,
+    thumbnails=None,
+    provenance=None,
+    settings=LZW,
+    recompress=False,
+):
+    """
+    Rewrite a TIFF compressed as settings (a CompressionSettings) say, LZW by
+    default, keeping its SubIFD thumbnails, or writing thumbnails (a list of
+    arrays or tiffio.JpegThumbnails, the primary one first) as the new ones.
+    provenance may be passed in by a caller that has already looked it up.
+    Prints the size change and speed of each file.
+
+    Unless thumbnails are given, files already encoded that way are skipped
+    (unless recompress is set), and the original is kept when the rewritten
+    file would not be smaller and is not retiled as settings ask.
+    """
     file_path = Path(file_path)
-    output_file = file_path.with_name(f"{file_path.stem}-compressed.tiff")
+    output_file = file_path.with_name(f"{file_path.stem}{COMPRESSED_SUFFIX}")
+
+    if thumbnails is None and not recompress and is_compressed(file_path, settings):
+        print(f"Skipped {file_path}: already compressed with {settings.codec}")
+        return True
 
     # Gather metadata
     stat = file_path.stat()
+    if provenance is None:
+        provenance = get_provenance(file_path)
+    json_str = json.dumps(provenance)
 
-    existing_meta = get_existing_metadata(file_path)
-    if existing_meta:
-        json_str = json.dumps(existing_meta)
-    else:
-        created_at = getattr(stat, "st_birthtime", stat.st_mtime)
-        sha1 = get_sha1(file_path)
-        source_file = str(file_path.resolve())
-
-        metadata = {"created_at": created_at, "sha1": sha1, "source_file": source_file}
-        json_str = json.dumps(metadata)
-
+    started = time.perf_counter()
     try:
         with tifffile.TiffFile(file_path) as tif:
-            arr = tif.asarray()
             page = tif.pages[0]
-            photometric = getattr(page, "photometric", 2)
-
-            # Preserve resolution if available
-            resolution = None
-            if "XResolution" in page.tags and "YResolution" in page.tags:
-                xres = page.tags["XResolution"].value
-                yres = page.tags["YResolution"].value
-                # resolution unit?
-                unit = (
-                    page.tags["ResolutionUnit"].value
-                    if "ResolutionUnit" in page.tags
-                    else 2
-                )
-                resolution = (xres, yres, unit)
-
-            # Check for thumbnail
-            thumb_arr = None
-            thumb_photometric = None
-
-            if page.subifds:
-                thumb_offsets = set(page.subifds)
-                for series in tif.series:
-                    if series.pages and series.pages[0].offset in thumb_offsets:
-                        thumb_arr = series.asarray()
-                        thumb_photometric = series.pages[0].photometric
-                        break
-
-        # Write new file
-        with tifffile.TiffWriter(output_file) as writer:
-            has_thumb = thumb_arr is not None
-
-            writer.write(
-                arr,
-                photometric=photometric,
-                compression="LZW",
-                subifds=1 if has_thumb else 0,
-                resolution=resolution,
-                description=json_str,
+            # A tile layout that was asked for is kept even if not smaller
+            retiled = bool(settings.tile) and not (
+                page.tilewidth == page.tilelength == settings.tile
             )
 
-            if has_thumb:
-                writer.write(
-                    thumb_arr,
-                    photometric=thumb_photometric,
-                    subfiletype=1,
-                    compression="LZW",
+            # Check for thumbnails
+            thumbs = thumbnails
+            if thumbs is None:
+                thumbs = [read_thumbnail(tif, thumb) for thumb in page.pages or ()]
+
+            # Write new file, streaming the main image through the encoder.
+            # Output can exceed the raw size on noisy data, hence nbytes.
+            compression, options = _write_options(settings, page)
+            bigtiff = needs_bigtiff(max(stat.st_size, page.nbytes))
+            with tifffile.TiffWriter(output_file, bigtiff=bigtiff) as writer:
+                write_page(
+                    writer,
+                    tif,
+                    page,
+                    compression=compression,
+                    buffer_size=buffer_size,
+                    subifds=len(thumbs),
+                    resolution=page_resolution(page),
+                    description=json_str,
+                    **options,
                 )
 
+                # Thumbnails stay LZW, which every TIFF reader can decode,
+                # or JPEG, which is copied as is
+                for thumb in thumbs:
+                    write_thumbnail(writer, thumb, compression="LZW")
+
         # Preserve timestamps
         os.utime(output_file, (stat.st_atime, stat.st_mtime))
 
+        output_size = output_file.stat().st_size
+        if thumbnails is None and not retiled and output_size >= stat.st_size:
+            output_file.unlink()
+            print(
+                f"Kept {file_path}: {settings.codec} output of "
+                f"{output_size / 1e6:.1f} MB is not smaller than "
+                f"{stat.st_size / 1e6:.1f} MB"
+            )
+            return True
         output_file.replace(file_path)
-        print(f"Compressed {file_path}")
+        seconds = time.perf_counter() - started
+        print(
+            f"Compressed {file_path} with {settings.codec}: "
+            f"{stat.st_size / 1e6:.1f} MB -> {output_size / 1e6:.1f} MB "
+            f"({stat.st_size / max(output_size, 1):.2f}x) in {seconds:.2f}s, "
+            f"{stat.st_size / 1e6 / max(seconds, 1e-6):.1f} MB/s"
+        )
+        return True
     except Exception as e:
         print(f"Failed to compress {file_path}: {e}")
         if output_file.exists():
             output_file.unlink()
+        return False
+
+
+def add_compression_arguments(parser):
+    """Add the options choosing the CompressionSettings of compressed TIFFs."""
+    parser.add_argument(
+        "--codec",
+        choices=list(CODECS),
+        default="lzw",
+        help="Compression codec (default: lzw; jpegxl is lossless)",
+    )
+    parser.add_argument(
+        "--predictor",
+        choices=list(PREDICTORS),
+        default="none",
+        help="Predictor applied before compression; auto picks float for "
+        "floating-point images and horizontal otherwise (default: none)",
+    )
+    parser.add_argument(
+        "--level", type=int, help="Compression level of deflate, zstd or jpegxl"
+    )
+    parser.add_argument(
+        "--tile",
+        type=int,
+        help="Write the image in tiles of this many pixels square (a multiple "
+        "of 16) instead of strips",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Threads encoding each image's tiles or strips "
+        "(default: all cores with -j 1, else 1)",
+    )
+    return parser
+
+
+def settings_from_args(parser, args):
+    """
+    CompressionSettings of add_compression_arguments' options (and --jobs);
+    exits if invalid.
+    """
+    if args.level is not None and args.codec == "lzw":
+        parser.error("lzw has no compression level")
+    if args.predictor not in ("none", "auto") and args.codec == "jpegxl":
+        parser.error("jpegxl does not use a predictor")
+    if args.tile is not None and (args.tile <= 0 or args.tile % 16):
+        parser.error("--tile must be a positive multiple of 16")
+
+    threads = args.threads
+    if threads is None and args.jobs > 1:
+        # The worker processes already keep the cores busy
+        threads = 1
+    return CompressionSettings(
+        args.codec, args.predictor, args.level, args.tile, threads
+    )
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compress TIFF images")
+    add_compression_arguments(parser)
+    parser.add_argument(
+        "--recompress",
+        action="store_true",
+        help="Rewrite files already compressed with the codec, predictor and "
+        "tile size, e.g. to change --level",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=int,
+        default=DEFAULT_BUFFER_SIZE // (1024 * 1024),
+        help="Raster memory per file in MiB; larger images are streamed in tiles",
+    )
+    add_common_arguments(parser)
+    add_manifest_arguments(parser)
+    args = parser.parse_args(argv)
+    settings = settings_from_args(parser, args)
+    operation = operation_name(settings)
 
-def main():
     extensions = [".tif", ".tiff"]
-    iterate_images(compress_tiff, extensions)
+    func = functools.partial(
+        compress_tiff,
+        buffer_size=args.buffer_size * 1024 * 1024,
+        settings=settings,
+        recompress=args.recompress,
+    )
+    iterate_images(
+        func,
+        extensions,
+        jobs=args.jobs,
+        max_memory=args.max_memory,
+        operation=operation,
+        force=args.force,
+        status=args.status,
+        resume=args.resume,
+        watch=args.watch,
+        metrics=RunMetrics.from_args(args, operation),
+    )
 
 
 if __name__ == "__main__":
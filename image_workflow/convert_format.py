@@ -1,29 +1,94 @@
 import argparse
+import functools
 import subprocess
 import json
 import os
 from pathlib import Path
-from .common import iterate_images, get_sha1, get_existing_metadata
-
-
-def convert_to_format(file_path, target_format):
+from .common import (
+    add_common_arguments,
+    add_manifest_arguments,
+    iterate_images,
+    get_provenance,
+)
+from .gm_batch import run_gm
+from .lazy import lazy_import
+from .metrics import RunMetrics, timed
+
+Image = lazy_import("PIL.Image")
+PngImagePlugin = lazy_import("PIL.PngImagePlugin")
+
+# Target formats written in-process, by Pillow format name
+PILLOW_FORMATS = {
+    "jpg": "JPEG",
+    "jpeg": "JPEG",
+    "png": "PNG",
+    "webp": "WEBP",
+    "tif": "TIFF",
+    "tiff": "TIFF",
+}
+
+IMAGE_DESCRIPTION = 270
+
+
+def _pillow_can_convert(img, pillow_format):
+    """
+    Whether Pillow converts this image as faithfully as gm would. Multi-page
+    files and TIFFs deeper than 8 bits per sample (other than 16-bit
+    greyscale) are left to gm.
+    """
+    if getattr(img, "n_frames", 1) > 1:
+        return False
+    if img.format == "TIFF" and img.mode != "I;16":
+        bits = img.tag_v2.get(258, (8,))
+        if any(b > 8 for b in (bits if isinstance(bits, tuple) else (bits,))):
+            return False
+    if pillow_format == "JPEG":
+        return img.mode in ("1", "L", "P", "RGB", "RGBA", "LA", "CMYK")
+    return True
+
+
+def _convert_with_pillow(img, new_file, pillow_format, json_str):
+    """
+    Save img as pillow_format with the provenance in the target's native
+    comment field: JPEG COM, PNG iTXt "comment", WebP EXIF ImageDescription or
+    TIFF ImageDescription. The source's EXIF and ICC profile are carried over.
+    """
+    options = {}
+    if img.info.get("icc_profile"):
+        options["icc_profile"] = img.info["icc_profile"]
+
+    exif = img.getexif()
+    if pillow_format == "WEBP" or IMAGE_DESCRIPTION in exif:
+        exif[IMAGE_DESCRIPTION] = json_str
+
+    if pillow_format == "JPEG":
+        if img.mode not in ("L", "RGB", "CMYK"):
+            img = img.convert("RGB")
+        options["comment"] = json_str
+    elif pillow_format == "PNG":
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_itxt("comment", json_str)
+        options["pnginfo"] = pnginfo
+    elif pillow_format == "WEBP":
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    elif pillow_format == "TIFF":
+        exif[IMAGE_DESCRIPTION] = json_str
+    if len(exif):
+        options["exif"] = exif
+
+    img.save(new_file, pillow_format, **options)
+
+
+def convert_to_format(file_path, target_format, engine="auto", gm_backend="batch"):
+    """Convert an image into converted/, returning the new path or False."""
     file_path = Path(file_path)
     if "converted" in file_path.parts:
         return
 
     # Gather metadata
     stat = file_path.stat()
-
-    existing_meta = get_existing_metadata(file_path)
-    if existing_meta:
-        json_str = json.dumps(existing_meta)
-    else:
-        created_at = getattr(stat, "st_birthtime", stat.st_mtime)
-        sha1 = get_sha1(file_path)
-        source_file = str(file_path.resolve())
-
-        metadata = {"created_at": created_at, "sha1": sha1, "source_file": source_file}
-        json_str = json.dumps(metadata)
+    json_str = json.dumps(get_provenance(file_path))
 
     base = file_path.stem
     dir_path = file_path.parent
@@ -31,32 +96,97 @@ def convert_to_format(file_path, target_format):
     converted_dir.mkdir(parents=True, exist_ok=True)
     new_file = converted_dir / f"{base}.{target_format}"
 
+    pillow_format = PILLOW_FORMATS.get(target_format.lower())
+    if engine == "pillow" and not pillow_format:
+        print(f"Failed to convert {file_path}: Pillow cannot write {target_format}")
+        return False
+
+    if engine != "gm" and pillow_format:
+        try:
+            with Image.open(file_path) as img:
+                converted = engine == "pillow" or _pillow_can_convert(
+                    img, pillow_format
+                )
+                if converted:
+                    with timed("pillow-convert") as stage:
+                        _convert_with_pillow(img, new_file, pillow_format, json_str)
+                        stage.bytes_read = stat.st_size
+                        stage.bytes_written = new_file.stat().st_size
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            if engine == "pillow":
+                print(f"Failed to convert {file_path}: {e}")
+                return False
+            print(f"Pillow could not convert {file_path} ({e}), using gm")
+            converted = False
+        if converted:
+            os.utime(new_file, (stat.st_atime, stat.st_mtime))
+            print(f"Converted {file_path} to {new_file}")
+            return new_file
+
     try:
         # Add comment with JSON metadata
-        subprocess.run(
-            ["gm", "convert", str(file_path), "-comment", json_str, str(new_file)],
-            check=True,
-        )
+        with timed("gm-convert") as stage:
+            run_gm(
+                ["convert", str(file_path), "-comment", json_str, str(new_file)],
+                backend=gm_backend,
+            )
+            stage.bytes_read = stat.st_size
+            stage.bytes_written = new_file.stat().st_size
 
         # Preserve timestamps (atime, mtime)
         os.utime(new_file, (stat.st_atime, stat.st_mtime))
 
         print(f"Converted {file_path} to {new_file}")
+        return new_file
     except subprocess.CalledProcessError as e:
         print(f"Failed to convert {file_path}: {e}")
+        return False
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Convert images to target format")
     parser.add_argument("target_format", help="Target format (e.g., png)")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--engine",
+        choices=["auto", "pillow", "gm"],
+        default="auto",
+        help="Convert in-process with Pillow, with GraphicsMagick, or (auto) "
+        "with Pillow where it can write the target format and gm otherwise",
+    )
+    parser.add_argument(
+        "--gm-backend",
+        choices=["batch", "exec"],
+        default="batch",
+        help="Feed a long-lived `gm batch` process per worker (default), "
+        "or run one `gm convert` per file",
+    )
+    add_common_arguments(parser)
+    add_manifest_arguments(parser)
+    args = parser.parse_args(argv)
 
     extensions = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp"]
 
-    def func(file_path):
-        convert_to_format(file_path, args.target_format)
-
-    iterate_images(func, extensions)
+    # A partial (unlike a closure) can be pickled to the worker processes
+    func = functools.partial(
+        convert_to_format,
+        target_format=args.target_format,
+        engine=args.engine,
+        gm_backend=args.gm_backend,
+    )
+
+    operation = f"convert-{args.target_format.lower()}"
+    iterate_images(
+        func,
+        extensions,
+        jobs=args.jobs,
+        max_memory=args.max_memory,
+        operation=operation,
+        force=args.force,
+        status=args.status,
+        resume=args.resume,
+        watch=args.watch,
+        metrics=RunMetrics.from_args(args, operation),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,380 @@
+"""
+Long-running daemon that processes jobs sent over a Unix domain socket.
+
+  iw-daemon serve -j 4                                # in the tree root
+  iw-daemon submit add-thumbnail scans/a.jpg scans/b.tif
+  iw-daemon submit convert a.tif -o format=png
+
+The daemon imports the processors and starts its worker processes once, so a
+job only pays for the work itself. Each connection sends one JSON request per
+line and reads one JSON response per line:
+
+  {"operation": "add-thumbnail", "paths": ["a.jpg"], "options": {}}
+  {"ok": true, "results": [{"path": "a.jpg", "ok": true, "output": null}],
+   "seconds": 0.02, "metrics": {"file": {"count": 1, ...}}}
+
+Operations are those of the iw-* tools (add-thumbnail, remove-thumbnail,
+extract-thumbnail, compress, convert, pipeline) with their options as in
+job_function(); {"operation": "status"} reports the daemon's load. Processed
+files are recorded in the run manifest like a run of the tool. Relative paths
+are relative to the daemon's working directory.
+
+Connections are served concurrently and their files share the worker pool.
+At most --max-queue files are queued at once: a job that does not fit is
+refused with "busy" so the client can back off and retry, instead of piling
+up work the daemon cannot keep up with.
+"""
+
+import argparse
+import functools
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from pathlib import Path
+
+from .add_thumbnails import add_thumbnails_if_needed
+from .common import (
+    DEFAULT_SIZES,
+    WorkerPool,
+    default_jobs,
+    parse_sizes,
+    thumbnail_operation,
+)
+from .compress_tiffs import (
+    CODECS,
+    PREDICTORS,
+    CompressionSettings,
+    compress_tiff,
+    operation_name,
+)
+from .convert_format import convert_to_format
+from .encoders import FORMATS, SUBSAMPLING, ThumbnailEncoding
+from .extract_thumbnails import extract_thumbnail_to_dir
+from .lazy import preload
+from .manifest import get_manifest
+from .metrics import Measured, RunMetrics, measured
+from .pipeline import check_stages, pipeline_operation, run_stages
+from .remove_thumbnails import remove_thumbnails_if_needed
+
+SOCKET_FILENAME = ".iw-daemon.sock"
+
+
+def _sizes(options):
+    """Thumbnail sizes of a job: a list, or a string like "256,64,1024"."""
+    sizes = options.get("sizes", DEFAULT_SIZES)
+    if isinstance(sizes, str):
+        return parse_sizes(sizes)
+    if isinstance(sizes, int):
+        return (sizes,)
+    return parse_sizes(",".join(str(size) for size in sizes))
+
+
+def _encoding(options):
+    """Thumbnail encoding of a job, from the iw-* tools' encoding options."""
+    encoding = ThumbnailEncoding(
+        options.get("thumb_format", "jpeg"),
+        options.get("thumb_quality"),
+        options.get("subsampling"),
+        bool(options.get("progressive")),
+        options.get("tiff_thumbnails", "none"),
+    )
+    if (
+        encoding.format not in FORMATS
+        or encoding.tiff not in ("none", "jpeg")
+        or (
+            encoding.subsampling is not None and encoding.subsampling not in SUBSAMPLING
+        )
+    ):
+        raise ValueError(f"Unknown thumbnail encoding: {encoding}")
+    return encoding
+
+
+def _settings(options):
+    """Compression settings of a job, from iw-compress-tiffs' options."""
+    settings = CompressionSettings(
+        options.get("codec", "lzw"),
+        options.get("predictor", "none"),
+        options.get("level"),
+        options.get("tile"),
+        options.get("threads", 1),
+    )
+    if settings.codec not in CODECS or settings.predictor not in PREDICTORS:
+        raise ValueError(f"Unknown codec or predictor: {settings}")
+    return settings
+
+
+def job_function(operation, options):
+    """
+    Return (manifest operation name, per-file function) for a job, as the
+    iw-* tool for the operation would run it. Raises ValueError for unknown
+    operations or invalid options.
+    """
+    if operation == "add-thumbnail":
+        sizes, encoding = _sizes(options), _encoding(options)
+        func = functools.partial(
+            add_thumbnails_if_needed,
+            keep_aspect=bool(options.get("keep_aspect")),
+            sizes=sizes,
+            encoding=encoding,
+        )
+        return thumbnail_operation(operation, sizes, encoding), func
+    if operation == "remove-thumbnail":
+        return operation, remove_thumbnails_if_needed
+    if operation == "extract-thumbnail":
+        sizes, encoding = _sizes(options), _encoding(options)
+        func = functools.partial(
+            extract_thumbnail_to_dir, sizes=sizes, encoding=encoding
+        )
+        return thumbnail_operation(operation, sizes, encoding), func
+    if operation in ("compress", "compress-lzw"):
+        settings = _settings(options)
+        func = functools.partial(
+            compress_tiff,
+            buffer_size=options.get("buffer_size"),
+            settings=settings,
+            recompress=bool(options.get("recompress")),
+        )
+        return operation_name(settings), func
+    if operation == "convert":
+        if "format" not in options:
+            raise ValueError("convert needs a format option")
+        fmt = str(options["format"]).lower()
+        func = functools.partial(
+            convert_to_format,
+            target_format=fmt,
+            engine=options.get("engine", "auto"),
+            gm_backend=options.get("gm_backend", "batch"),
+        )
+        return f"convert-{fmt}", func
+    if operation == "pipeline":
+        stages = [stage for stage in options.get("stages", []) if stage != "gallery"]
+        error = check_stages(stages) if stages else "pipeline needs stages"
+        if error:
+            raise ValueError(error)
+        settings = _settings(options)
+        func = functools.partial(
+            run_stages,
+            stages=stages,
+            keep_aspect=bool(options.get("keep_aspect")),
+            sizes=_sizes(options),
+            encoding=_encoding(options),
+            settings=settings,
+        )
+        return pipeline_operation(stages, settings), func
+    raise ValueError(f"Unknown operation: {operation}")
+
+
+def _process(func, operation, file):
+    """Run func on file in a worker and record it in the run manifest."""
+    res = func(file)
+    result = res.result if isinstance(res, Measured) else res
+    manifest = get_manifest()
+    if manifest is not None and result is not False:
+        output = result if isinstance(result, (str, Path)) else None
+        manifest.record(file, operation, output)
+    return res
+
+
+class Daemon:
+    def __init__(self, jobs=None, max_queue=None):
+        self.jobs = jobs or default_jobs()
+        self.max_queue = max_queue or self.jobs * 16
+        self.queued = 0
+        self.served = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # Started before any connection thread exists, and all at once, so
+        # the first jobs do not wait for workers to fork or import codecs
+        preload()
+        self.pool = WorkerPool(self.jobs)
+        self.pool.start()
+
+    def status(self):
+        return {
+            "ok": True,
+            "pid": os.getpid(),
+            "workers": self.jobs,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "jobs_served": self.served,
+            "uptime_s": round(time.time() - self.started, 1),
+        }
+
+    def handle(self, request):
+        """Run one job request and return the response."""
+        operation = request.get("operation")
+        if operation == "status":
+            return self.status()
+        paths = request.get("paths") or []
+        if not isinstance(paths, list) or not all(
+            isinstance(path, str) for path in paths
+        ):
+            return {"ok": False, "error": "paths must be a list of file paths"}
+        try:
+            manifest_operation, func = job_function(
+                operation, request.get("options") or {}
+            )
+        except ValueError as e:
+            return {"ok": False, "error": str(e)}
+
+        with self.lock:
+            # A job larger than the whole queue is still taken when idle
+            if self.queued and self.queued + len(paths) > self.max_queue:
+                return {"ok": False, "error": "busy", "queued": self.queued}
+            self.queued += len(paths)
+        try:
+            started = time.perf_counter()
+            func = functools.partial(
+                _process, functools.partial(measured, func), manifest_operation
+            )
+            futures = [(self.pool.submit(func, path), path) for path in paths]
+            metrics = RunMetrics(manifest_operation)
+            results = []
+            for future, path in futures:
+                _, ok, res = self.pool.outcome(future, path)
+                if isinstance(res, Measured):
+                    metrics.add(path, res.samples)
+                    res = res.result
+                ok = ok and res is not False
+                output = str(res) if isinstance(res, (str, Path)) else None
+                results.append({"path": path, "ok": ok, "output": output})
+        finally:
+            with self.lock:
+                self.queued -= len(paths)
+                self.served += 1
+        return {
+            "ok": all(result["ok"] for result in results),
+            "results": results,
+            "seconds": round(time.perf_counter() - started, 4),
+            "metrics": metrics.summary(),
+        }
+
+    def close(self):
+        self.pool.close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = self.server.daemon.handle(request)
+            except (json.JSONDecodeError, AttributeError, TypeError) as e:
+                response = {"ok": False, "error": f"Invalid request: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, daemon):
+    """Serve daemon on socket_path until interrupted."""
+    if os.path.exists(socket_path):
+        try:
+            request(socket_path, {"operation": "status"})
+        except OSError:
+            os.remove(socket_path)  # left behind by a daemon that died
+        else:
+            raise OSError(f"A daemon is already serving {socket_path}")
+    server = _Server(socket_path, _Handler)
+    server.daemon = daemon
+    os.chmod(socket_path, 0o600)
+    # Stop cleanly on SIGTERM as on Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Serving on {socket_path} with {daemon.jobs} workers (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        daemon.close()
+
+
+def request(socket_path, job, timeout=None):
+    """Send one job to the daemon at socket_path and return its response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps(job).encode() + b"\n")
+            f.flush()
+            line = f.readline()
+    if not line:
+        raise OSError("The daemon closed the connection")
+    return json.loads(line)
+
+
+def _option(text):
+    key, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {text!r}")
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        return key, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Process images in a long-running daemon"
+    )
+    parser.add_argument(
+        "--socket",
+        default=SOCKET_FILENAME,
+        help=f"Unix socket to serve or connect to (default: {SOCKET_FILENAME})",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the daemon")
+    serve_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=default_jobs(),
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    serve_parser.add_argument(
+        "--max-queue",
+        type=int,
+        help="Files queued at once before jobs are refused (default: 16 per worker)",
+    )
+
+    submit_parser = subparsers.add_parser("submit", help="Send a job to the daemon")
+    submit_parser.add_argument("operation", help="Operation, or status")
+    submit_parser.add_argument("paths", nargs="*", help="Files to process")
+    submit_parser.add_argument(
+        "-o",
+        "--option",
+        type=_option,
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help='Operation option, e.g. format=png or stages=["compress"]',
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.socket, Daemon(args.jobs, args.max_queue))
+    elif args.command == "submit":
+        job = {
+            "operation": args.operation,
+            "paths": args.paths,
+            "options": dict(args.option),
+        }
+        response = request(args.socket, job)
+        print(json.dumps(response, indent=2))
+        if not response.get("ok"):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Encoders for the thumbnails the tools write.
+
+  iw-add-thumbnails --thumb-format webp --thumb-quality 70
+  iw-add-thumbnails --thumb-quality 80 --progressive --tiff-thumbnails jpeg
+  iw-extract-thumbnails --thumb-format avif --thumb-quality 50
+
+Sidecars and extracted thumbnails are written in the chosen format (JPEG,
+WebP, or AVIF where Pillow can write it), named .jpg, .webp or .avif. EXIF
+thumbnails stay baseline JPEG, which is all the EXIF standard allows, but
+take the quality and chroma subsampling. TIFF SubIFD thumbnails are stored
+uncompressed, or as JPEG with --tiff-thumbnails jpeg. JPEGs are always
+written with optimized Huffman tables, which costs no quality.
+
+Each encode is a metrics stage, encode-<format>, recording the raw and
+encoded bytes. When metrics are collected it also records the PSNR of the
+encoded thumbnail against the pixels it was made from. So the run summary
+shows what the settings trade; that check is timed with the encode.
+"""
+
+import math
+from collections import namedtuple
+from io import BytesIO
+
+from .lazy import lazy_import
+from .metrics import measuring_psnr, timed
+from .tiffio import JpegThumbnail
+
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+# --thumb-format choices -> (Pillow format, file extension)
+FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "avif": ("AVIF", ".avif"),
+}
+
+# --subsampling choices -> TIFF YCbCrSubSampling (horizontal, vertical)
+SUBSAMPLING = {"4:4:4": (1, 1), "4:2:2": (2, 1), "4:2:0": (2, 2)}
+
+# How thumbnails are encoded:
+#   format       jpeg, webp or avif (see FORMATS)
+#   quality      1-100, None for the encoder's default
+#   subsampling  chroma subsampling of JPEG and AVIF, None for the default
+#                (4:2:0); WebP is always 4:2:0
+#   progressive  progressive JPEG sidecars and extracted thumbnails
+#   tiff         compression of TIFF SubIFD thumbnails: none or jpeg
+ThumbnailEncoding = namedtuple(
+    "ThumbnailEncoding",
+    "format quality subsampling progressive tiff",
+    defaults=("jpeg", None, None, False, "none"),
+)
+
+DEFAULT_ENCODING = ThumbnailEncoding()
+
+# PSNR reported for an encode that reproduced its input exactly
+LOSSLESS_PSNR = 100.0
+
+
+def extension(encoding):
+    """File extension of thumbnails written with encoding, e.g. ".webp"."""
+    return FORMATS[encoding.format][1]
+
+
+def settings_label(encoding):
+    """
+    The encoder settings of encoding as a name suffix, e.g. "-q80-420-progressive",
+    or "" when it uses the encoder's defaults.
+    """
+    parts = []
+    if encoding.quality is not None:
+        parts.append(f"q{encoding.quality}")
+    if encoding.subsampling:
+        parts.append(encoding.subsampling.replace(":", ""))
+    if encoding.progressive:
+        parts.append("progressive")
+    return "".join(f"-{part}" for part in parts)
+
+
+def can_encode(fmt):
+    """Whether this Pillow build can write thumbnails in fmt."""
+    Image.init()
+    return FORMATS[fmt][0] in Image.SAVE
+
+
+def _psnr(img, data):
+    with Image.open(BytesIO(data)) as decoded:
+        decoded = np.asarray(decoded.convert(img.mode), dtype=np.float64)
+    mse = np.mean((np.asarray(img, dtype=np.float64) - decoded) ** 2)
+    if mse == 0:
+        return LOSSLESS_PSNR
+    return min(LOSSLESS_PSNR, 10 * math.log10(255**2 / mse))
+
+
+def encode_thumbnail(img, encoding=DEFAULT_ENCODING, baseline=False):
+    """
+    Encode a thumbnail image as encoding says and return the bytes. baseline
+    forces a baseline JPEG, as embedded EXIF thumbnails must be.
+    """
+    fmt = "jpeg" if baseline else encoding.format
+    options = {}
+    if encoding.quality is not None:
+        options["quality"] = encoding.quality
+    if fmt == "jpeg":
+        options["optimize"] = True
+        options["progressive"] = encoding.progressive and not baseline
+    if fmt in ("jpeg", "avif") and encoding.subsampling:
+        options["subsampling"] = encoding.subsampling
+    with timed(f"encode-{fmt}") as stage:
+        buffer = BytesIO()
+        img.save(buffer, FORMATS[fmt][0], **options)
+        data = buffer.getvalue()
+        stage.bytes_read = img.width * img.height * len(img.getbands())
+        stage.bytes_written = len(data)
+        if measuring_psnr():
+            stage.psnr = _psnr(img, data)
+    return data
+
+
+def tiff_thumbnail(img, encoding=DEFAULT_ENCODING):
+    """
+    A thumbnail image as stored in a TIFF SubIFD: an array of its pixels, or
+    with encoding.tiff == "jpeg" a JpegThumbnail.
+    """
+    if encoding.tiff != "jpeg":
+        return np.asarray(img)
+    subsampling = encoding.subsampling or "4:2:0"
+    data = encode_thumbnail(img, encoding._replace(subsampling=subsampling), True)
+    samples = len(img.getbands())
+    return JpegThumbnail(
+        data,
+        img.width,
+        img.height,
+        samples,
+        SUBSAMPLING[subsampling] if samples == 3 else None,
+    )
+
+
+def add_encoding_arguments(parser):
+    """Add the thumbnail encoding options to an argparse parser."""
+    parser.add_argument(
+        "--thumb-format",
+        choices=list(FORMATS),
+        default="jpeg",
+        help="Format of sidecar and extracted thumbnails (default: jpeg); EXIF "
+        "thumbnails are always JPEG",
+    )
+    parser.add_argument(
+        "--thumb-quality",
+        type=int,
+        help="Thumbnail encoder quality, 1-100 (default: the encoder's)",
+    )
+    parser.add_argument(
+        "--subsampling",
+        choices=list(SUBSAMPLING),
+        help="Chroma subsampling of JPEG and AVIF thumbnails (default: 4:2:0)",
+    )
+    parser.add_argument(
+        "--progressive",
+        action="store_true",
+        help="Write progressive JPEG sidecar and extracted thumbnails",
+    )
+    parser.add_argument(
+        "--tiff-thumbnails",
+        choices=["none", "jpeg"],
+        default="none",
+        help="Compression of TIFF SubIFD thumbnails (default: none)",
+    )
+    return parser
+
+
+def encoding_from_args(parser, args):
+    """ThumbnailEncoding of add_encoding_arguments' options; exits if invalid."""
+    if not can_encode(args.thumb_format):
+        parser.error(f"This Pillow build cannot write {args.thumb_format} images")
+    if args.thumb_quality is not None and not 1 <= args.thumb_quality <= 100:
+        parser.error("--thumb-quality must be between 1 and 100")
+    return ThumbnailEncoding(
+        args.thumb_format,
+        args.thumb_quality,
+        args.subsampling,
+        args.progressive,
+        args.tiff_thumbnails,
+    )
@@ -1,18 +1,66 @@
-import os
+import argparse
+import functools
 
-from .common import iterate_images, extract_thumbnail, ALL_SUPPORTED_EXTENSIONS
+from .common import (
+    DEFAULT_SIZES,
+    add_common_arguments,
+    add_manifest_arguments,
+    add_sizes_argument,
+    iterate_images,
+    thumbnail_operation,
+    extract_thumbnail,
+    extracted_thumbnail_path,
+    ALL_SUPPORTED_EXTENSIONS,
+)
+from .encoders import (
+    DEFAULT_ENCODING,
+    add_encoding_arguments,
+    encoding_from_args,
+    extension,
+)
+from .metrics import RunMetrics
 
 
-def extract_thumbnail_to_dir(file_path):
+def extract_thumbnail_to_dir(
+    file_path, thumbnails=None, sizes=DEFAULT_SIZES, encoding=DEFAULT_ENCODING
+):
     thumb_dir = "thumbnails"
-    if not os.path.exists(thumb_dir):
-        os.makedirs(thumb_dir)
-    return extract_thumbnail(file_path, thumb_dir)
+    if not extract_thumbnail(
+        file_path, thumb_dir, thumbnails=thumbnails, sizes=sizes, encoding=encoding
+    ):
+        return False
+    # Recorded in the run manifest, so a deleted thumbnail is extracted again
+    return extracted_thumbnail_path(file_path, thumb_dir, ext=extension(encoding))
 
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extract thumbnails to the thumbnails/ directory"
+    )
+    add_sizes_argument(parser)
+    add_encoding_arguments(parser)
+    add_common_arguments(parser)
+    add_manifest_arguments(parser)
+    args = parser.parse_args(argv)
+    encoding = encoding_from_args(parser, args)
+
     extensions = list(ALL_SUPPORTED_EXTENSIONS)
-    iterate_images(extract_thumbnail_to_dir, extensions)
+    operation = thumbnail_operation("extract-thumbnail", args.sizes, encoding)
+    func = functools.partial(
+        extract_thumbnail_to_dir, sizes=args.sizes, encoding=encoding
+    )
+    iterate_images(
+        func,
+        extensions,
+        jobs=args.jobs,
+        max_memory=args.max_memory,
+        operation=operation,
+        force=args.force,
+        status=args.status,
+        resume=args.resume,
+        watch=args.watch,
+        metrics=RunMetrics.from_args(args, "extract-thumbnail", encodes=True),
+    )
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
+import argparse
 from pathlib import Path
-from .common import iterate_images
+from .common import add_common_arguments, find_thumbnail, iterate_images
+from .metrics import RunMetrics
 
 
 HTML_HEADER = """<!DOCTYPE html>
@@ -29,17 +31,14 @@ HTML_FOOTER = """    </div>
 
 def generate_gallery_item(file_path):
     file_path = Path(file_path)
-    # Skip thumbnail files themselves if they are picked up
-    if "thumbnails" in file_path.parts or "converted" in file_path.parts:
-        return None
     base = file_path.name
 
-    # Check for extracted thumbnail in root thumbnails/ directory
-    # Matches naming convention from extract_thumbnails.py: filename.ext.jpg
-    thumb_flat = Path("thumbnails") / f"{file_path.name}.jpg"
+    # Extracted thumbnail in the root thumbnails/ directory, else one already
+    # in the thumbnail store (see extract_thumbnails.py)
+    thumb = find_thumbnail(file_path)
 
-    if thumb_flat.exists():
-        img_src = str(thumb_flat)
+    if thumb:
+        img_src = thumb
     else:
         # Fallback to sidecar in same dir check (legacy)
         # or just link to original
@@ -48,14 +47,29 @@ def generate_gallery_item(file_path):
     return f"""<div class='image-item'><a href='{file_path}' target='_blank'><img src='{img_src}' alt='{base}'></a><p>{base}</p></div>"""
 
 
-def main():
-    extensions = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp"]
-    items = iterate_images(generate_gallery_item, extensions, collect_results=True)
-    with open("gallery.html", "w") as f:
+def write_gallery(items, path="gallery.html"):
+    with open(path, "w") as f:
         f.write(HTML_HEADER)
         f.write("\n".join(items))
         f.write(HTML_FOOTER)
-    print("Gallery generated: gallery.html")
+    print(f"Gallery generated: {path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate gallery.html")
+    add_common_arguments(parser)
+    args = parser.parse_args(argv)
+
+    extensions = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp"]
+    items = iterate_images(
+        generate_gallery_item,
+        extensions,
+        collect_results=True,
+        jobs=args.jobs,
+        max_memory=args.max_memory,
+        metrics=RunMetrics.from_args(args, "gallery"),
+    )
+    write_gallery(items)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+"""
+Long-lived GraphicsMagick workers.
+
+Spawning `gm convert` per file makes process startup the bottleneck for
+directories of small images. A GmBatch keeps one `gm batch` process open and
+feeds it one command per line on stdin; with -feedback on, gm prints a pass or
+fail marker after every command, which is how completion is detected.
+
+Each worker process of the iterate_images pool owns one GmBatch (see
+run_gm), so the number of gm processes follows --jobs.
+"""
+
+import atexit
+import os
+import re
+import subprocess
+import threading
+
+PASS_MARKER = "__IW_GM_PASS__"
+FAIL_MARKER = "__IW_GM_FAIL__"
+
+# Arguments made only of these characters need no quoting
+_SAFE_ARG = re.compile(r"^[\w@%+=:,./-]+$")
+
+
+def quote_arg(arg):
+    """Quote one argument for gm batch's unix-style command line parser."""
+    arg = str(arg)
+    if "\n" in arg or "\r" in arg:
+        raise ValueError(f"Argument cannot be passed to gm batch: {arg!r}")
+    if _SAFE_ARG.match(arg):
+        return arg
+    return '"' + arg.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class GmBatch:
+    """A persistent `gm batch` process that runs gm commands one at a time."""
+
+    def __init__(self):
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        self.proc = subprocess.Popen(
+            [
+                "gm",
+                "batch",
+                "-escape",
+                "unix",
+                "-echo",
+                "off",
+                "-prompt",
+                "off",
+                "-stop-on-error",
+                "off",
+                "-feedback",
+                "on",
+                "-pass",
+                PASS_MARKER,
+                "-fail",
+                FAIL_MARKER,
+                "-",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+
+    def run(self, args):
+        """
+        Run one gm command (e.g. ["convert", src, dst]) in the batch process.
+        Returns the command's output; raises subprocess.CalledProcessError
+        if it fails. If gm itself has died, raises BrokenPipeError and the
+        next command starts a fresh process.
+        """
+        line = " ".join(quote_arg(arg) for arg in args) + "\n"
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self._start()
+            output = []
+            try:
+                self.proc.stdin.write(line)
+                self.proc.stdin.flush()
+                while True:
+                    out = self.proc.stdout.readline()
+                    if not out:
+                        raise BrokenPipeError("gm batch exited")
+                    out = out.rstrip("\n")
+                    if out == PASS_MARKER:
+                        return "\n".join(output)
+                    if out == FAIL_MARKER:
+                        raise subprocess.CalledProcessError(
+                            1, ["gm", *args], "\n".join(output)
+                        )
+                    output.append(out)
+            except OSError:
+                self.close()
+                raise
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+        self.proc = None
+
+
+_batches = {}
+
+
+def _close_all():
+    for batch in _batches.values():
+        batch.close()
+
+
+atexit.register(_close_all)
+
+
+def run_gm(args, backend="batch"):
+    """
+    Run a gm command. backend="batch" sends it to this process's persistent
+    gm batch worker. Commands it cannot carry (arguments containing newlines)
+    or that were lost because the worker died run in a separate `gm` process,
+    as does everything with backend="exec".
+    """
+    carriable = not any("\n" in str(arg) or "\r" in str(arg) for arg in args)
+    if backend == "batch" and carriable:
+        batch = _batches.get(os.getpid())
+        if batch is None:
+            batch = _batches[os.getpid()] = GmBatch()
+        try:
+            return batch.run(args)
+        except OSError as e:
+            print(f"gm batch worker failed ({e}), running gm directly")
+    subprocess.run(["gm", *args], check=True)
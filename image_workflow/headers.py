@@ -0,0 +1,439 @@
+"""
+Header-only parsers for the image containers the workflow handles.
+
+These read just the structural parts of a file (JPEG markers, PNG chunk
+headers, RIFF chunks, TIFF IFDs) and seek over pixel data, so they are cheap
+compared to decoding the image or forking GraphicsMagick.
+"""
+
+import struct
+import zlib
+from collections import namedtuple
+from io import BytesIO
+
+EXIF_HEADER = b"Exif\x00\x00"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+IMAGE_DESCRIPTION = 270
+
+# TIFF field type -> (struct format character, size in bytes)
+TIFF_TYPES = {
+    1: ("B", 1),  # BYTE
+    2: ("s", 1),  # ASCII
+    3: ("H", 2),  # SHORT
+    4: ("I", 4),  # LONG
+    5: ("I", 8),  # RATIONAL (two LONGs)
+    6: ("b", 1),  # SBYTE
+    7: ("s", 1),  # UNDEFINED
+    8: ("h", 2),  # SSHORT
+    9: ("i", 4),  # SLONG
+    10: ("i", 8),  # SRATIONAL (two SLONGs)
+    11: ("f", 4),  # FLOAT
+    12: ("d", 8),  # DOUBLE
+    13: ("I", 4),  # IFD
+    16: ("Q", 8),  # LONG8
+    17: ("q", 8),  # SLONG8
+    18: ("Q", 8),  # IFD8
+}
+
+TiffEntry = namedtuple("TiffEntry", "tag type count field")
+
+
+class TiffReader:
+    """Read IFD entries from a TIFF (or EXIF) structure without decoding pixels."""
+
+    def __init__(self, f, base=0):
+        self.f = f
+        self.base = base
+        f.seek(base)
+        header = f.read(16)
+        if header[:2] == b"II":
+            self.byteorder = "<"
+        elif header[:2] == b"MM":
+            self.byteorder = ">"
+        else:
+            raise ValueError("Not a TIFF structure")
+        magic = struct.unpack(self.byteorder + "H", header[2:4])[0]
+        if magic == 42:
+            self.bigtiff = False
+            self.first_ifd = struct.unpack(self.byteorder + "I", header[4:8])[0]
+        elif magic == 43:
+            self.bigtiff = True
+            self.first_ifd = struct.unpack(self.byteorder + "Q", header[8:16])[0]
+        else:
+            raise ValueError(f"Unknown TIFF magic number {magic}")
+
+    def read_ifd(self, offset):
+        """Return ([TiffEntry, ...], next_ifd_offset) for the IFD at offset."""
+        order = self.byteorder
+        if self.bigtiff:
+            count_fmt, entry_fmt, entry_size, next_fmt = "Q", "HHQ8s", 20, "Q"
+        else:
+            count_fmt, entry_fmt, entry_size, next_fmt = "H", "HHI4s", 12, "I"
+
+        self.f.seek(self.base + offset)
+        count_size = struct.calcsize(count_fmt)
+        count = struct.unpack(order + count_fmt, self.f.read(count_size))[0]
+        data = self.f.read(count * entry_size + struct.calcsize(next_fmt))
+        if len(data) < count * entry_size:
+            raise ValueError(f"Truncated IFD at offset {offset}")
+
+        entries = []
+        for i in range(count):
+            chunk = data[i * entry_size : (i + 1) * entry_size]
+            entries.append(TiffEntry(*struct.unpack(order + entry_fmt, chunk)))
+        tail = data[count * entry_size :]
+        next_ifd = struct.unpack(order + next_fmt, tail)[0] if tail else 0
+        return entries, next_ifd
+
+    def value(self, entry):
+        """Return an entry's value: bytes for ASCII/UNDEFINED, else a tuple."""
+        fmt, size = TIFF_TYPES.get(entry.type, ("B", 1))
+        total = size * entry.count
+        if total <= len(entry.field):
+            raw = entry.field[:total]
+        else:
+            offset_fmt = "Q" if self.bigtiff else "I"
+            offset = struct.unpack(
+                self.byteorder + offset_fmt, entry.field[: struct.calcsize(offset_fmt)]
+            )[0]
+            self.f.seek(self.base + offset)
+            raw = self.f.read(total)
+
+        if fmt == "s":
+            return raw
+        if entry.type in (5, 10):
+            return struct.unpack(f"{self.byteorder}{2 * entry.count}{fmt}", raw)
+        return struct.unpack(f"{self.byteorder}{entry.count}{fmt}", raw)
+
+
+def _decode_text(raw):
+    raw = raw.rstrip(b"\x00")
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("latin-1")
+
+
+def _tiff_descriptions(f, base=0):
+    reader = TiffReader(f, base)
+    entries, _ = reader.read_ifd(reader.first_ifd)
+    return [
+        _decode_text(reader.value(entry))
+        for entry in entries
+        if entry.tag == IMAGE_DESCRIPTION
+    ]
+
+
+def _exif_descriptions(data):
+    if data.startswith(EXIF_HEADER):
+        data = data[len(EXIF_HEADER) :]
+    return _tiff_descriptions(BytesIO(data))
+
+
+def _jpeg_segments(f):
+    """
+    Yield (marker, payload_offset, payload_length) for each JPEG segment
+    before the image data. Payloads the caller does not read are skipped.
+    """
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return
+        if byte != b"\xff":
+            raise ValueError("Corrupt JPEG marker stream")
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return
+        code = marker[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            continue  # markers without a length field
+        if code in (0xD9, 0xDA):
+            return  # end of image / start of scan: no more metadata
+        length = struct.unpack(">H", f.read(2))[0] - 2
+        offset = f.tell()
+        yield code, offset, length
+        f.seek(offset + length)
+
+
+def _jpeg_comments(f):
+    comments = []
+    for code, _, length in _jpeg_segments(f):
+        if code == 0xFE:
+            comments.append(_decode_text(f.read(length)))
+        elif code == 0xE1:
+            data = f.read(length)
+            if data.startswith(EXIF_HEADER):
+                comments.extend(_exif_descriptions(data))
+    return comments
+
+
+def _png_comments(f):
+    comments = []
+    f.seek(len(PNG_SIGNATURE))
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IEND":
+            break
+        if chunk_type == b"tEXt":
+            _, _, text = f.read(length).partition(b"\x00")
+            comments.append(text.decode("latin-1"))
+        elif chunk_type == b"zTXt":
+            _, _, rest = f.read(length).partition(b"\x00")
+            comments.append(zlib.decompress(rest[1:]).decode("latin-1"))
+        elif chunk_type == b"iTXt":
+            _, _, rest = f.read(length).partition(b"\x00")
+            compressed = rest[0] == 1
+            _, _, rest = rest[2:].partition(b"\x00")  # language tag
+            _, _, text = rest.partition(b"\x00")  # translated keyword
+            if compressed:
+                text = zlib.decompress(text)
+            comments.append(text.decode("utf-8"))
+        elif chunk_type == b"eXIf":
+            comments.extend(_exif_descriptions(f.read(length)))
+        else:
+            f.seek(length, 1)
+        f.seek(4, 1)  # CRC
+    return comments
+
+
+def _webp_comments(f):
+    comments = []
+    f.seek(12)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk_type, length = struct.unpack("<4sI", header)
+        if chunk_type == b"EXIF":
+            comments.extend(_exif_descriptions(f.read(length)))
+            f.seek(length & 1, 1)
+        else:
+            f.seek(length + (length & 1), 1)
+    return comments
+
+
+def read_comments(file_path):
+    """
+    Return the comment/description strings embedded in an image:
+    JPEG COM segments and EXIF ImageDescription, PNG tEXt/zTXt/iTXt chunks,
+    WebP EXIF ImageDescription and TIFF ImageDescription.
+    Returns None when the container is not recognised (or is malformed), so
+    callers can fall back to a slower, more general reader.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            magic = f.read(12)
+            if magic[:2] == b"\xff\xd8":
+                return _jpeg_comments(f)
+            if magic[:8] == PNG_SIGNATURE:
+                return _png_comments(f)
+            if magic[:4] == b"RIFF" and magic[8:12] == b"WEBP":
+                return _webp_comments(f)
+            if magic[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+                return _tiff_descriptions(f)
+    except (OSError, ValueError, IndexError, struct.error, zlib.error):
+        pass
+    return None
+
+
+# Result of a thumbnail probe:
+#   has_thumbnail  whether an embedded thumbnail is present
+#   exif           (offset, length) of the JPEG EXIF (TIFF) block, or None
+#   thumbnail      (offset, length) of the EXIF thumbnail JPEG, or None
+#   subifds        SubIFD offsets of TIFF page 0
+ThumbnailProbe = namedtuple(
+    "ThumbnailProbe",
+    "has_thumbnail exif thumbnail subifds",
+    defaults=(None, None, ()),
+)
+
+NO_THUMBNAIL = ThumbnailProbe(False)
+
+JPEG_INTERCHANGE_FORMAT = 513
+JPEG_INTERCHANGE_FORMAT_LENGTH = 514
+SUBIFDS = 330
+
+
+def probe_jpeg_thumbnail(file_path):
+    """
+    Find the EXIF thumbnail of a JPEG by reading only the APP1 IFD headers.
+    A thumbnail is present when IFD1 points at non-empty JPEG data, which is
+    what piexif reports as exif["thumbnail"].
+    """
+    try:
+        with open(file_path, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return NO_THUMBNAIL
+            for code, offset, length in _jpeg_segments(f):
+                if code != 0xE1 or f.read(len(EXIF_HEADER)) != EXIF_HEADER:
+                    continue
+                base = offset + len(EXIF_HEADER)
+                exif = (base, length - len(EXIF_HEADER))
+                reader = TiffReader(f, base)
+                _, ifd1 = reader.read_ifd(reader.first_ifd)
+                if not ifd1:
+                    return ThumbnailProbe(False, exif)
+                entries, _ = reader.read_ifd(ifd1)
+                values = {
+                    entry.tag: reader.value(entry)[0]
+                    for entry in entries
+                    if entry.tag
+                    in (JPEG_INTERCHANGE_FORMAT, JPEG_INTERCHANGE_FORMAT_LENGTH)
+                }
+                thumb_offset = values.get(JPEG_INTERCHANGE_FORMAT)
+                thumb_length = values.get(JPEG_INTERCHANGE_FORMAT_LENGTH)
+                if thumb_offset is None or not thumb_length:
+                    return ThumbnailProbe(False, exif)
+                return ThumbnailProbe(True, exif, (base + thumb_offset, thumb_length))
+    except (OSError, ValueError, IndexError, struct.error):
+        pass
+    return NO_THUMBNAIL
+
+
+def probe_tiff_thumbnail(file_path):
+    """Check for a SubIFD thumbnail by reading only the page-0 IFD."""
+    try:
+        with open(file_path, "rb") as f:
+            reader = TiffReader(f)
+            entries, _ = reader.read_ifd(reader.first_ifd)
+            for entry in entries:
+                if entry.tag == SUBIFDS:
+                    subifds = reader.value(entry)
+                    return ThumbnailProbe(bool(subifds), subifds=subifds)
+    except (OSError, ValueError, IndexError, struct.error):
+        pass
+    return NO_THUMBNAIL
+
+
+# Size of the decoded raster: pixels, samples per pixel and bits per sample
+ImageGeometry = namedtuple("ImageGeometry", "width height samples bits")
+
+# PNG colour type -> samples per pixel
+PNG_SAMPLES = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+SAMPLES_PER_PIXEL = 277
+
+
+def _jpeg_geometry(f):
+    for code, _, _ in _jpeg_segments(f):
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            bits, height, width, samples = struct.unpack(">BHHB", f.read(6))
+            return ImageGeometry(width, height, samples, bits)
+    return None
+
+
+def _png_geometry(f):
+    f.seek(len(PNG_SIGNATURE) + 8)
+    width, height, bits, color_type = struct.unpack(">IIBB", f.read(10))
+    return ImageGeometry(width, height, PNG_SAMPLES.get(color_type, 4), bits)
+
+
+def _webp_geometry(f):
+    f.seek(12)
+    chunk_type, _ = struct.unpack("<4sI", f.read(8))
+    data = f.read(10)
+    if chunk_type == b"VP8X":
+        width = int.from_bytes(data[4:7], "little") + 1
+        height = int.from_bytes(data[7:10], "little") + 1
+        return ImageGeometry(width, height, 4 if data[0] & 0x10 else 3, 8)
+    if chunk_type == b"VP8 ":
+        width, height = struct.unpack("<HH", data[6:10])
+        return ImageGeometry(width & 0x3FFF, height & 0x3FFF, 3, 8)
+    if chunk_type == b"VP8L":
+        bits = int.from_bytes(data[1:5], "little")
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+        return ImageGeometry(width, height, 4, 8)
+    return None
+
+
+def _tiff_geometry(f):
+    reader = TiffReader(f)
+    entries, _ = reader.read_ifd(reader.first_ifd)
+    values = {
+        entry.tag: reader.value(entry)
+        for entry in entries
+        if entry.tag in (IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, SAMPLES_PER_PIXEL)
+    }
+    return ImageGeometry(
+        values[IMAGE_WIDTH][0],
+        values[IMAGE_LENGTH][0],
+        values.get(SAMPLES_PER_PIXEL, (1,))[0],
+        max(values.get(BITS_PER_SAMPLE, (1,))),
+    )
+
+
+def image_geometry(file_path):
+    """
+    Read an image's dimensions, samples per pixel and bit depth from its
+    header (the first page of a TIFF). Returns None for unknown or malformed
+    files.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            magic = f.read(12)
+            if magic[:2] == b"\xff\xd8":
+                return _jpeg_geometry(f)
+            if magic[:8] == PNG_SIGNATURE:
+                return _png_geometry(f)
+            if magic[:4] == b"RIFF" and magic[8:12] == b"WEBP":
+                return _webp_geometry(f)
+            if magic[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+                return _tiff_geometry(f)
+    except (OSError, ValueError, IndexError, KeyError, struct.error):
+        pass
+    return None
+
+
+def decoded_size(file_path):
+    """Bytes needed to hold an image's decoded raster, or None if unknown."""
+    geometry = image_geometry(file_path)
+    if geometry is None:
+        return None
+    bytes_per_sample = (geometry.bits + 7) // 8
+    return geometry.width * geometry.height * geometry.samples * bytes_per_sample
+
+
+# How TIFF page 0 is encoded: Compression and Predictor tag values, tile
+# width (None for strips) and SampleFormat (1 unsigned, 2 signed, 3 float)
+TiffEncoding = namedtuple("TiffEncoding", "compression predictor tile sample_format")
+
+COMPRESSION = 259
+PREDICTOR = 317
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+
+
+def tiff_encoding(file_path):
+    """
+    Read how the first page of a TIFF is compressed and laid out from its
+    IFD. Returns None for files that are not TIFFs or are malformed.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            reader = TiffReader(f)
+            entries, _ = reader.read_ifd(reader.first_ifd)
+            values = {
+                entry.tag: reader.value(entry)[0]
+                for entry in entries
+                if entry.tag in (COMPRESSION, PREDICTOR, TILE_WIDTH, SAMPLE_FORMAT)
+            }
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+    return TiffEncoding(
+        values.get(COMPRESSION, 1),
+        values.get(PREDICTOR, 1),
+        values.get(TILE_WIDTH),
+        values.get(SAMPLE_FORMAT, 1),
+    )
@@ -0,0 +1,104 @@
+"""
+Crash-safe job journal for long runs.
+
+Each run of an operation appends JSON lines to .iw-job-<operation>.jsonl in
+the tree root: a "start" record, a "queued" record as each file is handed to a
+worker, a "done" or "failed" record as each result comes back, and an "end"
+record when the run completes. A journal without an "end" record belongs to a
+run that was killed; its queued-but-unfinished files were in progress and may
+have left temporary files behind, and its done files need not be redone when
+the run is resumed.
+
+Records are flushed as they are written, so a killed process loses nothing;
+after a power failure at most the last few records are lost, which only means
+those files are processed again.
+"""
+
+import fcntl
+import json
+import os
+import time
+
+JOURNAL_PREFIX = ".iw-job-"
+
+
+def _key(path):
+    return os.path.normpath(str(path))
+
+
+class JobJournal:
+    def __init__(self, operation, root="."):
+        self.operation = operation
+        self.path = os.path.join(root, f"{JOURNAL_PREFIX}{operation}.jsonl")
+        self.done = set()
+        self.in_progress = set()
+        self.interrupted = False
+        self.f = None
+
+    def load(self):
+        """Read the previous run's journal, if any."""
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # the record being written when the run was killed
+            event = record.get("event")
+            if event == "start":
+                self.interrupted = True
+            elif event == "end":
+                # A completed run leaves nothing to resume or recover
+                self.interrupted = False
+                self.done.clear()
+                self.in_progress.clear()
+            elif event == "queued":
+                self.in_progress.add(record["file"])
+            elif event in ("done", "failed"):
+                self.in_progress.discard(record["file"])
+                if event == "done":
+                    self.done.add(record["file"])
+
+    def open(self, resume=False):
+        """
+        Start journalling this run: take the journal, then load the previous
+        run's records. With resume they are kept, so the done set carries
+        over; otherwise the journal starts afresh. Returns False, without
+        reading anything, if another run of the operation holds the journal.
+        """
+        self.f = open(self.path, "a")
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.f.close()
+            self.f = None
+            return False
+        # Only read once locked: a live run's journal is not an interrupted one
+        self.load()
+        if not resume:
+            self.f.truncate(0)
+        self._write(event="start", time=time.time(), resume=resume)
+        return True
+
+    def _write(self, **record):
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+    def queued(self, file):
+        """Journal file as handed to a worker."""
+        self._write(event="queued", file=_key(file))
+
+    def finish(self, file, ok):
+        self._write(event="done" if ok else "failed", file=_key(file))
+
+    def close(self, processed, failed):
+        self._write(event="end", time=time.time(), processed=processed, failed=failed)
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
+
+    def is_done(self, file):
+        return _key(file) in self.done
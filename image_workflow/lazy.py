@@ -0,0 +1,44 @@
+"""
+Deferred imports of the codec libraries.
+
+numpy, Pillow, tifffile (with imagecodecs) and piexif take a few hundred
+milliseconds to import, which would dominate a one-file run of a tool or one
+that never decodes an image (iw-generate-html-gallery, iw-cache show). The
+modules that use them bind them with lazy_import() instead:
+
+    tifffile = lazy_import("tifffile")
+
+which returns a stand-in that imports the module on its first attribute
+access, so a library is loaded when a processor for its format first uses it.
+"""
+
+import importlib
+import types
+
+# Libraries imported lazily, for preload()
+CODEC_MODULES = ("numpy", "PIL.Image", "piexif", "tifffile")
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module, importing it when one of its attributes is used."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Only called for names not set on the stand-in itself
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    """Return a stand-in for module name, imported when first used."""
+    return LazyModule(name)
+
+
+def preload():
+    """Import the codec libraries now, e.g. before forking workers that use them."""
+    for name in CODEC_MODULES:
+        importlib.import_module(name)
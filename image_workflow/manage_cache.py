@@ -0,0 +1,94 @@
+import argparse
+import os
+
+from .cache import NullCache, cache_path, get_cache
+from .manifest import get_manifest
+from .metrics import RunMetrics
+from .thumbstore import get_thumbnail_store
+from .common import (
+    add_common_arguments,
+    get_existing_metadata,
+    get_sha1,
+    iterate_images,
+)
+
+EXTENSIONS = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp"]
+
+
+def cache_file(file_path):
+    """Hash a file and read its embedded metadata into the cache."""
+    cache = get_cache()
+    stat = os.stat(file_path)
+    cache.get(file_path, "metadata", get_existing_metadata, stat)
+    cache.get(file_path, "sha1", get_sha1, stat)
+
+
+def show(cache, list_entries):
+    stats = cache.stats()
+    size = os.path.getsize(cache.db_path)
+    print(f"Cache: {os.path.abspath(cache.db_path)} ({size} bytes)")
+    print(f"  entries:       {stats['entries']}")
+    print(f"  hashed:        {stats['hashed']}")
+    print(f"  with metadata: {stats['with_metadata']}")
+    manifest = get_manifest()
+    if manifest is not None:
+        print(f"  manifest:      {manifest.count()} processed (file, operation)")
+    store = get_thumbnail_store()
+    if store is not None:
+        print(
+            f"  thumbnails:    {store.count()} stored ({store.size()} bytes "
+            f"of {store.max_bytes}) in {store.root}"
+        )
+    if list_entries:
+        for path, size, sha1, metadata in cache.entries():
+            source = metadata["source_file"] if metadata else "-"
+            print(f"{sha1 or '-':40}  {size:>12}  {path}  <- {source}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Inspect, prune or rebuild the hash/metadata cache"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    show_parser = subparsers.add_parser("show", help="Print cache statistics")
+    show_parser.add_argument(
+        "--list", action="store_true", help="Also list every cached file"
+    )
+    subparsers.add_parser("prune", help="Drop entries for missing or changed files")
+    rebuild_parser = subparsers.add_parser(
+        "rebuild", help="Clear the cache and re-hash every image in the tree"
+    )
+    add_common_arguments(rebuild_parser)
+    args = parser.parse_args(argv)
+
+    cache = get_cache()
+    if isinstance(cache, NullCache):
+        print(f"Metadata cache is disabled (IW_CACHE={cache_path()})")
+        return
+
+    if args.command == "show":
+        show(cache, args.list)
+    elif args.command == "prune":
+        removed = cache.prune()
+        print(f"Pruned {removed} stale entries")
+        manifest = get_manifest()
+        if manifest is not None:
+            print(f"Pruned {manifest.prune()} manifest records of missing files")
+        store = get_thumbnail_store()
+        if store is not None:
+            store.prune()
+            print(f"Evicted {store.evict()} thumbnails over the store size limit")
+    elif args.command == "rebuild":
+        cache.clear()
+        iterate_images(
+            cache_file,
+            EXTENSIONS,
+            jobs=args.jobs,
+            max_memory=args.max_memory,
+            metrics=RunMetrics.from_args(args, "cache-rebuild"),
+        )
+        show(cache, False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Run manifest: which files each operation has already processed.
+
+For every (file, operation) pair the manifest records the file's identity after
+the operation ran (size, mtime, ctime and, when the metadata cache already
+knows it, the SHA-1) and the output it produced, if any. A re-run compares
+each file's stat against its record and only processes new or changed files.
+
+The manifest is a table in the metadata cache database (see cache.py), so it
+lives in the tree root and is disabled along with the cache by IW_CACHE=off.
+"""
+
+import os
+import sqlite3
+import time
+from collections import Counter
+
+from .cache import cache_path, get_cache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    path TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    sha1 TEXT,
+    output TEXT,
+    processed_at REAL NOT NULL,
+    PRIMARY KEY (path, operation)
+)
+"""
+
+# Reasons a file needs processing, as reported by --status
+NEW = "new"
+CHANGED = "changed"
+OUTPUT_MISSING = "output missing"
+UP_TO_DATE = "up to date"
+
+
+def _key(path):
+    return os.path.normpath(str(path))
+
+
+class RunManifest:
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self.conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Losing the last few records on power failure only means redoing them
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SCHEMA)
+
+    def state(self, path, operation):
+        """Return why path needs operation (NEW, CHANGED, ...) or UP_TO_DATE."""
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, ctime_ns, sha1, output FROM manifest "
+            "WHERE path = ? AND operation = ?",
+            (_key(path), operation),
+        ).fetchone()
+        if row is None:
+            return NEW
+        size, mtime_ns, ctime_ns, sha1, output = row
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return NEW
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            return CHANGED
+        if stat.st_ctime_ns != ctime_ns:
+            # Touched since (e.g. copied back with its mtime restored): only
+            # a hash can tell whether the contents actually changed
+            if sha1 is None or get_cache().get(path, "sha1", _sha1, stat) != sha1:
+                return CHANGED
+        if output and not os.path.exists(output):
+            return OUTPUT_MISSING
+        return UP_TO_DATE
+
+    def pending(self, files, operation, skipped):
+        """
+        Yield the files that need operation; up-to-date files are appended to
+        the skipped list instead.
+        """
+        for file in files:
+            if self.state(file, operation) == UP_TO_DATE:
+                skipped.append(file)
+            else:
+                yield file
+
+    def record(self, path, operation, output=None):
+        """Record that operation has processed path, as the file is now."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        sha1 = get_cache().peek(path, "sha1", stat)
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO manifest "
+                "(path, operation, size, mtime_ns, ctime_ns, sha1, output, "
+                "processed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    _key(path),
+                    operation,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    stat.st_ctime_ns,
+                    sha1,
+                    str(output) if output is not None else None,
+                    time.time(),
+                ),
+            )
+        except sqlite3.Error as e:
+            print(f"Could not update run manifest for {path}: {e}")
+
+    def forget(self, path, operation):
+        """Drop the records of path for operation and its variants."""
+        try:
+            self.conn.execute(
+                "DELETE FROM manifest WHERE path = ? "
+                "AND (operation = ? OR operation LIKE ?)",
+                (_key(path), operation, f"{operation}-%"),
+            )
+        except sqlite3.Error as e:
+            print(f"Could not update run manifest for {path}: {e}")
+
+    def status(self, files, operation):
+        """Print what a run of operation would do, and return the counts."""
+        counts = Counter()
+        for file in files:
+            state = self.state(file, operation)
+            counts[state] += 1
+            if state != UP_TO_DATE:
+                print(f"{state:>15}: {file}")
+        pending = sum(n for state, n in counts.items() if state != UP_TO_DATE)
+        print(
+            f"{operation}: {pending} files to process, "
+            f"{counts[UP_TO_DATE]} up to date"
+        )
+        return counts
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM manifest").fetchone()[0]
+
+    def prune(self):
+        """Drop records of files that no longer exist. Returns the count."""
+        paths = [
+            row[0] for row in self.conn.execute("SELECT DISTINCT path FROM manifest")
+        ]
+        missing = [(path,) for path in paths if not os.path.exists(path)]
+        self.conn.executemany("DELETE FROM manifest WHERE path = ?", missing)
+        return len(missing)
+
+    def clear(self):
+        self.conn.execute("DELETE FROM manifest")
+
+
+def _sha1(path):
+    # Imported here because common imports this module
+    from .common import get_sha1
+
+    return get_sha1(path)
+
+
+_manifests = {}
+
+
+def get_manifest():
+    """
+    Return this process's manifest for the current tree, or None when the
+    cache database is disabled (IW_CACHE=off) or cannot be opened.
+    """
+    path = cache_path()
+    if path == "off":
+        return None
+    key = (os.getpid(), os.path.abspath(path))
+    if key not in _manifests:
+        try:
+            _manifests[key] = RunManifest(path)
+        except sqlite3.Error as e:
+            print(f"Run manifest disabled ({path}: {e})")
+            _manifests[key] = None
+    return _manifests[key]
@@ -0,0 +1,241 @@
+"""
+Per-stage timing of the tools' hot paths.
+
+Code wraps the expensive steps it performs on a file in a stage timer:
+
+    with timed("sha1") as stage:
+        ...
+        stage.bytes_read += len(chunk)
+
+Timers cost almost nothing unless a run collects metrics (--metrics or
+--metrics-file). Then iterate_images runs each file through measured(), which
+returns the file's per-stage totals along with its result, even from a worker
+process, and RunMetrics aggregates them into p50/p95/p99 durations per stage.
+Stages may nest, e.g. "sha1" runs inside "compress"; a stage's time includes
+the stages inside it. The "file" stage is the whole time spent on a file.
+Lossy encoding stages may also record the PSNR of their output (stage.psnr),
+reported as its mean over the run.
+
+The thumbnail tools always collect their encode stages, to end the run with the
+size of the thumbnails each encoding produced; only --metrics adds the timing
+table and the PSNR, which costs decoding every thumbnail again.
+"""
+
+import json
+import math
+import time
+from collections import defaultdict, namedtuple
+
+# Totals of one stage for one file; psnr is the sum over its calls, in dB
+Sample = namedtuple(
+    "Sample", "stage seconds calls bytes_read bytes_written psnr", defaults=(0.0,)
+)
+
+# Result of a file processed by measured(): func's result and its samples
+Measured = namedtuple("Measured", "result samples")
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_collecting = False
+_psnr = False
+_stages = {}
+
+
+class _Stage:
+    __slots__ = ("name", "started", "bytes_read", "bytes_written", "psnr")
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.psnr = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if not _collecting:
+            return
+        seconds = time.perf_counter() - self.started
+        total = _stages.get(self.name)
+        if total is None:
+            total = _stages[self.name] = [0.0, 0, 0, 0, 0.0]
+        total[0] += seconds
+        total[1] += 1
+        total[2] += self.bytes_read
+        total[3] += self.bytes_written
+        total[4] += self.psnr
+
+
+def timed(stage):
+    """Context manager timing one stage of the current file's processing."""
+    return _Stage(stage)
+
+
+def collecting():
+    """Whether the current file's stages are being measured."""
+    return _collecting
+
+
+def measuring_psnr():
+    """Whether encoding stages should record the PSNR of their output."""
+    return _collecting and _psnr
+
+
+def measured(func, file, psnr=True):
+    """
+    Run func(file), collecting its stage timings, and with psnr the quality
+    of its encodes; returns a Measured.
+    """
+    global _collecting, _psnr
+    _stages.clear()
+    _collecting = True
+    _psnr = psnr
+    try:
+        with timed("file"):
+            result = func(file)
+    finally:
+        _collecting = False
+    samples = [Sample(name, *total) for name, total in _stages.items()]
+    return Measured(result, samples)
+
+
+def _quantile(values, q):
+    """Nearest-rank quantile of sorted values."""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class RunMetrics:
+    """Per-file stage samples of one run, with summary and export."""
+
+    def __init__(self, operation, path=None, fmt=None, detailed=True):
+        self.operation = operation
+        self.path = path
+        self.fmt = fmt or ("prometheus" if str(path).endswith(".prom") else "jsonl")
+        # Without detail only the encoding summary is reported, without PSNR
+        self.detailed = detailed
+        self.files = []
+
+    @classmethod
+    def from_args(cls, args, operation, encodes=False):
+        """
+        RunMetrics for a run with add_common_arguments' options, or None. Runs
+        that encode thumbnails always get one, for their encoding summary.
+        """
+        if not (args.metrics or args.metrics_file):
+            return cls(operation, detailed=False) if encodes else None
+        return cls(operation, args.metrics_file, args.metrics_format)
+
+    def add(self, file, samples):
+        self.files.append((str(file), samples))
+
+    def summary(self):
+        """
+        Return {stage: {count, total_s, p50_s, ..., bytes_read, bytes_written}},
+        plus the mean psnr_db of the stages that record it.
+        """
+        seconds = defaultdict(list)
+        read = defaultdict(int)
+        written = defaultdict(int)
+        calls = defaultdict(int)
+        psnr = defaultdict(float)
+        for _, samples in self.files:
+            for sample in samples:
+                seconds[sample.stage].append(sample.seconds)
+                read[sample.stage] += sample.bytes_read
+                written[sample.stage] += sample.bytes_written
+                calls[sample.stage] += sample.calls
+                psnr[sample.stage] += sample.psnr
+        summary = {}
+        for stage, values in seconds.items():
+            values.sort()
+            summary[stage] = {
+                "count": len(values),
+                "total_s": sum(values),
+                **{f"p{round(q * 100)}_s": _quantile(values, q) for q in QUANTILES},
+                "bytes_read": read[stage],
+                "bytes_written": written[stage],
+            }
+            if psnr[stage]:
+                summary[stage]["psnr_db"] = psnr[stage] / calls[stage]
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if not summary:
+            return
+        if self.detailed:
+            print(
+                f"{'stage':<16}{'files':>7}{'total':>10}"
+                f"{'p50':>10}{'p95':>10}{'p99':>10}"
+            )
+            for stage, s in sorted(
+                summary.items(), key=lambda item: -item[1]["total_s"]
+            ):
+                print(
+                    f"{stage:<16}{s['count']:>7}{s['total_s']:>9.2f}s"
+                    f"{s['p50_s'] * 1000:>8.1f}ms{s['p95_s'] * 1000:>8.1f}ms"
+                    f"{s['p99_s'] * 1000:>8.1f}ms"
+                )
+        # Size against quality of the thumbnail encodes
+        for stage, s in sorted(summary.items()):
+            if not stage.startswith("encode-") or not s["bytes_written"]:
+                continue
+            quality = f", mean PSNR {s['psnr_db']:.1f} dB" if "psnr_db" in s else ""
+            print(
+                f"{stage}: {s['bytes_written'] / 1e3:.1f} kB from "
+                f"{s['bytes_read'] / 1e3:.1f} kB of pixels "
+                f"({s['bytes_read'] / s['bytes_written']:.1f}x){quality}"
+            )
+
+    def export(self):
+        if not self.path:
+            return
+        with open(self.path, "w") as f:
+            if self.fmt == "prometheus":
+                f.write(self.prometheus())
+            else:
+                self.write_jsonl(f)
+        print(f"Metrics written to {self.path}")
+
+    def write_jsonl(self, f):
+        """One line per file and stage, then one summary line per stage."""
+        for file, samples in self.files:
+            for sample in samples:
+                record = {"operation": self.operation, "file": file}
+                record.update(sample._asdict())
+                f.write(json.dumps(record) + "\n")
+        for stage, s in self.summary().items():
+            record = {"operation": self.operation, "summary": stage}
+            record.update(s)
+            f.write(json.dumps(record) + "\n")
+
+    def prometheus(self):
+        """The summary in the Prometheus text exposition format."""
+        lines = [
+            "# HELP iw_stage_seconds Time spent on one file in a stage.",
+            "# TYPE iw_stage_seconds summary",
+        ]
+        summary = self.summary()
+        for stage, s in summary.items():
+            labels = f'operation="{self.operation}",stage="{stage}"'
+            for q in QUANTILES:
+                value = s[f"p{round(q * 100)}_s"]
+                lines.append(f'iw_stage_seconds{{{labels},quantile="{q}"}} {value}')
+            lines.append(f"iw_stage_seconds_sum{{{labels}}} {s['total_s']}")
+            lines.append(f"iw_stage_seconds_count{{{labels}}} {s['count']}")
+        for name, key in (("read", "bytes_read"), ("written", "bytes_written")):
+            lines.append(f"# HELP iw_stage_bytes_{name}_total Bytes {name} in a stage.")
+            lines.append(f"# TYPE iw_stage_bytes_{name}_total counter")
+            for stage, s in summary.items():
+                labels = f'operation="{self.operation}",stage="{stage}"'
+                lines.append(f"iw_stage_bytes_{name}_total{{{labels}}} {s[key]}")
+        encoded = {stage: s for stage, s in summary.items() if "psnr_db" in s}
+        if encoded:
+            lines.append("# HELP iw_stage_psnr_db Mean PSNR of a stage's output.")
+            lines.append("# TYPE iw_stage_psnr_db gauge")
+            for stage, s in encoded.items():
+                labels = f'operation="{self.operation}",stage="{stage}"'
+                lines.append(f"iw_stage_psnr_db{{{labels}}} {s['psnr_db']}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,250 @@
+"""
+Run several operations over the tree in a single pass.
+
+  iw-pipeline add-thumbnails compress extract-thumbnails gallery
+
+Each file is visited once. The stages that change an image (add-thumbnails,
+compress) only decide what to do; the file is then written once, so a TIFF
+that gets both a thumbnail and compression (as iw-compress-tiffs' options say)
+is read and rewritten a single time. Only thumbnail sizes added to --sizes
+since an image got its thumbnail are added by a write of their own. The stages
+that produce output from an image (extract-thumbnails) run after that write and
+reuse the thumbnail built for it instead of reading it back. The gallery only
+needs file names, so it is written at the end from a stat-only walk of the
+tree.
+"""
+
+import argparse
+import functools
+from pathlib import Path
+
+from .common import (
+    ALL_SUPPORTED_EXTENSIONS,
+    add_common_arguments,
+    DEFAULT_SIZES,
+    add_manifest_arguments,
+    add_sizes_argument,
+    add_thumbnail,
+    build_thumbnails,
+    get_provenance,
+    iterate_images,
+    missing_thumbnail_sizes,
+    probe_thumbnail,
+    walk_images,
+)
+from .add_thumbnails import add_thumbnails_if_needed
+from .compress_tiffs import (
+    LZW,
+    add_compression_arguments,
+    compress_tiff,
+    is_compressed,
+    operation_name,
+    settings_from_args,
+)
+from .encoders import (
+    DEFAULT_ENCODING,
+    add_encoding_arguments,
+    encoding_from_args,
+    tiff_thumbnail,
+)
+from .extract_thumbnails import extract_thumbnail_to_dir
+from .generate_html_gallery import generate_gallery_item, write_gallery
+from .metrics import RunMetrics
+from .tiffio import DEFAULT_BUFFER_SIZE
+
+# Stages that change the image, and stages that only read it, in the order
+# they may appear on the command line
+WRITE_STAGES = ("add-thumbnails", "compress")
+OUTPUT_STAGES = ("extract-thumbnails", "gallery")
+STAGES = WRITE_STAGES + OUTPUT_STAGES
+
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+
+class FileContext:
+    """What the stages of a pipeline know about one file, and plan to do to it."""
+
+    def __init__(self, file_path, sizes=DEFAULT_SIZES, encoding=DEFAULT_ENCODING):
+        self.path = Path(file_path)
+        self.sizes = sizes
+        self.encoding = encoding
+        self.is_tiff = self.path.suffix.lower() in TIFF_EXTENSIONS
+        self.probe = probe_thumbnail(self.path)
+        self._provenance = None
+        # Thumbnail images built by add-thumbnails, one per size, to be
+        # embedded by the write
+        self.thumbnails = None
+        # Whether the image already has its thumbnail but not every size
+        self.add_sizes = False
+        self.compress = False
+
+    @property
+    def provenance(self):
+        if self._provenance is None:
+            self._provenance = get_provenance(self.path)
+        return self._provenance
+
+
+def _add_thumbnails(ctx, keep_aspect):
+    if not ctx.probe.has_thumbnail:
+        ctx.thumbnails = build_thumbnails(ctx.path, ctx.sizes, keep_aspect)
+    else:
+        ctx.add_sizes = bool(missing_thumbnail_sizes(ctx.path, ctx.sizes))
+
+
+def _compress(ctx, settings):
+    # A file already compressed so only needs rewriting if it gets a
+    # thumbnail, which the write does without recompressing it
+    ctx.compress = ctx.is_tiff and not is_compressed(ctx.path, settings)
+
+
+def _write(ctx, buffer_size, settings):
+    """Apply the write stages' plan to the file in a single write."""
+    if ctx.compress:
+        thumbs = None
+        if ctx.thumbnails is not None:
+            thumbs = [tiff_thumbnail(thumb, ctx.encoding) for thumb in ctx.thumbnails]
+        return compress_tiff(
+            ctx.path,
+            buffer_size=buffer_size,
+            thumbnails=thumbs,
+            provenance=ctx.provenance,
+            settings=settings,
+        )
+    if ctx.thumbnails is not None:
+        return add_thumbnail(
+            ctx.path,
+            probe=ctx.probe,
+            thumbnails=ctx.thumbnails,
+            sizes=ctx.sizes,
+            encoding=ctx.encoding,
+        )
+    return True
+
+
+def _extract_thumbnails(ctx):
+    # Thumbnails just built are saved as is, without reading them back
+    return extract_thumbnail_to_dir(
+        ctx.path, thumbnails=ctx.thumbnails, sizes=ctx.sizes, encoding=ctx.encoding
+    )
+
+
+def run_stages(
+    file_path,
+    stages,
+    keep_aspect=False,
+    buffer_size=None,
+    sizes=DEFAULT_SIZES,
+    encoding=DEFAULT_ENCODING,
+    settings=LZW,
+):
+    """
+    Run the per-file stages on one file, compressing as settings (a
+    CompressionSettings) say; returns False if any failed.
+    """
+    ctx = FileContext(file_path, sizes, encoding)
+    if "add-thumbnails" in stages:
+        _add_thumbnails(ctx, keep_aspect)
+    if "compress" in stages:
+        _compress(ctx, settings)
+    if _write(ctx, buffer_size, settings) is False:
+        return False
+    if ctx.add_sizes and not add_thumbnails_if_needed(
+        ctx.path, keep_aspect=keep_aspect, sizes=sizes, encoding=encoding
+    ):
+        return False
+    if "extract-thumbnails" in stages and _extract_thumbnails(ctx) is False:
+        return False
+    return True
+
+
+def pipeline_operation(stages, settings=LZW):
+    """
+    Run manifest operation of a pipeline, e.g. pipeline-add-thumbnails+compress,
+    naming the compression if it is not LZW (pipeline-compress-zstd-l9).
+    """
+    compress = operation_name(settings)
+    if compress == operation_name(LZW):
+        compress = "compress"
+    names = [compress if stage == "compress" else stage for stage in stages]
+    return "pipeline-" + "+".join(names)
+
+
+def check_stages(stages):
+    """Return an error message if stages are repeated or out of order."""
+    if len(set(stages)) != len(stages):
+        return "each stage may only be given once"
+    seen_output = False
+    for stage in stages:
+        if stage in OUTPUT_STAGES:
+            seen_output = True
+        elif seen_output:
+            return "add-thumbnails and compress must come before the output stages"
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run several operations over the images in a single pass"
+    )
+    parser.add_argument(
+        "stages", nargs="+", choices=STAGES, help="Stages to run, in order"
+    )
+    parser.add_argument(
+        "--keep-aspect",
+        action="store_true",
+        help="Fit thumbnails within their size instead of stretching them to it",
+    )
+    add_sizes_argument(parser)
+    add_encoding_arguments(parser)
+    add_compression_arguments(parser)
+    parser.add_argument(
+        "--buffer-size",
+        type=int,
+        default=DEFAULT_BUFFER_SIZE // (1024 * 1024),
+        help="Raster memory per file in MiB; larger images are streamed in tiles",
+    )
+    add_common_arguments(parser)
+    add_manifest_arguments(parser)
+    args = parser.parse_args(argv)
+
+    error = check_stages(args.stages)
+    if error:
+        parser.error(error)
+    encoding = encoding_from_args(parser, args)
+    settings = settings_from_args(parser, args)
+
+    file_stages = [stage for stage in args.stages if stage != "gallery"]
+    if file_stages:
+        func = functools.partial(
+            run_stages,
+            stages=file_stages,
+            keep_aspect=args.keep_aspect,
+            buffer_size=args.buffer_size * 1024 * 1024,
+            sizes=args.sizes,
+            encoding=encoding,
+            settings=settings,
+        )
+        operation = pipeline_operation(file_stages, settings)
+        iterate_images(
+            func,
+            list(ALL_SUPPORTED_EXTENSIONS),
+            jobs=args.jobs,
+            max_memory=args.max_memory,
+            operation=operation,
+            force=args.force,
+            status=args.status,
+            resume=args.resume,
+            watch=args.watch,
+            metrics=RunMetrics.from_args(args, operation, encodes=True),
+        )
+
+    if "gallery" in args.stages and not args.status:
+        extensions = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp"]
+        write_gallery(
+            generate_gallery_item(file) for file in walk_images(".", extensions)
+        )
+
+
+if __name__ == "__main__":
+    main()
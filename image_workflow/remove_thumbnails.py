@@ -1,21 +1,43 @@
+import argparse
+
 from .common import (
-    has_thumbnail,
+    add_common_arguments,
+    add_manifest_arguments,
     iterate_images,
+    probe_thumbnail,
     remove_thumbnail,
     ALL_SUPPORTED_EXTENSIONS,
 )
+from .metrics import RunMetrics
 
 
 def remove_thumbnails_if_needed(file_path):
-    if has_thumbnail(file_path):
-        remove_thumbnail(file_path)
-    else:
-        print(f"No thumbnail to remove for {file_path}")
+    probe = probe_thumbnail(file_path)
+    if probe.has_thumbnail:
+        return remove_thumbnail(file_path, probe=probe)
+    print(f"No thumbnail to remove for {file_path}")
+    return True
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove thumbnails from images")
+    add_common_arguments(parser)
+    add_manifest_arguments(parser)
+    args = parser.parse_args(argv)
 
-def main():
     extensions = list(ALL_SUPPORTED_EXTENSIONS)
-    iterate_images(remove_thumbnails_if_needed, extensions)
+    iterate_images(
+        remove_thumbnails_if_needed,
+        extensions,
+        jobs=args.jobs,
+        max_memory=args.max_memory,
+        operation="remove-thumbnail",
+        force=args.force,
+        status=args.status,
+        resume=args.resume,
+        watch=args.watch,
+        metrics=RunMetrics.from_args(args, "remove-thumbnail"),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+Content-addressed thumbnail store shared by the tools.
+
+Every thumbnail the tools extract from an image or generate for it is kept in
+.iw-thumbnails/ next to the cache database, named after the SHA-1 of the source
+image and the parameters it was made with (thumbnails kept in sidecars are not,
+as a sidecar can be replaced while the image, and so its SHA-1, stays the same):
+
+    .iw-thumbnails/3f/3f2a...9c-embedded.jpg     thumbnail embedded in the image
+    .iw-thumbnails/3f/3f2a...9c-256x256.png      generated, stretched to 256x256
+    .iw-thumbnails/3f/3f2a...9c-fit256x256.png   generated, fitting in 256x256
+
+so the same image is only decoded once however many copies of it there are and
+however often it is processed. Only images whose SHA-1 is already in the cache
+(from their provenance record, or iw-cache rebuild) use the store: hashing an
+image just for it would read more than the decode it saves. An index table in
+the cache database records each object's size and when it was last used; once
+the store grows past $IW_THUMB_STORE_SIZE (default 1G) the least recently used
+objects are evicted. The store is disabled along with the cache by IW_CACHE=off.
+"""
+
+import os
+import sqlite3
+import time
+
+from .cache import cache_path
+
+STORE_DIRNAME = ".iw-thumbnails"
+
+DEFAULT_MAX_BYTES = 1024**3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thumbnails (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    used_at REAL NOT NULL
+)
+"""
+
+
+class ThumbnailStore:
+    def __init__(self, root, db_path, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(str(db_path), timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(SCHEMA)
+
+    def object_path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def lookup(self, sha1, params):
+        """Return the stored thumbnail of the image with sha1, or None."""
+        name = f"{sha1}-{params}"
+        path = self.object_path(name)
+        if not os.path.isfile(path):
+            return None
+        try:
+            self.conn.execute(
+                "UPDATE thumbnails SET used_at = ? WHERE name = ?", (time.time(), name)
+            )
+        except sqlite3.Error:
+            pass  # only costs the object its place in the LRU order
+        return path
+
+    def add(self, sha1, params, produce):
+        """
+        Store a thumbnail of the image with sha1: produce(path) writes it to
+        path and returns False if it cannot. Returns the stored path or None.
+        """
+        name = f"{sha1}-{params}"
+        path = self.object_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Workers storing the same image at once each write their own file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            if produce(tmp_path) is False or not os.path.isfile(tmp_path):
+                return None
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO thumbnails (name, size, used_at) "
+                "VALUES (?, ?, ?)",
+                (name, size, time.time()),
+            )
+            self.evict()
+        except sqlite3.Error as e:
+            print(f"Could not update thumbnail store index for {path}: {e}")
+        return path
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used objects until the store fits. Returns the
+        count.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        total = self.size()
+        if total <= max_bytes:
+            return 0
+        evicted = []
+        for name, size in self.conn.execute(
+            "SELECT name, size FROM thumbnails ORDER BY used_at"
+        ).fetchall():
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(self.object_path(name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted.append((name,))
+        self.conn.executemany("DELETE FROM thumbnails WHERE name = ?", evicted)
+        return len(evicted)
+
+    def size(self):
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM thumbnails"
+        ).fetchone()[0]
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM thumbnails").fetchone()[0]
+
+    def prune(self):
+        """Drop index records of objects deleted from disk. Returns the count."""
+        names = [row[0] for row in self.conn.execute("SELECT name FROM thumbnails")]
+        missing = [
+            (name,) for name in names if not os.path.isfile(self.object_path(name))
+        ]
+        self.conn.executemany("DELETE FROM thumbnails WHERE name = ?", missing)
+        return len(missing)
+
+    def clear(self):
+        """Remove every stored thumbnail."""
+        self.evict(max_bytes=0)
+
+
+def store_max_bytes():
+    """Size limit of the store: $IW_THUMB_STORE_SIZE (e.g. "512M"), else 1G."""
+    # Imported here because common imports this module
+    from .common import parse_size
+
+    value = os.environ.get("IW_THUMB_STORE_SIZE")
+    return parse_size(value) if value else DEFAULT_MAX_BYTES
+
+
+_stores = {}
+
+
+def get_thumbnail_store():
+    """
+    Return this process's thumbnail store for the current tree, or None when
+    the cache database is disabled (IW_CACHE=off) or cannot be opened.
+    """
+    path = cache_path()
+    if path == "off":
+        return None
+    key = (os.getpid(), os.path.abspath(path))
+    if key not in _stores:
+        root = os.path.join(os.path.dirname(os.path.abspath(path)), STORE_DIRNAME)
+        try:
+            _stores[key] = ThumbnailStore(root, path, store_max_bytes())
+        except sqlite3.Error as e:
+            print(f"Thumbnail store disabled ({path}: {e})")
+            _stores[key] = None
+    return _stores[key]
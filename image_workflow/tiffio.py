@@ -0,0 +1,520 @@
+"""
+Bounded-memory rewriting of TIFF pages.
+
+Rewriting a TIFF used to mean tif.asarray() followed by TiffWriter.write(),
+which needs the whole decoded raster (4+ GB for a large scan) in memory.
+write_page() instead streams page 0 from the source into a TiffWriter:
+
+* pages smaller than the buffer are simply read and written as before;
+* when the compression is kept, encoded strips/tiles are copied verbatim
+  (uncompressed pages are memory-mapped and re-striped into buffer-sized
+  strips, so a single huge strip never has to be read at once);
+* when recompressing, decoded segments are assembled into bands of rows and
+  written as tiles, which tifffile encodes one tile at a time.
+
+shrink_page() reads a page the same way to build a thumbnail of it, shrinking
+each band of rows as it is decoded.
+
+append_subifds() avoids the rewrite altogether when only a thumbnail is added.
+"""
+
+import json
+import os
+import struct
+from collections import namedtuple
+
+from .headers import TIFF_TYPES, TiffReader
+from .lazy import lazy_import
+from .metrics import timed
+
+np = lazy_import("numpy")
+tifffile = lazy_import("tifffile")
+
+# Upper bound on the raster data held in memory per rewrite (bytes)
+DEFAULT_BUFFER_SIZE = int(os.environ.get("IW_TIFF_BUFFER_SIZE", 64 * 1024 * 1024))
+
+# Tile edge used when a recompressed page is streamed
+STREAM_TILE = 256
+
+# Classic TIFF offsets are 32 bit; leave headroom for IFDs and thumbnails
+BIGTIFF_THRESHOLD = 2**32 - 2**25
+
+# Sidecar recording how to undo an unfinished in-place append
+JOURNAL_SUFFIX = ".iw-journal"
+
+# Tags written by append_subifds
+NEW_SUBFILE_TYPE = 254
+IMAGE_DESCRIPTION = 270
+SUBIFDS = 330
+YCBCR_SUBSAMPLING = 530
+
+# A thumbnail encoded as a single JPEG strip (the complete stream), as
+# written by append_subifds and write_thumbnail. subsampling is the
+# (horizontal, vertical) chroma subsampling of YCbCr data, None for grayscale.
+JpegThumbnail = namedtuple("JpegThumbnail", "data width height samples subsampling")
+
+
+def needs_bigtiff(nbytes):
+    """Whether a file of about nbytes must be written as BigTIFF."""
+    return nbytes > BIGTIFF_THRESHOLD
+
+
+def page_resolution(page):
+    """Return (xres, yres, unit) of a page, or None if it has no resolution."""
+    if "XResolution" in page.tags and "YResolution" in page.tags:
+        xres = page.tags["XResolution"].value
+        yres = page.tags["YResolution"].value
+        unit = page.tags["ResolutionUnit"].value if "ResolutionUnit" in page.tags else 2
+        return (xres, yres, unit)
+    return None
+
+
+def _layout_args(page):
+    """Writer arguments describing the pixel layout of page."""
+    args = {
+        "shape": page.shape,
+        "dtype": page.dtype,
+        "photometric": page.photometric,
+        "planarconfig": page.planarconfig,
+    }
+    if page.extrasamples:
+        args["extrasamples"] = page.extrasamples
+    if page.colormap is not None:
+        args["colormap"] = page.colormap
+    return args
+
+
+def jpeg_stream(tif, page):
+    """
+    Return the complete JPEG stream of a JPEG-compressed single-strip page,
+    or None if the page cannot be copied without decoding it. Shared
+    JPEGTables are merged back into the stream.
+    """
+    if page.compression != tifffile.COMPRESSION.JPEG or page.is_tiled:
+        return None
+    if len(page.dataoffsets) != 1:
+        return None
+    # Without an Adobe marker decoders assume 3-channel JPEGs are YCbCr
+    if page.photometric not in (
+        tifffile.PHOTOMETRIC.YCBCR,
+        tifffile.PHOTOMETRIC.MINISBLACK,
+    ):
+        return None
+    tif.filehandle.seek(page.dataoffsets[0])
+    data = tif.filehandle.read(page.databytecounts[0])
+    if page.jpegtables:
+        # Tables end with EOI and the strip starts with SOI
+        data = page.jpegtables[:-2] + data[2:]
+    return data
+
+
+def read_thumbnail(tif, page):
+    """
+    Return a thumbnail page as a JpegThumbnail if it is a single JPEG strip,
+    which is then copied as is, else as an array.
+    """
+    data = jpeg_stream(tif, page)
+    if data is None:
+        return page.asarray()
+    subsampling = page.subsampling if page.samplesperpixel == 3 else None
+    return JpegThumbnail(
+        data, page.imagewidth, page.imagelength, page.samplesperpixel, subsampling
+    )
+
+
+def write_thumbnail(writer, thumb, compression="LZW"):
+    """
+    Write a thumbnail (an array, or a JpegThumbnail copied as is) as the next
+    SubIFD of writer; arrays are compressed with compression.
+    """
+    if isinstance(thumb, JpegThumbnail):
+        shape = (thumb.height, thumb.width)
+        if thumb.samples > 1:
+            shape += (thumb.samples,)
+        writer.write(
+            iter([thumb.data]),
+            shape=shape,
+            dtype="uint8",
+            photometric="ycbcr" if thumb.subsampling else "minisblack",
+            subsampling=thumb.subsampling,
+            compression="jpeg",
+            rowsperstrip=thumb.height,
+            subfiletype=1,
+        )
+        return
+    writer.write(
+        thumb,
+        photometric="rgb" if thumb.ndim == 3 else "minisblack",
+        subfiletype=1,
+        compression=compression,
+    )
+
+
+def _read_segments(fh, page):
+    """Yield the encoded strips/tiles of page one at a time."""
+    for offset, bytecount in zip(page.dataoffsets, page.databytecounts):
+        if not bytecount:
+            yield b""
+            continue
+        fh.seek(offset)
+        yield fh.read(bytecount)
+
+
+def _rows_per_buffer(page, buffer_size):
+    row_bytes = max(1, page.nbytes // page.shape[0])
+    return max(1, buffer_size // row_bytes)
+
+
+def _memmap_strips(page, rows):
+    """Yield uncompressed strips of rows rows from a memory map of page."""
+    data = page.asarray(out="memmap")
+    try:
+        for start in range(0, data.shape[0], rows):
+            yield data[start : start + rows].tobytes()
+    finally:
+        del data
+
+
+def _row_bands(page, buffer_size):
+    """Yield consecutive bands of decoded rows of a contiguous page, in order."""
+    if page.is_memmappable:
+        data = page.asarray(out="memmap")
+        rows = _rows_per_buffer(page, buffer_size)
+        for start in range(0, data.shape[0], rows):
+            yield np.array(data[start : start + rows])
+        return
+
+    height = page.shape[0]
+    band = None
+    band_top = 0
+    for segment, indices, _ in page.segments(sort=True):
+        # indices are (sample, depth, row, column, 0) of the segment
+        top, left = indices[2], indices[3]
+        segment = segment.reshape(segment.shape[-3:])
+        if page.ndim == 2:
+            segment = segment[..., 0]
+        if band is not None and top != band_top:
+            yield band
+            band = None
+        if band is None:
+            band_top = top
+            band_rows = min(segment.shape[0], height - top)
+            band = np.empty((band_rows,) + page.shape[1:], page.dtype)
+        width = min(segment.shape[1], page.shape[1] - left)
+        band[:, left : left + width] = segment[: band.shape[0], :width]
+    if band is not None:
+        yield band
+
+
+def _tiles(bands, tile):
+    """Regroup row bands into tiles of tile x tile pixels, in row-major order."""
+    pending = None
+    for band in bands:
+        pending = band if pending is None else np.concatenate([pending, band])
+        while pending.shape[0] >= tile:
+            for left in range(0, pending.shape[1], tile):
+                yield pending[:tile, left : left + tile]
+            pending = pending[tile:]
+    if pending is not None and pending.shape[0]:
+        # tifffile zero-pads incomplete tiles at the bottom edge
+        for left in range(0, pending.shape[1], tile):
+            yield pending[:, left : left + tile]
+
+
+def _box_reduce(band, factor, width):
+    """Average factor x factor blocks of band, whose height is a multiple of factor."""
+    rows = band.shape[0] // factor
+    blocks = band[:, : width * factor].reshape(
+        (rows, factor, width, factor) + band.shape[2:]
+    )
+    reduced = blocks.mean(axis=(1, 3))
+    if np.issubdtype(band.dtype, np.integer):
+        reduced = reduced.round()
+    return reduced.astype(band.dtype)
+
+
+def shrink_page(page, size, buffer_size=None):
+    """
+    Return page reduced by the largest integer factor that keeps it at least
+    size (width, height), decoded band by band and each band averaged down as
+    it is read, so memory holds one band and the reduced image rather than the
+    whole raster. Returns None if the page is no larger than the buffer (or is
+    planar-separate), so can simply be decoded whole.
+    """
+    if buffer_size is None:
+        buffer_size = DEFAULT_BUFFER_SIZE
+    contiguous = page.planarconfig == 1 or page.samplesperpixel == 1
+    if page.nbytes <= buffer_size or not contiguous:
+        return None
+    height, width = page.shape[:2]
+    factor = max(1, min(width // size[0], height // size[1]))
+    reduced = []
+    pending = None
+    for band in _row_bands(page, buffer_size):
+        pending = band if pending is None else np.concatenate([pending, band])
+        usable = pending.shape[0] // factor * factor
+        if usable:
+            reduced.append(_box_reduce(pending[:usable], factor, width // factor))
+            pending = pending[usable:]
+    return np.concatenate(reduced)
+
+
+def write_page(
+    writer, tif, page, compression=None, buffer_size=None, tile=None, **kwargs
+):
+    """
+    Write page (read from tif) to writer without holding its whole raster.
+    compression=None keeps the page's compression and predictor; any other
+    value recompresses the image data with it, unless the page is already
+    encoded that way (same compression and predictor, no compressionargs,
+    and tiles of tile x tile pixels if tile is given).
+    A recompressed page is written in tiles of tile x tile pixels if tile is
+    given, else in strips; pages streamed through the buffer are always
+    tiled. Remaining keyword arguments (description, subifds, resolution,
+    predictor, compressionargs, maxworkers, ...) are passed to
+    TiffWriter.write.
+    """
+    with timed("tiff-write") as stage:
+        stage.bytes_read = sum(page.databytecounts)
+        _write_page(writer, tif, page, compression, buffer_size, tile, **kwargs)
+
+
+def _same_encoding(page, compression, tile, kwargs):
+    predictor = kwargs.get("predictor") or 1
+    return (
+        compression == page.compression
+        and predictor == page.predictor
+        and "compressionargs" not in kwargs
+        and (not tile or (page.tilewidth, page.tilelength) == (tile, tile))
+    )
+
+
+def _write_page(writer, tif, page, compression, buffer_size, tile, **kwargs):
+    if buffer_size is None:
+        buffer_size = DEFAULT_BUFFER_SIZE
+    keep = compression is None or _same_encoding(page, compression, tile, kwargs)
+    if keep:
+        kwargs.pop("predictor", None)
+    elif tile:
+        kwargs["tile"] = (tile, tile)
+    layout = _layout_args(page)
+    contiguous = page.planarconfig == 1 or page.samplesperpixel == 1
+
+    if page.nbytes <= buffer_size or not contiguous:
+        # Small (or planar-separate) pages are read whole as before
+        if keep:
+            kwargs.setdefault(
+                "predictor", page.predictor if page.predictor > 1 else None
+            )
+        writer.write(
+            page.asarray(),
+            compression=page.compression if keep else compression,
+            **{k: v for k, v in layout.items() if k not in ("shape", "dtype")},
+            **kwargs,
+        )
+        return
+
+    if keep and page.compression == 1 and page.is_memmappable:
+        rows = _rows_per_buffer(page, buffer_size)
+        writer.write(_memmap_strips(page, rows), rowsperstrip=rows, **layout, **kwargs)
+    elif keep:
+        if page.is_tiled:
+            kwargs["tile"] = (page.tilelength, page.tilewidth)
+        else:
+            kwargs["rowsperstrip"] = page.rowsperstrip
+        if page.jpegtables is not None:
+            kwargs["jpegtables"] = page.jpegtables
+        writer.write(
+            _read_segments(tif.filehandle, page),
+            compression=page.compression,
+            predictor=page.predictor if page.predictor > 1 else None,
+            **layout,
+            **kwargs,
+        )
+    else:
+        tile = tile or STREAM_TILE
+        kwargs["tile"] = (tile, tile)
+        writer.write(
+            _tiles(_row_bands(page, buffer_size), tile),
+            compression=compression,
+            **layout,
+            **kwargs,
+        )
+
+
+class _Appender:
+    """Collect data to be appended at the (word aligned) end of a file."""
+
+    def __init__(self, f):
+        f.seek(0, os.SEEK_END)
+        self.size = f.tell()
+        self.start = self.size + (self.size & 1)
+        self.buf = bytearray(self.start - self.size)
+
+    def add(self, data):
+        """Queue data and return the file offset it will be written at."""
+        if len(self.buf) & 1:
+            self.buf += b"\x00"
+        offset = self.size + len(self.buf)
+        self.buf += data
+        return offset
+
+
+def _pack(byteorder, field_type, values):
+    if field_type == 2:
+        return values + b"\x00"
+    fmt = TIFF_TYPES[field_type][0]
+    return struct.pack(f"{byteorder}{len(values)}{fmt}", *values)
+
+
+def _entry(reader, appender, tag, field_type, values):
+    """Build an IFD entry, appending its value if it does not fit inline."""
+    order = reader.byteorder
+    data = _pack(order, field_type, values)
+    count = len(data) if field_type == 2 else len(values)
+    inline = 8 if reader.bigtiff else 4
+    if len(data) <= inline:
+        field = data.ljust(inline, b"\x00")
+    else:
+        offset = appender.add(data)
+        field = struct.pack(order + ("Q" if reader.bigtiff else "I"), offset)
+    return (tag, field_type, count, field)
+
+
+def _pack_ifd(reader, entries, next_ifd):
+    order = reader.byteorder
+    if reader.bigtiff:
+        head, entry_fmt, tail = "Q", "HHQ8s", "Q"
+    else:
+        head, entry_fmt, tail = "H", "HHI4s", "I"
+    data = struct.pack(order + head, len(entries))
+    for entry in entries:
+        data += struct.pack(order + entry_fmt, *entry)
+    return data + struct.pack(order + tail, next_ifd)
+
+
+def recover_append(file_path):
+    """
+    Roll back an append_subifds that was interrupted, using its journal.
+    Returns True if a rollback was performed.
+    """
+    journal_path = str(file_path) + JOURNAL_SUFFIX
+    if not os.path.exists(journal_path):
+        return False
+    with open(journal_path) as f:
+        journal = json.load(f)
+    with open(file_path, "r+b") as f:
+        f.write(bytes.fromhex(journal["header"]))
+        f.truncate(journal["size"])
+        f.flush()
+        os.fsync(f.fileno())
+    os.remove(journal_path)
+    return True
+
+
+def append_subifds(file_path, thumbs, description):
+    """
+    Attach thumbs (arrays, written uncompressed, or JpegThumbnails) as SubIFDs
+    of page 0, in order, without rewriting the image.
+
+    The thumbnail strips, their IFDs and a copy of page 0's IFD are appended to
+    the file, then the header is repointed at the new IFD. The copied IFD
+    gains the SubIFDs tag, and description replaces any ImageDescription it
+    had, as when the file is rewritten: an IFD may hold only one. Every other
+    entry, and all image data, stay byte-for-byte as before. The original
+    header and size are journaled first, so recover_append can undo an
+    interrupted update.
+    Raises ValueError if the file cannot be updated in place.
+    """
+    for thumb in thumbs:
+        if isinstance(thumb, JpegThumbnail):
+            continue
+        if thumb.dtype != np.uint8 or thumb.ndim not in (2, 3):
+            raise ValueError("Only 8-bit grayscale or RGB thumbnails can be appended")
+    description = description.encode("ascii")
+    journal_path = str(file_path) + JOURNAL_SUFFIX
+
+    with open(file_path, "r+b") as f:
+        reader = TiffReader(f)
+        entries, next_ifd = reader.read_ifd(reader.first_ifd)
+        if any(entry.tag == SUBIFDS for entry in entries):
+            raise ValueError("Page 0 already has SubIFDs")
+
+        long_type = 16 if reader.bigtiff else 4
+        ifd_type = 18 if reader.bigtiff else 13
+        appender = _Appender(f)
+
+        # Thumbnails: one strip (raw pixels or a JPEG stream) plus an IFD each
+        thumb_ifds = []
+        for thumb in thumbs:
+            if isinstance(thumb, JpegThumbnail):
+                width, height, samples = thumb.width, thumb.height, thumb.samples
+                data = thumb.data
+                compression = 7
+                photometric = 6 if thumb.subsampling else 1
+            else:
+                height, width = thumb.shape[:2]
+                samples = 1 if thumb.ndim == 2 else thumb.shape[2]
+                data = np.ascontiguousarray(thumb).tobytes()
+                compression = 1
+                photometric = 2 if samples == 3 else 1
+            strip = appender.add(data)
+            thumb_entries = [
+                _entry(reader, appender, NEW_SUBFILE_TYPE, 4, (1,)),
+                _entry(reader, appender, 256, 4, (width,)),
+                _entry(reader, appender, 257, 4, (height,)),
+                _entry(reader, appender, 258, 3, (8,) * samples),
+                _entry(reader, appender, 259, 3, (compression,)),
+                _entry(reader, appender, 262, 3, (photometric,)),
+                _entry(reader, appender, 273, long_type, (strip,)),
+                _entry(reader, appender, 277, 3, (samples,)),
+                _entry(reader, appender, 278, 4, (height,)),
+                _entry(reader, appender, 279, long_type, (len(data),)),
+                _entry(reader, appender, 284, 3, (1,)),
+            ]
+            if photometric == 6:
+                thumb_entries.append(
+                    _entry(reader, appender, YCBCR_SUBSAMPLING, 3, thumb.subsampling)
+                )
+            thumb_ifds.append(appender.add(_pack_ifd(reader, thumb_entries, 0)))
+
+        # Page 0: original entries with our description, plus SubIFDs
+        new_entries = [
+            _entry(reader, appender, IMAGE_DESCRIPTION, 2, description),
+            _entry(reader, appender, SUBIFDS, ifd_type, tuple(thumb_ifds)),
+        ]
+        new_entries += [
+            tuple(entry) for entry in entries if entry.tag != IMAGE_DESCRIPTION
+        ]
+        new_entries.sort(key=lambda entry: entry[0])
+        page0_ifd = appender.add(_pack_ifd(reader, new_entries, next_ifd))
+
+        if not reader.bigtiff and appender.size + len(appender.buf) >= 2**32:
+            raise ValueError("Appending would exceed the classic TIFF size limit")
+
+        # 1. Journal the state needed to roll back
+        header_size = 16 if reader.bigtiff else 8
+        f.seek(0)
+        header = f.read(header_size)
+        with open(journal_path, "w") as journal:
+            json.dump({"size": appender.size, "header": header.hex()}, journal)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        # 2. Append the new structures after the existing data
+        f.seek(appender.size)
+        f.write(appender.buf)
+        f.flush()
+        os.fsync(f.fileno())
+
+        # 3. Atomically (a single small write) switch to the new page 0 IFD
+        if reader.bigtiff:
+            f.seek(8)
+            f.write(struct.pack(reader.byteorder + "Q", page0_ifd))
+        else:
+            f.seek(4)
+            f.write(struct.pack(reader.byteorder + "I", page0_ifd))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.remove(journal_path)
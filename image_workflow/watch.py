@@ -0,0 +1,201 @@
+"""
+Watch mode: keep running and process images as they arrive in the tree.
+
+New and rewritten files are picked up from inotify (on Linux; elsewhere the
+tree is re-scanned every second) and handed on once their size and mtime have
+been stable for a settle time, so files still being written by a scanner or a
+copy are not read half-finished. The tools' own temporary files, sidecars and
+output directories are never reported, and neither is a file the tool has just
+rewritten itself: after each batch its stat is remembered, and an event that
+leaves a file exactly as the tool left it is dropped.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from .common import DEFAULT_SETTLE, is_sidecar, is_temporary_file, walk_images
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+
+
+class Inotify:
+    """Recursive inotify watch on a tree, pruning the tools' output directories."""
+
+    def __init__(self, root, prune):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = str(root)
+        self.prune = set(prune)
+        self.dirs = {}
+        self.add_tree(str(root))
+
+    def add_tree(self, root):
+        """Watch root and every directory below it."""
+        for directory, subdirs, _ in os.walk(root):
+            subdirs[:] = [d for d in subdirs if d not in self.prune]
+            wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd >= 0:
+                self.dirs[wd] = directory
+
+    def events(self, timeout):
+        """
+        Wait up to timeout seconds and return the paths written or moved in.
+        Files in directories that appeared since are included, as they may
+        have been written before their directory was watched.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: treat every file as possibly new
+                paths.extend(
+                    str(path) for path in walk_images(self.root, [""], self.prune)
+                )
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if os.path.basename(path) not in self.prune:
+                    self.add_tree(path)
+                    paths.extend(str(p) for p in walk_images(path, [""], self.prune))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """Stand-in for Inotify where it is unavailable: compares stat snapshots."""
+
+    def __init__(self, root, prune, interval=1.0):
+        self.root = root
+        self.prune = prune
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        return {
+            str(path): _signature(path)
+            for path in walk_images(self.root, [""], self.prune)
+        }
+
+    def events(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        snapshot = self._scan()
+        paths = [
+            path for path, sig in snapshot.items() if self.snapshot.get(path) != sig
+        ]
+        self.snapshot = snapshot
+        return paths
+
+    def close(self):
+        pass
+
+
+class Watcher:
+    def __init__(self, root, extensions, prune, settle=DEFAULT_SETTLE):
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.settle = settle
+        # path -> (signature when last seen, time it was last seen changing)
+        self.pending = {}
+        # path -> signature the tool left it with
+        self.processed = {}
+        try:
+            self.source = Inotify(root, prune)
+        except (OSError, AttributeError, TypeError):
+            print("inotify is not available; polling for new files every second")
+            self.source = Poller(root, prune)
+
+    def _wanted(self, path):
+        name = os.path.basename(path).lower()
+        if not name.endswith(self.extensions) or is_sidecar(name):
+            return False
+        return not is_temporary_file(path)
+
+    def wait(self):
+        """Block until some files have settled, and return them sorted."""
+        while True:
+            timeout = self.settle / 4 if self.pending else None
+            for path in self.source.events(timeout):
+                path = os.path.normpath(path)
+                if self._wanted(path):
+                    self.pending[path] = (None, time.monotonic())
+
+            ready = []
+            now = time.monotonic()
+            for path, (seen, since) in list(self.pending.items()):
+                signature = _signature(path)
+                if signature is None:
+                    del self.pending[path]
+                elif signature != seen:
+                    self.pending[path] = (signature, now)
+                elif now - since >= self.settle:
+                    del self.pending[path]
+                    if self.processed.get(path) != signature:
+                        ready.append(path)
+            if ready:
+                return sorted(ready)
+
+    def done(self, files):
+        """Remember how the tool left files, so its own writes are ignored."""
+        for file in files:
+            self.processed[os.path.normpath(str(file))] = _signature(file)
+
+    def close(self):
+        self.source.close()
+
+
+def watch_images(run, root, extensions, prune, settle=DEFAULT_SETTLE):
+    """
+    Call run() once to catch up with the tree, then run(files=...) for each
+    batch of new files until interrupted. The watch starts before the
+    catch-up run so that nothing arriving during it is missed.
+    """
+    watcher = Watcher(root, extensions, prune, settle)
+    try:
+        run()
+        print(f"Watching {root} for new images (Ctrl-C to stop)")
+        while True:
+            files = watcher.wait()
+            run(files=files)
+            watcher.done(files)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        watcher.close()
@@ -0,0 +1,12 @@
+import pytest
+
+from image_workflow.cache import CACHE_FILENAME
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(monkeypatch, tmp_path):
+    """
+    Give each test its own cache database and thumbnail store, so no test
+    leaves them in the checkout or passes on another's cached entries.
+    """
+    monkeypatch.setenv("IW_CACHE", str(tmp_path / CACHE_FILENAME))
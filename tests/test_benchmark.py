@@ -0,0 +1,42 @@
+import json
+import os
+import tempfile
+
+import pytest
+
+from image_workflow.benchmark import main as benchmark_main
+
+
+def test_benchmark_run_and_compare():
+    """Test a tiny benchmark run produces results and compare flags slowdowns."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        baseline = os.path.join(tmpdir, "baseline.json")
+        benchmark_main(
+            [
+                "run",
+                "--corpus",
+                "mixed",
+                "--scale",
+                "0.01",
+                "--operation",
+                "add-thumbnail",
+                "--output",
+                baseline,
+            ]
+        )
+        with open(baseline) as f:
+            results = json.load(f)
+        result = results["results"]["mixed/add-thumbnail"]
+        assert result["files"] == 2  # WebP has no thumbnail support
+        assert result["failed"] == 0
+        assert result["wall_s"] > 0
+        assert result["peak_rss_mb"] > 0
+
+        # Identical results pass; twice the wall time is a regression
+        benchmark_main(["compare", baseline, baseline])
+        result["wall_s"] *= 2
+        current = os.path.join(tmpdir, "current.json")
+        with open(current, "w") as f:
+            json.dump(results, f)
+        with pytest.raises(SystemExit):
+            benchmark_main(["compare", baseline, current, "--threshold", "50"])
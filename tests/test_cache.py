@@ -0,0 +1,46 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+import image_workflow.common as common
+from image_workflow.cache import CACHE_FILENAME, get_cache
+from image_workflow.manage_cache import main as manage_cache_main
+
+
+def test_provenance_is_cached(monkeypatch):
+    """Test hashes are reused until the file changes, and prune drops stale rows."""
+    # The cache of the tree being processed, not the one conftest sets up
+    monkeypatch.delenv("IW_CACHE")
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            src = Path("test.tif")
+            tifffile.imwrite(src, np.zeros((10, 10, 3), dtype=np.uint8))
+
+            first = common.get_provenance(src)
+            assert os.path.exists(CACHE_FILENAME)
+
+            def no_hashing(path):
+                raise AssertionError("cached file should not be re-hashed")
+
+            monkeypatch.setattr(common, "get_sha1", no_hashing)
+            assert common.get_provenance(src) == first
+
+            # Rewriting the file (even with its old mtime) invalidates the entry
+            stat = src.stat()
+            tifffile.imwrite(src, np.ones((10, 10, 3), dtype=np.uint8))
+            os.utime(src, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            monkeypatch.undo()
+            second = common.get_provenance(src)
+            assert second["sha1"] != first["sha1"]
+
+            assert get_cache().stats()["entries"] == 1
+            src.unlink()
+            manage_cache_main(["prune"])
+            assert get_cache().stats()["entries"] == 0
+        finally:
+            os.chdir(original_cwd)
@@ -39,7 +39,7 @@ def test_add_thumbnail():
         assert add_thumbnail(png_dst)
         assert PngImageProcessor.has_thumbnail(png_dst)
         # Extract to another dir
-        extract_dir = os.path.join(tmpdir, "thumbs")
+        extract_dir = os.path.join(tmpdir, "thumbnails")
         os.makedirs(extract_dir)
         assert extract_thumbnail(png_dst, extract_dir)
         assert os.path.exists(os.path.join(extract_dir, "test.png.jpg"))
@@ -63,3 +63,334 @@ def test_processor_methods_on_nonexistent():
     assert not PngImageProcessor.add_thumbnail("nonexistent.png")
     assert not PngImageProcessor.extract_thumbnail("nonexistent.png", "thumbs")
     assert not PngImageProcessor.remove_thumbnail("nonexistent.png")
+
+
+def _name_or_fail(file_path):
+    if file_path.name.startswith("bad"):
+        raise RuntimeError("boom")
+    return file_path.name
+
+
+def test_iterate_images_parallel():
+    """Test the process pool keeps input order and isolates per-file failures."""
+    import tempfile
+    from pathlib import Path
+    from image_workflow.common import iterate_images
+
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            names = [f"img{i:02d}.png" for i in range(20)] + ["bad.png"]
+            for name in names:
+                Path(name).touch()
+
+            sequential = iterate_images(_name_or_fail, [".png"], collect_results=True)
+            parallel = iterate_images(
+                _name_or_fail, [".png"], collect_results=True, jobs=4
+            )
+            assert parallel == sequential
+            assert "bad.png" not in parallel
+            assert len(parallel) == 20
+
+            unordered = iterate_images(
+                _name_or_fail, [".png"], collect_results=True, jobs=4, ordered=False
+            )
+            assert sorted(unordered) == sorted(parallel)
+        finally:
+            os.chdir(original_cwd)
+
+
+def _name_or_die(file_path):
+    if "dead" in file_path.name:
+        os._exit(1)
+    return file_path.name
+
+
+def test_iterate_images_worker_died():
+    """Test a worker dying fails its files but not the rest of the run."""
+    import tempfile
+    from pathlib import Path
+    from image_workflow.common import iterate_images
+
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            names = [f"img{i:02d}.png" for i in range(20)] + ["img05-dead.png"]
+            for name in names:
+                Path(name).touch()
+
+            for max_memory in (None, 1024):
+                results = iterate_images(
+                    _name_or_die,
+                    [".png"],
+                    collect_results=True,
+                    jobs=2,
+                    max_memory=max_memory,
+                )
+                assert "img05-dead.png" not in results
+                assert "img19.png" in results
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_iterate_images_memory_budget():
+    """Test the budgeted scheduler runs everything, largest first."""
+    import tempfile
+    from PIL import Image
+    from image_workflow.common import estimate_memory, iterate_images, parse_size
+
+    assert parse_size("512M") == 512 * 1024**2
+    assert parse_size("1.5GiB") == 3 * 1024**3 // 2
+    assert parse_size("4096") == 4096
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            sizes = {"a.png": 10, "b.png": 40, "c.png": 20, "d.png": 30}
+            for name, side in sizes.items():
+                Image.new("RGB", (side, side)).save(name)
+            assert estimate_memory("b.png") == 40 * 40 * 3
+
+            results = iterate_images(
+                _name_or_fail, [".png"], collect_results=True, jobs=2, max_memory=1
+            )
+            assert results == sorted(sizes)
+
+            # Nothing fits in the budget, so files run one at a time, largest first
+            results = iterate_images(
+                _name_or_fail,
+                [".png"],
+                collect_results=True,
+                jobs=2,
+                ordered=False,
+                max_memory=1,
+            )
+            assert results == ["b.png", "d.png", "c.png", "a.png"]
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_walk_images():
+    """
+    Test the walker matches extensions case-insensitively, prunes output dirs
+    and skips temporary rewrites, but not a file that only looks like one.
+    """
+    import tempfile
+    from pathlib import Path
+    from image_workflow.common import walk_images
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        for rel in [
+            "a.jpg",
+            "b.PNG",
+            "notes.txt",
+            "a.png.thumb.jpg",
+            "sub/c.TIFF",
+            "sub/c-compressed.tiff",
+            "sub/scan-compressed.tiff",
+            "sub/deeper/d.jpeg",
+            "thumbnails/a.jpg.jpg",
+            "converted/sub/c.png",
+        ]:
+            path = root / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+
+        extensions = [".jpg", ".jpeg", ".png", ".tif", ".tiff"]
+        walker = walk_images(root, extensions)
+        assert next(walker) == root / "a.jpg", "walker should yield lazily"
+        found = [root / "a.jpg"] + list(walker)
+        assert [p.relative_to(root).as_posix() for p in found] == [
+            "a.jpg",
+            "b.PNG",
+            "sub/c.TIFF",
+            "sub/scan-compressed.tiff",
+            "sub/deeper/d.jpeg",
+        ]
+
+        unpruned = walk_images(root, extensions, prune=())
+        assert root / "converted/sub/c.png" in list(unpruned)
+
+
+def test_make_thumbnail_reduced_decode():
+    """Test JPEGs are draft-decoded and aspect ratio is kept on request."""
+    import tempfile
+    from PIL import Image
+    from image_workflow.common import make_thumbnail
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, "large.jpg")
+        Image.new("RGB", (4000, 2000), "blue").save(src)
+
+        with Image.open(src) as img:
+            thumb = make_thumbnail(img)
+            # draft() made the decoder scale by 1/4 instead of decoding 8 MP
+            assert img.size == (1000, 500)
+        assert thumb.size == (256, 256)
+
+        with Image.open(src) as img:
+            assert make_thumbnail(img, keep_aspect=True).size == (256, 128)
+
+        rgba = Image.new("RGBA", (300, 300))
+        assert make_thumbnail(rgba).mode == "RGB"
+
+
+def test_thumbnail_sizes(monkeypatch):
+    """Test several thumbnail sizes are made from one decode and extracted."""
+    import shutil
+    import tempfile
+
+    import tifffile
+    import image_workflow.common as common
+
+    decodes = []
+    make_thumbnail = common.make_thumbnail
+
+    def counting_make_thumbnail(img, *args, **kwargs):
+        decodes.append(img)
+        return make_thumbnail(img, *args, **kwargs)
+
+    monkeypatch.setattr(common, "make_thumbnail", counting_make_thumbnail)
+    original_cwd = os.getcwd()
+    sizes = (256, 64, 1024)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            for ext in ("jpg", "png", "tif"):
+                shutil.copy2(
+                    os.path.join(original_cwd, f"test_images/clean_sample.{ext}"),
+                    os.path.join(tmpdir, f"a.{ext}"),
+                )
+            os.chdir(tmpdir)
+
+            for name in ("a.jpg", "a.png", "a.tif"):
+                decodes.clear()
+                assert add_thumbnail(name, sizes=sizes)
+                assert len(decodes) == 1
+                assert extract_thumbnail(name, "thumbnails", sizes=sizes)
+                assert os.path.exists(f"thumbnails/{name}.jpg")
+                for size in (64, 1024):
+                    with common.Image.open(f"thumbnails/{name}-{size}.jpg") as img:
+                        assert img.size == (size, size)
+
+            assert os.path.exists("a.jpg.thumb-64.jpg")
+            assert os.path.exists("a.png.thumb-1024.jpg")
+            assert not os.path.exists("a.tif.thumb-64.jpg")
+            with tifffile.TiffFile("a.tif") as tif:
+                assert [page.shape[0] for page in tif.pages[0].pages] == [256, 64, 1024]
+
+            # Sidecars of every size are removed, and never taken for images
+            assert remove_thumbnail("a.png")
+            assert not os.path.exists("a.png.thumb-64.jpg")
+            assert list(common.walk_images(".", [".jpg", ".png"])) == [
+                common.Path("a.jpg"),
+                common.Path("a.png"),
+            ]
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_thumbnail_too_large_for_exif():
+    """Test a primary thumbnail over the EXIF limit goes to a sidecar instead."""
+    import tempfile
+
+    import numpy as np
+    import image_workflow.common as common
+
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            # Noise, so a 1024px JPEG thumbnail cannot fit in 64 KB
+            rng = np.random.default_rng(0)
+            pixels = rng.integers(0, 255, (1200, 1200, 3), dtype=np.uint8)
+            common.Image.fromarray(pixels).save("a.jpg")
+            with open("a.jpg", "rb") as f:
+                original = f.read()
+
+            assert not add_thumbnail("a.jpg", sizes=(1024,))
+            with open("a.jpg", "rb") as f:
+                assert f.read() == original
+
+            assert add_thumbnail("a.jpg", sizes=(1024, 256))
+            assert os.path.exists("a.jpg.thumb.jpg")
+            assert os.path.exists("a.jpg.thumb-256.jpg")
+            offset, length = ExifImageProcessor.probe("a.jpg").thumbnail
+            with open("a.jpg", "rb") as f:
+                f.seek(offset)
+                embedded = common.Image.open(common.BytesIO(f.read(length)))
+            assert embedded.size == (256, 256)
+
+            assert extract_thumbnail("a.jpg", "thumbnails", sizes=(1024, 256))
+            with common.Image.open("thumbnails/a.jpg.jpg") as img:
+                assert img.size == (1024, 1024)
+            with common.Image.open("thumbnails/a.jpg-256.jpg") as img:
+                assert img.size == (256, 256)
+
+            assert remove_thumbnail("a.jpg")
+            assert not os.path.exists("a.jpg.thumb.jpg")
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_thumbnail_encodings():
+    """Test thumbnails are written as WebP sidecars and JPEG TIFF SubIFDs."""
+    import shutil
+    import tempfile
+
+    import functools
+
+    import tifffile
+    import image_workflow.common as common
+    from image_workflow.encoders import ThumbnailEncoding
+    from image_workflow.metrics import RunMetrics, measured
+
+    original_cwd = os.getcwd()
+    webp = ThumbnailEncoding("webp", quality=60)
+    jpeg = ThumbnailEncoding(quality=80, progressive=True, tiff="jpeg")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            for ext in ("png", "tif"):
+                shutil.copy2(
+                    os.path.join(original_cwd, f"test_images/clean_sample.{ext}"),
+                    os.path.join(tmpdir, f"a.{ext}"),
+                )
+            os.chdir(tmpdir)
+
+            res = measured(functools.partial(add_thumbnail, encoding=webp), "a.png")
+            assert res.result
+            assert os.path.exists("a.png.thumb.webp")
+            assert has_thumbnail("a.png")
+            metrics = RunMetrics("add-thumbnail")
+            metrics.add("a.png", res.samples)
+            assert metrics.summary()["encode-webp"]["psnr_db"] > 20
+            assert extract_thumbnail("a.png", "thumbnails", encoding=webp)
+            with common.Image.open("thumbnails/a.png.webp") as img:
+                assert img.format == "WEBP"
+
+            assert add_thumbnail("a.tif", encoding=jpeg)
+            with tifffile.TiffFile("a.tif") as tif:
+                assert tif.pages[0].pages[0].compression == 7
+            # The embedded JPEG is encoded again as progressive was asked for
+            assert extract_thumbnail("a.tif", "thumbnails", encoding=jpeg)
+            with tifffile.TiffFile("a.tif") as tif:
+                embedded = common.jpeg_stream(tif, tif.pages[0].pages[0])
+            progressive = common.Path("thumbnails/a.tif.jpg").read_bytes()
+            assert progressive != embedded
+            with common.Image.open("thumbnails/a.tif.jpg") as img:
+                assert img.info.get("progressive")
+
+            # Thumbnails of other settings are stored apart
+            low = ThumbnailEncoding(quality=10)
+            assert extract_thumbnail("a.tif", "thumbnails", encoding=low)
+            extracted = common.Path("thumbnails/a.tif.jpg").read_bytes()
+            assert len(extracted) < len(progressive)
+            assert extract_thumbnail("a.tif", "thumbnails")
+            assert common.Path("thumbnails/a.tif.jpg").read_bytes() == embedded
+        finally:
+            os.chdir(original_cwd)
@@ -0,0 +1,64 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from image_workflow.common import has_thumbnail
+from image_workflow.daemon import SOCKET_FILENAME, request
+
+
+def test_daemon_runs_jobs():
+    """Test jobs sent over the socket are processed by the warm workers."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            shutil.copy2(
+                os.path.join(original_cwd, "test_images/clean_sample.jpg"), "a.jpg"
+            )
+            env = dict(os.environ, PYTHONPATH=original_cwd)
+            proc = subprocess.Popen(
+                [sys.executable, "-m", "image_workflow.daemon", "serve", "-j", "1"],
+                env=env,
+                stdout=subprocess.DEVNULL,
+            )
+            try:
+                for _ in range(100):
+                    if os.path.exists(SOCKET_FILENAME):
+                        break
+                    time.sleep(0.1)
+
+                response = request(SOCKET_FILENAME, {"operation": "status"})
+                assert response["ok"] and response["workers"] == 1
+
+                job = {"operation": "add-thumbnail", "paths": ["a.jpg", "missing.jpg"]}
+                response = request(SOCKET_FILENAME, job)
+                assert not response["ok"]
+                assert [r["ok"] for r in response["results"]] == [True, False]
+                assert response["metrics"]["file"]["count"] == 2
+                assert has_thumbnail("a.jpg")
+
+                job = {"operation": "convert", "paths": ["a.jpg"]}
+                response = request(SOCKET_FILENAME, job)
+                assert response == {
+                    "ok": False,
+                    "error": "convert needs a format option",
+                }
+
+                # A single path must still be sent as a list
+                job = {"operation": "remove-thumbnail", "paths": "a.jpg"}
+                response = request(SOCKET_FILENAME, job)
+                assert response == {
+                    "ok": False,
+                    "error": "paths must be a list of file paths",
+                }
+                assert has_thumbnail("a.jpg")
+            finally:
+                proc.send_signal(signal.SIGTERM)
+                assert proc.wait(timeout=30) == 0
+            assert not os.path.exists(SOCKET_FILENAME)
+        finally:
+            os.chdir(original_cwd)
@@ -50,7 +50,7 @@ def test_gallery_generation():
             # which currently fails because common.py doesn't support it.
 
             try:
-                generate_gallery_main()
+                generate_gallery_main([])
             except TypeError as e:
                 pytest.fail(
                     f"generate_html_gallery failed with TypeError (likely iterate_images mismatch): {e}"
@@ -0,0 +1,76 @@
+import os
+import shlex
+import subprocess
+import sys
+
+import pytest
+
+from image_workflow.gm_batch import GmBatch, quote_arg, run_gm
+
+# Stands in for gm: in batch mode it answers each command with its arguments
+# and the pass marker, fails commands on "bad" files and exits on "crash".
+# Every start is logged, so restarts can be counted.
+FAKE_GM = """#!{python}
+import shlex
+import sys
+
+with open({log!r}, "a") as log:
+    log.write(" ".join(sys.argv[1:3]) + "\\n")
+if sys.argv[1:2] != ["batch"]:
+    sys.exit(0)
+args = sys.argv[1:]
+passed = args[args.index("-pass") + 1]
+failed = args[args.index("-fail") + 1]
+for line in sys.stdin:
+    command = shlex.split(line)
+    if "crash" in command:
+        sys.exit(1)
+    print(" ".join(command))
+    print(failed if "bad.jpg" in command else passed, flush=True)
+"""
+
+
+def test_quote_arg():
+    """Test arguments survive unix-style splitting, including JSON comments."""
+    args = [
+        "convert",
+        "dir with spaces/img.jpg",
+        "-comment",
+        '{"source_file": "C:\\\\scans\\\\a.tif", "sha1": "abc"}',
+        "out.png",
+    ]
+    line = " ".join(quote_arg(arg) for arg in args)
+    assert shlex.split(line) == args
+    assert quote_arg("plain/path-1.jpg") == "plain/path-1.jpg"
+
+    with pytest.raises(ValueError):
+        quote_arg("two\nlines")
+
+
+def test_gm_batch_results_and_restart(monkeypatch, tmp_path):
+    """Test pass/fail markers are reported per command and a dead gm is restarted."""
+    log = tmp_path / "starts.log"
+    gm = tmp_path / "gm"
+    gm.write_text(FAKE_GM.format(python=sys.executable, log=str(log)))
+    gm.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    batch = GmBatch()
+    try:
+        assert batch.run(["convert", "a b.jpg", "a.png"]) == "convert a b.jpg a.png"
+        with pytest.raises(subprocess.CalledProcessError) as failure:
+            batch.run(["convert", "bad.jpg", "bad.png"])
+        assert failure.value.output == "convert bad.jpg bad.png"
+        assert batch.run(["convert", "c.jpg", "c.png"]) == "convert c.jpg c.png"
+        assert log.read_text().splitlines() == ["batch -escape"]
+
+        with pytest.raises(BrokenPipeError):
+            batch.run(["convert", "crash", "d.png"])
+        assert batch.run(["convert", "d.jpg", "d.png"]) == "convert d.jpg d.png"
+        assert log.read_text().splitlines() == ["batch -escape"] * 2
+    finally:
+        batch.close()
+
+    # A command lost with its batch process is run by a gm of its own
+    run_gm(["convert", "crash", "e.png"])
+    assert log.read_text().splitlines()[-2:] == ["batch -escape", "convert crash"]
@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import piexif
+import tifffile
+from PIL import Image, PngImagePlugin
+
+from image_workflow.common import get_existing_metadata
+from image_workflow.headers import read_comments
+
+META = {"created_at": 1.0, "sha1": "ab" * 20, "source_file": "/src/ü.jpg"}
+META_JSON = json.dumps(META, ensure_ascii=False)
+
+
+def test_read_comments_per_format():
+    """Test the provenance blob is found in each format's native comment field."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        img = Image.new("RGB", (32, 32), "red")
+
+        jpg_com = os.path.join(tmpdir, "com.jpg")
+        img.save(jpg_com, comment=META_JSON.encode("utf-8"))
+
+        jpg_exif = os.path.join(tmpdir, "exif.jpg")
+        exif = piexif.dump(
+            {"0th": {piexif.ImageIFD.ImageDescription: META_JSON.encode("utf-8")}}
+        )
+        img.save(jpg_exif, exif=exif)
+
+        png_text = os.path.join(tmpdir, "text.png")
+        info = PngImagePlugin.PngInfo()
+        info.add_text("comment", json.dumps(META))
+        img.save(png_text, pnginfo=info)
+
+        png_itxt = os.path.join(tmpdir, "itxt.png")
+        info = PngImagePlugin.PngInfo()
+        info.add_itxt("comment", META_JSON, zip=True)
+        img.save(png_itxt, pnginfo=info)
+
+        webp = os.path.join(tmpdir, "exif.webp")
+        img.save(webp, exif=exif)
+
+        tif = os.path.join(tmpdir, "desc.tif")
+        tifffile.imwrite(
+            tif,
+            np.zeros((8, 8, 3), dtype=np.uint8),
+            photometric="rgb",
+            description=json.dumps(META),
+        )
+
+        for path in [jpg_com, jpg_exif, png_text, png_itxt, webp, tif]:
+            assert get_existing_metadata(path) == META, path
+
+        # tifffile's own shape description is returned alongside ours
+        assert len(read_comments(tif)) == 2
+
+
+def test_read_comments_without_provenance():
+    """Test plain images yield no comments and unknown containers yield None."""
+    assert read_comments("test_images/clean_sample.jpg") == []
+    assert read_comments("test_images/clean_sample.png") == []
+    assert get_existing_metadata("test_images/clean_sample.tif") is None
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        other = os.path.join(tmpdir, "image.xyz")
+        with open(other, "wb") as f:
+            f.write(b"not an image")
+        assert read_comments(other) is None
+
+
+def test_probe_thumbnail():
+    """Test the header probe agrees with piexif/tifffile about thumbnails."""
+    import shutil
+    from image_workflow.common import add_thumbnail, probe_thumbnail
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        jpg = os.path.join(tmpdir, "test.jpg")
+        shutil.copy2("test_images/clean_sample.jpg", jpg)
+        probe = probe_thumbnail(jpg)
+        assert not probe.has_thumbnail and probe.exif is None
+
+        assert add_thumbnail(jpg, probe=probe)
+        probe = probe_thumbnail(jpg)
+        assert probe.has_thumbnail and probe.exif is not None
+        offset, length = probe.thumbnail
+        with open(jpg, "rb") as f:
+            f.seek(offset)
+            assert f.read(length) == piexif.load(jpg)["thumbnail"]
+
+        tif = os.path.join(tmpdir, "test.tif")
+        shutil.copy2("test_images/clean_sample.tif", tif)
+        assert not probe_thumbnail(tif).has_thumbnail
+        add_thumbnail(tif)
+        with tifffile.TiffFile(tif) as t:
+            assert probe_thumbnail(tif).subifds == tuple(t.pages[0].subifds)
+
+        assert not probe_thumbnail(os.path.join(tmpdir, "missing.jpg")).has_thumbnail
+
+
+def test_image_geometry():
+    """Test decoded sizes are read from the headers of each format."""
+    from image_workflow.headers import ImageGeometry, decoded_size, image_geometry
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        arr = np.zeros((30, 40, 3), dtype=np.uint8)
+        for ext in ("jpg", "png", "webp"):
+            path = os.path.join(tmpdir, f"test.{ext}")
+            Image.fromarray(arr).save(path)
+            assert image_geometry(path) == ImageGeometry(40, 30, 3, 8)
+
+        path = os.path.join(tmpdir, "test16.tif")
+        tifffile.imwrite(path, np.zeros((30, 40, 3), dtype=np.uint16))
+        assert decoded_size(path) == 40 * 30 * 3 * 2
+
+        path = os.path.join(tmpdir, "junk.png")
+        with open(path, "wb") as f:
+            f.write(b"not an image")
+        assert decoded_size(path) is None
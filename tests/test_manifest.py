@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+from image_workflow.add_thumbnails import main as add_main
+from image_workflow.compress_tiffs import main as compress_main
+from image_workflow.jobs import JobJournal
+from image_workflow.remove_thumbnails import main as remove_main
+
+
+def test_rerun_skips_processed_files(capsys):
+    """Test a re-run only compresses new or changed files."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            for name in ["a.tif", "b.tif"]:
+                tifffile.imwrite(name, np.zeros((10, 10, 3), dtype=np.uint8))
+
+            compress_main(["-j", "1"])
+            assert "Compressed a.tif" in capsys.readouterr().out
+
+            compress_main(["-j", "1"])
+            out = capsys.readouterr().out
+            assert "Compressed" not in out
+            assert "Skipped 2 up-to-date files" in out
+
+            # A rewritten file is picked up even though its mtime is restored
+            stat = Path("b.tif").stat()
+            tifffile.imwrite("b.tif", np.ones((10, 10, 3), dtype=np.uint8))
+            os.utime("b.tif", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            compress_main(["-j", "1", "--status"])
+            out = capsys.readouterr().out
+            assert "changed: b.tif" in out
+            assert "1 files to process, 1 up to date" in out
+
+            # Forced, a.tif is looked at again but is already LZW
+            compress_main(["-j", "1", "--force"])
+            out = capsys.readouterr().out
+            assert "Skipped a.tif: already compressed" in out
+            assert "Compressed b.tif" in out
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_resume_interrupted_run(capsys):
+    """Test a killed run's temp files are cleaned up and resume skips its work."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            for name in ["a.tif", "b.tif"]:
+                tifffile.imwrite(name, np.zeros((10, 10, 3), dtype=np.uint8))
+
+            # A run that finished a.tif and was killed while writing b.tif
+            journal = JobJournal("compress-lzw")
+            journal.open()
+            for file in [Path("a.tif"), Path("b.tif")]:
+                journal.queued(file)
+            journal.finish("a.tif", True)
+            journal.f.close()
+            Path("b-compressed.tiff").write_bytes(b"partial")
+
+            # The orphan is neither treated as an input nor left behind
+            compress_main(["-j", "1", "--resume", "--force"])
+            out = capsys.readouterr().out
+            assert "1 files done, 1 in progress" in out
+            assert not Path("b-compressed.tiff").exists()
+            assert "Compressed b.tif" in out
+            assert "Compressed a.tif" not in out
+            assert "Processed 1 files" in out
+
+            journal = JobJournal("compress-lzw")
+            journal.load()
+            assert not journal.interrupted
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_live_run_is_not_reported_interrupted(capsys):
+    """Test a run that finds the journal locked does not read it as interrupted."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            tifffile.imwrite("a.tif", np.zeros((10, 10, 3), dtype=np.uint8))
+
+            # A run still working on a.tif
+            live = JobJournal("compress-lzw")
+            assert live.open()
+            live.queued(Path("a.tif"))
+
+            compress_main(["-j", "1", "--resume"])
+            out = capsys.readouterr().out
+            assert "Another compress-lzw run is in progress" in out
+            assert "interrupted" not in out
+            assert not Path("a-compressed.tiff").exists()
+            live.close(0, 0)
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_new_thumbnail_sizes_are_added(capsys):
+    """Test a run with more sizes adds just those, and removal takes them all."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            for ext in ("jpg", "png", "tif"):
+                shutil.copy2(
+                    os.path.join(original_cwd, f"test_images/clean_sample.{ext}"),
+                    os.path.join(tmpdir, f"a.{ext}"),
+                )
+            os.chdir(tmpdir)
+
+            add_main(["-j", "1"])
+            assert "Processed 3 files in" in capsys.readouterr().out
+
+            add_main(["-j", "1", "--sizes", "256,64"])
+            out = capsys.readouterr().out
+            assert "up-to-date" not in out
+            assert out.count("Added 64px thumbnails to") == 3
+            assert os.path.exists("a.jpg.thumb-64.jpg")
+            assert os.path.exists("a.png.thumb-64.jpg")
+            with tifffile.TiffFile("a.tif") as tif:
+                assert [page.shape[0] for page in tif.pages[0].pages] == [256, 64]
+
+            add_main(["-j", "1", "--sizes", "256,64", "--force"])
+            assert capsys.readouterr().out.count("Already has thumbnail") == 3
+
+            remove_main(["-j", "1"])
+            assert not [name for name in os.listdir(".") if ".thumb" in name]
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_removed_thumbnails_are_added_again(capsys):
+    """Test add, remove, add puts back the thumbnails, sidecars included."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            for ext in ("jpg", "png", "tif"):
+                shutil.copy2(
+                    os.path.join(original_cwd, f"test_images/clean_sample.{ext}"),
+                    os.path.join(tmpdir, f"a.{ext}"),
+                )
+            os.chdir(tmpdir)
+
+            add_main(["-j", "1"])
+            remove_main(["-j", "1"])
+            assert not os.path.exists("a.png.thumb.jpg")
+            capsys.readouterr()
+
+            add_main(["-j", "1"])
+            out = capsys.readouterr().out
+            assert "up-to-date" not in out
+            assert out.count("Added thumbnail to") == 3
+            assert os.path.exists("a.png.thumb.jpg")
+        finally:
+            os.chdir(original_cwd)
@@ -281,3 +281,31 @@ def test_add_thumbnail_preserves_metadata():
 
         finally:
             os.chdir(original_cwd)
+
+
+def test_convert_format_pillow_engine():
+    """Test the in-process engine writes provenance into each target format."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            from PIL import Image
+            from image_workflow.common import get_existing_metadata
+
+            SRC = Path("test.jpg")
+            Image.new("RGB", (100, 100), "white").save(SRC)
+            mtime = 1600000000.0
+            os.utime(SRC, (mtime, mtime))
+            sha1 = hashlib.sha1(SRC.read_bytes()).hexdigest()
+
+            for target_format in ["png", "webp", "jpg", "tif"]:
+                convert_to_format(SRC, target_format, engine="pillow")
+
+                DST = Path("converted") / f"test.{target_format}"
+                assert abs(DST.stat().st_mtime - mtime) < 1.0
+                meta = get_existing_metadata(DST)
+                assert meta is not None, target_format
+                assert meta["sha1"] == sha1
+                assert meta["source_file"] == str(SRC.resolve())
+        finally:
+            os.chdir(original_cwd)
@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import tifffile
+
+from image_workflow.compress_tiffs import main as compress_main
+
+
+def test_stage_metrics_export():
+    """Test per-stage timings come back from workers and export in both formats."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            for name in ["a.tif", "b.tif", "c.tif"]:
+                tifffile.imwrite(name, np.zeros((64, 64, 3), dtype=np.uint8))
+
+            compress_main(["-j", "2", "--force", "--metrics-file", "run.prom"])
+            with open("run.prom") as f:
+                prom = f.read()
+            assert "# TYPE iw_stage_seconds summary" in prom
+            labels = 'operation="compress-lzw",stage="sha1"'
+            assert f"iw_stage_seconds_count{{{labels}}} 3" in prom
+            assert 'stage="tiff-write",quantile="0.95"' in prom
+
+            compress_main(
+                ["-j", "1", "--force", "--recompress", "--metrics-file", "run.jsonl"]
+            )
+            with open("run.jsonl") as f:
+                records = [json.loads(line) for line in f]
+            per_file = [r for r in records if "file" in r and r["stage"] == "file"]
+            assert len(per_file) == 3
+            summary = {r["summary"]: r for r in records if "summary" in r}
+            assert summary["tiff-write"]["count"] == 3
+            assert summary["tiff-write"]["bytes_read"] > 0
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_encoding_summary(capsys):
+    """Test thumbnail runs end with their encodings' sizes, PSNR only on request."""
+    import shutil
+
+    from image_workflow.add_thumbnails import main as add_main
+    from image_workflow.remove_thumbnails import main as remove_main
+
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            shutil.copy2(
+                os.path.join(original_cwd, "test_images/clean_sample.png"),
+                os.path.join(tmpdir, "a.png"),
+            )
+            os.chdir(tmpdir)
+
+            add_main(["-j", "1"])
+            out = capsys.readouterr().out
+            assert "encode-jpeg: " in out
+            assert "kB of pixels" in out
+            assert "PSNR" not in out
+            assert "p50" not in out
+
+            remove_main(["-j", "1"])
+            add_main(["-j", "1", "--thumb-format", "webp", "--metrics"])
+            out = capsys.readouterr().out
+            assert "p50" in out
+            assert "encode-webp: " in out
+            assert "mean PSNR" in out
+        finally:
+            os.chdir(original_cwd)
@@ -0,0 +1,83 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pytest
+import tifffile
+
+import image_workflow.compress_tiffs as compress_tiffs
+import image_workflow.pipeline as pipeline
+
+
+def test_pipeline_single_write(monkeypatch):
+    """Test a TIFF is compressed and given a thumbnail by one rewrite."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            os.mkdir("scans")
+            src = Path("scans/page.tif")
+            tifffile.imwrite(src, np.full((600, 400, 3), 128, dtype=np.uint8))
+
+            writes = []
+            original_compress = compress_tiffs.compress_tiff
+
+            def counting_compress(*args, **kwargs):
+                writes.append(args[0])
+                return original_compress(*args, **kwargs)
+
+            monkeypatch.setattr(pipeline, "compress_tiff", counting_compress)
+            pipeline.main(
+                [
+                    "-j",
+                    "1",
+                    "add-thumbnails",
+                    "compress",
+                    "extract-thumbnails",
+                    "gallery",
+                ]
+            )
+
+            assert writes == [src]
+            with tifffile.TiffFile(src) as tif:
+                page = tif.pages[0]
+                assert page.compression == tifffile.COMPRESSION.LZW
+                assert len(page.subifds) == 1
+                assert "sha1" in page.description
+            assert Path("thumbnails/scans/page.tif.jpg").exists()
+            assert "thumbnails/scans/page.tif.jpg" in Path("gallery.html").read_text()
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_pipeline_compression_and_new_sizes(capsys):
+    """Test the pipeline compresses as asked and adds sizes requested since."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            tifffile.imwrite("page.tif", np.full((600, 400, 3), 128, dtype=np.uint8))
+
+            pipeline.main(["-j", "1", "add-thumbnails", "compress", "--codec", "zstd"])
+            with tifffile.TiffFile("page.tif") as tif:
+                assert tif.pages[0].compression == tifffile.COMPRESSION.ZSTD
+            capsys.readouterr()
+
+            pipeline.main(
+                ["-j", "1", "--force", "add-thumbnails", "compress", "--codec", "zstd"]
+                + ["--sizes", "256,64"]
+            )
+            assert "Added 64px thumbnails to page.tif" in capsys.readouterr().out
+            with tifffile.TiffFile("page.tif") as tif:
+                page = tif.pages[0]
+                assert page.compression == tifffile.COMPRESSION.ZSTD
+                assert [thumb.shape[0] for thumb in page.pages] == [256, 64]
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_pipeline_stage_order():
+    """Test output stages cannot come before the stages that write the image."""
+    with pytest.raises(SystemExit):
+        pipeline.main(["extract-thumbnails", "compress"])
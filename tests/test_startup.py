@@ -0,0 +1,42 @@
+import subprocess
+import sys
+
+import pytest
+
+ENTRY_MODULES = [
+    "add_thumbnails",
+    "benchmark",
+    "compress_tiffs",
+    "convert_format",
+    "extract_thumbnails",
+    "generate_html_gallery",
+    "manage_cache",
+    "pipeline",
+    "remove_thumbnails",
+]
+
+CODEC_MODULES = ["numpy", "PIL.Image", "tifffile", "piexif", "imagecodecs"]
+
+# Cumulative import time of an entry point (importing the codecs takes ~250 ms)
+IMPORT_BUDGET_MS = 150
+
+
+@pytest.mark.parametrize("module", ENTRY_MODULES)
+def test_entry_point_imports_no_codecs(module):
+    """Test the iw-* entry points start without importing the codec libraries."""
+    code = (
+        f"import sys, image_workflow.{module}; "
+        f"print(','.join(m for m in {CODEC_MODULES!r} if m in sys.modules))"
+    )
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert res.stdout.strip() == ""
+
+    # The last line is the entry module itself: "import time: self | cumulative | name"
+    line = res.stderr.strip().splitlines()[-1]
+    cumulative_us = int(line.split("|")[1])
+    assert cumulative_us < IMPORT_BUDGET_MS * 1000, line
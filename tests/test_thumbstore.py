@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from PIL import Image
+
+import image_workflow.common as common
+from image_workflow.add_thumbnails import main as add_main
+from image_workflow.cache import get_cache
+from image_workflow.common import (
+    add_thumbnail,
+    build_thumbnail,
+    extract_thumbnail,
+    get_sha1,
+)
+from image_workflow.extract_thumbnails import main as extract_main
+from image_workflow.manage_cache import main as cache_main
+from image_workflow.remove_thumbnails import main as remove_main
+from image_workflow.thumbstore import get_thumbnail_store
+
+
+def test_extract_reads_through_store(monkeypatch):
+    """Test copies of an image are extracted once and do not collide by name."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            os.mkdir("a")
+            os.mkdir("b")
+            shutil.copy2(
+                os.path.join(original_cwd, "test_images/clean_sample.jpg"), "a/x.jpg"
+            )
+            assert add_thumbnail("a/x.jpg")
+            shutil.copy2("a/x.jpg", "b/x.jpg")
+            # Only images already hashed use the store
+            assert get_cache().peek("a/x.jpg", "sha1") is None
+            for path in ("a/x.jpg", "b/x.jpg"):
+                get_cache().get(path, "sha1", get_sha1)
+
+            assert extract_thumbnail("a/x.jpg", "thumbnails")
+
+            def no_extraction(file_path, thumb_path):
+                raise AssertionError("stored thumbnail should not be extracted again")
+
+            monkeypatch.setattr(
+                common.ExifImageProcessor, "extract_thumbnail", no_extraction
+            )
+            assert extract_thumbnail("b/x.jpg", "thumbnails")
+            first = Path("thumbnails/a/x.jpg.jpg").read_bytes()
+            assert Path("thumbnails/b/x.jpg.jpg").read_bytes() == first
+            assert get_thumbnail_store().count() == 2  # generated + embedded
+
+            # A generated thumbnail is reused for the copy, too
+            build_thumbnail("a/x.jpg")
+            monkeypatch.setattr(common.ExifImageProcessor, "build_thumbnail", None)
+            assert build_thumbnail("b/x.jpg").size == common.THUMBNAIL_SIZE
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_store_evicts_least_recently_used():
+    """Test the store stays within its size limit, dropping the oldest objects."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            store = get_thumbnail_store()
+
+            def produce(path):
+                with open(path, "wb") as f:
+                    f.write(b"x" * 100)
+
+            store.max_bytes = 250
+            first = store.add("a" * 40, "embedded.jpg", produce)
+            store.add("b" * 40, "embedded.jpg", produce)
+            assert store.lookup("a" * 40, "embedded.jpg") == first
+            store.add("c" * 40, "embedded.jpg", produce)
+
+            assert store.size() == 200
+            assert store.lookup("a" * 40, "embedded.jpg")
+            assert store.lookup("b" * 40, "embedded.jpg") is None
+            assert store.add("d" * 40, "embedded.jpg", lambda path: False) is None
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_store_never_hashes(monkeypatch):
+    """Test building and extracting thumbnails does not read the image to hash it."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            shutil.copy2(
+                os.path.join(original_cwd, "test_images/clean_sample.png"), "x.png"
+            )
+
+            def no_hashing(path):
+                raise AssertionError("the store should not hash images")
+
+            monkeypatch.setattr(common, "get_sha1", no_hashing)
+            assert build_thumbnail("x.png").size == common.THUMBNAIL_SIZE
+            assert extract_thumbnail("x.png", "thumbnails") is False
+            assert get_thumbnail_store().count() == 0
+        finally:
+            os.chdir(original_cwd)
+
+
+def test_replaced_sidecar_is_extracted_again():
+    """Test a sidecar replaced while its image stays the same is not served stale."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            Image.new("RGB", (512, 256), "red").save("x.png")
+            cache_main(["rebuild", "-j", "1"])
+
+            add_main(["-j", "1"])
+            extract_main(["-j", "1"])
+            with Image.open("thumbnails/x.png.jpg") as img:
+                assert img.size == (256, 256)
+
+            remove_main(["-j", "1"])
+            add_main(["-j", "1", "--keep-aspect", "--force"])
+            extract_main(["-j", "1"])
+            with Image.open("thumbnails/x.png.jpg") as img:
+                assert img.size == (256, 128)
+        finally:
+            os.chdir(original_cwd)
@@ -10,7 +10,11 @@ from image_workflow.common import (
     extract_thumbnail,
     remove_thumbnail,
 )
-from image_workflow.compress_tiffs import compress_tiff
+from image_workflow.compress_tiffs import (
+    CompressionSettings,
+    compress_tiff,
+    operation_name,
+)
 
 TEST_IMAGE_DIR = "test_images"
 CLEAN_TIFF = os.path.join(TEST_IMAGE_DIR, "clean_sample.tif")
@@ -109,3 +113,236 @@ def test_tiff_compression_preservation():
             assert (
                 thumb_series.pages[0].compression == 5
             ), "Thumbnail should also be compressed"
+
+
+def test_tiff_streamed_rewrite(monkeypatch):
+    """
+    Verify images larger than the buffer are rewritten segment by segment
+    without changing their pixels.
+    """
+    import numpy as np
+    from image_workflow import tiffio
+
+    monkeypatch.setattr(tiffio, "DEFAULT_BUFFER_SIZE", 16 * 1024)
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 255, (601, 503, 3), dtype=np.uint8)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Compressed strips: add/remove thumbnail copy the encoded segments
+        test_tif = os.path.join(tmpdir, "strips.tif")
+        tifffile.imwrite(
+            test_tif, data, photometric="rgb", compression="zlib", rowsperstrip=7
+        )
+        assert add_thumbnail(test_tif) is True
+        with tifffile.TiffFile(test_tif) as tif:
+            assert tif.pages[0].compression == 8
+            assert tif.pages[0].rowsperstrip == 7
+            assert np.array_equal(tif.pages[0].asarray(), data)
+        assert remove_thumbnail(test_tif) is True
+
+        # Uncompressed source: recompressed as streamed LZW tiles
+        data //= 64  # random bytes would not get smaller
+        raw_tif = os.path.join(tmpdir, "raw.tif")
+        tifffile.imwrite(raw_tif, data, photometric="rgb")
+        compress_tiff(raw_tif, buffer_size=16 * 1024)
+        with tifffile.TiffFile(raw_tif) as tif:
+            page = tif.pages[0]
+            assert page.compression == 5
+            assert page.is_tiled
+            assert np.array_equal(page.asarray(), data)
+
+
+def test_tiff_thumbnail_streamed_from_large_image(monkeypatch):
+    """
+    Verify an image over Pillow's pixel limit gets its thumbnail built from
+    its tiles, without the whole raster being decoded.
+    """
+    import numpy as np
+    from PIL import Image
+    from image_workflow import tiffio
+
+    monkeypatch.setattr(tiffio, "DEFAULT_BUFFER_SIZE", 64 * 1024)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100_000)
+    data = np.zeros((1000, 2000, 3), dtype=np.uint8)
+    data[:, :1000, 0] = 200  # red left half, blue right half
+    data[:, 1000:, 2] = 200
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_tif = os.path.join(tmpdir, "large.tif")
+        tifffile.imwrite(
+            test_tif, data, photometric="rgb", compression="lzw", tile=(128, 128)
+        )
+        with pytest.raises(Image.DecompressionBombError):
+            Image.open(test_tif)
+
+        def no_full_decode(self, *args, **kwargs):
+            raise AssertionError("the whole image should not be decoded")
+
+        monkeypatch.setattr(tifffile.TiffPage, "asarray", no_full_decode)
+        thumb = TiffImageProcessor.build_thumbnail(test_tif, keep_aspect=True)
+        assert thumb.size == (256, 128)
+        assert thumb.getpixel((10, 64)) == (200, 0, 0)
+        assert thumb.getpixel((245, 64)) == (0, 0, 200)
+
+
+def test_tiff_compression_settings(capsys):
+    """Verify codec, predictor, level and tiling options give lossless output."""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 255, (300, 200, 3), dtype=np.uint8)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_tif = os.path.join(tmpdir, "a.tif")
+        tifffile.imwrite(test_tif, data, photometric="rgb")
+        settings = CompressionSettings("zstd", "auto", 5, 64, 2)
+        assert operation_name(settings) == "compress-zstd-auto-l5-t64"
+        assert compress_tiff(test_tif, thumbnails=[data[::4, ::4]], settings=settings)
+        assert "Compressed" in capsys.readouterr().out
+
+        with tifffile.TiffFile(test_tif) as tif:
+            page = tif.pages[0]
+            assert page.compression == tifffile.COMPRESSION.ZSTD
+            assert page.predictor == tifffile.PREDICTOR.HORIZONTAL
+            assert page.tilewidth == 64
+            assert np.array_equal(page.asarray(), data)
+            assert page.pages[0].compression == tifffile.COMPRESSION.LZW
+
+
+def test_tiff_compression_skipped_when_no_gain(capsys):
+    """Verify compressed files are skipped and incompressible ones kept as is."""
+    import numpy as np
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        smooth_tif = os.path.join(tmpdir, "smooth.tif")
+        tifffile.imwrite(smooth_tif, np.zeros((64, 64), dtype=np.float32))
+        settings = CompressionSettings("deflate", "auto", tile=32)
+        assert compress_tiff(smooth_tif, settings=settings)
+        with tifffile.TiffFile(smooth_tif) as tif:
+            assert tif.pages[0].predictor == tifffile.PREDICTOR.FLOATINGPOINT
+        before = os.stat(smooth_tif)
+        assert compress_tiff(smooth_tif, settings=settings)
+        assert "Skipped" in capsys.readouterr().out
+        assert os.stat(smooth_tif).st_ino == before.st_ino
+
+        # A different tile size is not what was asked for
+        settings = settings._replace(tile=16)
+        assert compress_tiff(smooth_tif, settings=settings)
+        assert "Compressed" in capsys.readouterr().out
+        with tifffile.TiffFile(smooth_tif) as tif:
+            assert tif.pages[0].tilewidth == 16
+            assert tif.pages[0].tilelength == 16
+        assert compress_tiff(smooth_tif, settings=settings)
+        assert "Skipped" in capsys.readouterr().out
+
+        rng = np.random.default_rng(0)
+        noise_tif = os.path.join(tmpdir, "noise.tif")
+        tifffile.imwrite(noise_tif, rng.integers(0, 255, (64, 64), dtype=np.uint8))
+        with open(noise_tif, "rb") as f:
+            original = f.read()
+        assert compress_tiff(noise_tif)
+        assert "Kept" in capsys.readouterr().out
+        with open(noise_tif, "rb") as f:
+            assert f.read() == original
+        assert sorted(os.listdir(tmpdir)) == ["noise.tif", "smooth.tif"]
+
+
+def test_tiff_thumbnail_appended_in_place():
+    """
+    Verify adding a thumbnail leaves the original image bytes untouched and an
+    interrupted append can be rolled back from its journal.
+    """
+    from image_workflow.tiffio import JOURNAL_SUFFIX, recover_append
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_tif = os.path.join(tmpdir, "inplace.tif")
+        shutil.copy2(CLEAN_TIFF, test_tif)
+        with open(test_tif, "rb") as f:
+            original = f.read()
+
+        assert add_thumbnail(test_tif) is True
+        with open(test_tif, "rb") as f:
+            updated = f.read()
+        # Only the first-IFD pointer in the header changed; the rest was appended
+        assert updated[8 : len(original)] == original[8:]
+        assert not os.path.exists(test_tif + JOURNAL_SUFFIX)
+        assert has_thumbnail(test_tif) is True
+
+        # Simulate a crash after the header was switched but before cleanup
+        with open(test_tif + JOURNAL_SUFFIX, "w") as f:
+            f.write(
+                '{"size": %d, "header": "%s"}' % (len(original), original[:8].hex())
+            )
+        assert recover_append(test_tif) is True
+        with open(test_tif, "rb") as f:
+            assert f.read() == original
+
+
+def test_tiff_thumbnail_appended_replaces_description():
+    """Verify an appended page 0 has exactly one ImageDescription, the provenance."""
+    import json
+    import numpy as np
+    from image_workflow.headers import TiffReader
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_tif = os.path.join(tmpdir, "scanned.tif")
+        tifffile.imwrite(
+            test_tif,
+            np.zeros((300, 200, 3), np.uint8),
+            photometric="rgb",
+            description="Scanned with ACME 9000",
+            metadata=None,
+        )
+        with open(test_tif, "rb") as f:
+            original = f.read()
+
+        assert add_thumbnail(test_tif) is True
+        with open(test_tif, "rb") as f:
+            assert f.read()[8 : len(original)] == original[8:]
+            reader = TiffReader(f)
+            entries, _ = reader.read_ifd(reader.first_ifd)
+        tags = [entry.tag for entry in entries]
+        assert tags.count(270) == 1
+        assert tags == sorted(tags)
+        with tifffile.TiffFile(test_tif) as tif:
+            assert "sha1" in json.loads(tif.pages[0].description)
+
+
+def test_extract_copies_jpeg_thumbnail(monkeypatch):
+    """
+    A JPEG-compressed SubIFD thumbnail is copied without being decoded, and
+    an unchanged thumbnail is not rewritten.
+    """
+    import numpy as np
+    from PIL import Image
+    from image_workflow.tiffio import jpeg_stream
+
+    monkeypatch.setenv("IW_CACHE", "off")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        test_tif = os.path.join(tmpdir, "test.tif")
+        thumb = np.full((64, 48, 3), (200, 50, 30), dtype=np.uint8)
+        with tifffile.TiffWriter(test_tif) as writer:
+            writer.write(np.zeros((300, 200, 3), np.uint8), subifds=1)
+            writer.write(thumb, photometric="rgb", compression="jpeg", subfiletype=1)
+
+        def no_decoding(*args, **kwargs):
+            raise AssertionError("JPEG thumbnail should be copied, not decoded")
+
+        monkeypatch.setattr(tifffile.TiffPage, "asarray", no_decoding)
+        monkeypatch.setattr(tifffile.TiffPageSeries, "asarray", no_decoding)
+        assert extract_thumbnail(test_tif, tmpdir)
+        thumb_path = os.path.join(tmpdir, "test.tif.jpg")
+        with tifffile.TiffFile(test_tif) as tif:
+            embedded = jpeg_stream(tif, tif.pages[0].pages[0])
+        with open(thumb_path, "rb") as f:
+            assert f.read() == embedded
+        with Image.open(thumb_path) as img:
+            assert img.size == (48, 64)
+            assert (
+                max(abs(a - b) for a, b in zip(img.getpixel((10, 10)), (200, 50, 30)))
+                < 4
+            )
+
+        os.utime(thumb_path, ns=(0, 0))
+        assert extract_thumbnail(test_tif, tmpdir)
+        assert os.stat(thumb_path).st_mtime_ns == 0
@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+from PIL import Image
+
+from image_workflow.common import GENERATED_DIRS, SIDECAR_SUFFIX, add_thumbnail
+from image_workflow.watch import Watcher
+
+
+def test_watcher_reports_new_files_only():
+    """Test new files are reported once settled, and the tool's own writes are not."""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            os.chdir(tmpdir)
+            os.mkdir("thumbnails")
+            watcher = Watcher(".", [".jpg", ".png", ".tiff"], GENERATED_DIRS, 0.1)
+            try:
+                Image.new("RGB", (64, 64)).save("a.jpg")
+                Image.new("RGB", (64, 64)).save("thumbnails/a.jpg")
+                # compress_tiff's rewrite of b.tif (not watched) in progress
+                Image.new("RGB", (64, 64)).save("b.tif")
+                Image.new("RGB", (64, 64)).save("b-compressed.tiff")
+                os.mkdir("scans")
+                Image.new("RGB", (64, 64)).save("scans/b.png")
+                assert watcher.wait() == ["a.jpg", "scans/b.png"]
+
+                assert add_thumbnail("a.jpg") and add_thumbnail("scans/b.png")
+                watcher.done(["a.jpg", "scans/b.png"])
+                assert os.path.exists("scans/b.png" + SIDECAR_SUFFIX)
+                Image.new("RGB", (64, 64)).save("c.jpg")
+                assert watcher.wait() == ["c.jpg"]
+            finally:
+                watcher.close()
+        finally:
+            os.chdir(original_cwd)